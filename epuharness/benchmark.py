@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import yaml
+import socket
+import logging
+import resource
+import tempfile
+import argparse
+import xmlrpclib
+import collections
+
+from functools import partial
+
+import procstat
+from harness import EPUHarness
+from schema import validate_deployment
+from deployment import DeploymentPlan, compile_deployment, clear_plan_cache
+
+log = logging.getLogger(__name__)
+
+ERROR_RETURN = 1
+
+
+def make_deployment(process_dispatchers, nodes, eeagents):
+    """Generate a synthetic deployment
+
+    @param process_dispatchers: the number of process dispatchers
+    @param nodes: the number of nodes for each process dispatcher
+    @param eeagents: the number of eeagents on each node
+    """
+    deployment = {'process-dispatchers': {}, 'nodes': {}}
+    for pd_index in range(process_dispatchers):
+        pd_name = "pd_%d" % pd_index
+        deployment['process-dispatchers'][pd_name] = {
+            'config': {
+                'processdispatcher': {
+                    'engines': {
+                        'default': {
+                            'deployable_type': 'eeagent',
+                            'slots': 4,
+                            'base_need': 1
+                        }
+                    }
+                }
+            }
+        }
+
+        for node_index in range(nodes):
+            node_name = "node_%d_%d" % (pd_index, node_index)
+            node = {
+                'engine': 'default',
+                'process-dispatcher': pd_name,
+                'eeagents': {}
+            }
+            for eeagent_index in range(eeagents):
+                eeagent_name = "eeagent_%s_%d" % (node_name, eeagent_index)
+                node['eeagents'][eeagent_name] = {'launch_type': 'fork'}
+            deployment['nodes'][node_name] = node
+
+    return deployment
+
+
+def make_template_deployment(process_dispatchers, nodes, eeagents):
+    """Generate a synthetic deployment like make_deployment, as templates.
+    Nodes are spread over the process dispatchers in turn.
+    """
+    pd_names = ["pd_%d" % pd_index for pd_index in range(process_dispatchers)]
+    return {
+        'process-dispatchers': {
+            'template': 'pd_{i}',
+            'count': process_dispatchers,
+            'config': {
+                'processdispatcher': {
+                    'engines': {
+                        'default': {
+                            'deployable_type': 'eeagent',
+                            'slots': 4,
+                            'base_need': 1
+                        }
+                    }
+                }
+            }
+        },
+        'nodes': {
+            'template': 'node_{i}',
+            'count': process_dispatchers * nodes,
+            'engine': 'default',
+            'process-dispatcher': {'cycle': pd_names},
+            'eeagents_per_node': eeagents,
+            'eeagent': {'launch_type': 'fork'},
+        },
+    }
+
+
+class CountingProxy(object):
+    """Wraps an object and counts calls to its methods in counts.
+
+    Objects returned by get_pidantic and reload_instances are wrapped too,
+    so that calls made on each pidantic instance are counted. One pidantic
+    call may make several XML-RPC requests to supervisord, or none.
+    """
+
+    def __init__(self, target, counts, prefix=""):
+        self._target = target
+        self._counts = counts
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        key = self._prefix + name
+
+        def counted(*args, **kwargs):
+            self._counts[key] += 1
+            result = attr(*args, **kwargs)
+            if name == 'get_pidantic':
+                result = CountingProxy(result, self._counts, prefix="pidantic.")
+            elif name == 'reload_instances':
+                result = dict((instance_name, CountingProxy(instance, self._counts,
+                    prefix="pidantic.")) for instance_name, instance in result.iteritems())
+            return result
+        return counted
+
+
+class BenchmarkHarness(EPUHarness):
+    """An EPUHarness that runs a stand-in executable in place of each
+    service, counts calls to pidantic and XML-RPC requests to supervisord,
+    and skips node announcements, which the stand-ins can't answer
+    """
+
+    def __init__(self, stand_in="echo", **kwargs):
+        super(BenchmarkHarness, self).__init__(**kwargs)
+        self.stand_in = stand_in
+        self.pidantic_counts = collections.defaultdict(int)
+        self.rpc_counts = collections.defaultdict(int)
+
+    def _setup_factory(self):
+        if self.factory:
+            return
+        super(BenchmarkHarness, self)._setup_factory()
+        if self.supd.transport is not None:
+            self._count_requests(self.supd.transport)
+        self.factory = CountingProxy(self.factory, self.pidantic_counts)
+
+    def _count_requests(self, transport):
+        """Count each XML-RPC request sent through pidantic's supervisord
+        transport, by method
+        """
+        request = transport.request
+
+        def counted(host, handler, request_body, verbose=0):
+            _, method = xmlrpclib.loads(request_body)
+            self.rpc_counts[method] += 1
+            return request(host, handler, request_body, verbose)
+        transport.request = counted
+
+    def _program(self, proc_name, service, kind, command, **kwargs):
+        args = command.split()[1:]
+        command = " ".join([self.stand_in] + args)
+        return super(BenchmarkHarness, self)._program(proc_name, service,
+                kind, command, **kwargs)
+
+    def announce_nodes(self, nodes, state=None):
+        return []
+
+
+def peak_rss():
+    """Returns the peak RSS of this process in KB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def services_rss(harness):
+    """Returns the RSS of every process supervisord runs for a harness,
+    with their children, in KB
+    """
+    processes = procstat.read_all_processes()
+    total = 0
+    for info in harness._process_info().itervalues():
+        for pid in procstat.process_tree(info.get('pid') or 0, processes):
+            total += processes[pid]['rss']
+    return total / 1024
+
+
+def run_benchmark(process_dispatchers, nodes, eeagents, stand_in="echo",
+        amqp_uri="memory://epuharness-benchmark"):
+    """Start, poll and stop a synthetic deployment, and return how long
+    each phase took
+    """
+    deployment = make_deployment(process_dispatchers, nodes, eeagents)
+    deployment_str = yaml.dump(deployment)
+
+    pidantic_dir = tempfile.mkdtemp(prefix="epuharness-benchmark")
+    os.rmdir(pidantic_dir)
+    harness = BenchmarkHarness(stand_in=stand_in, amqp_uri=amqp_uri,
+            pidantic_dir=pidantic_dir)
+
+    result = {
+        'process_dispatchers': process_dispatchers,
+        'nodes': nodes,
+        'eeagents': eeagents,
+        'phases': {},
+        'pidantic_calls': {},
+        'rpc_calls': {},
+        'services_rss_kb': {},
+    }
+
+    phases = [
+        ('start', lambda: harness.start(deployment_str=deployment_str)),
+        ('status', lambda: harness.status(exit=False)),
+        ('stop', lambda: harness.stop()),
+    ]
+    for phase, fn in phases:
+        harness.pidantic_counts.clear()
+        harness.rpc_counts.clear()
+        began = time.time()
+        fn()
+        result['phases'][phase] = time.time() - began
+        result['pidantic_calls'][phase] = dict(harness.pidantic_counts)
+        result['rpc_calls'][phase] = dict(harness.rpc_counts)
+        if phase != 'stop':
+            result['services_rss_kb'][phase] = services_rss(harness)
+        if phase == 'start':
+            result['programs'] = harness.launch_timings['programs']
+            result['launch_timings'] = harness.launch_timings
+
+    result['timings'] = harness.timings.summary()
+    result['peak_rss_kb'] = peak_rss()
+    return result
+
+
+def run_compile_benchmark(process_dispatchers, nodes, eeagents):
+    """Time loading, validating and compiling a synthetic deployment,
+    without starting anything
+    """
+    deployment = make_deployment(process_dispatchers, nodes, eeagents)
+    deployment_str = yaml.dump(deployment)
+    template_str = yaml.dump(make_template_deployment(process_dispatchers,
+        nodes, eeagents))
+
+    result = {
+        'process_dispatchers': process_dispatchers,
+        'nodes': nodes,
+        'eeagents': eeagents,
+        'bytes': len(deployment_str),
+        'template_bytes': len(template_str),
+        'libyaml': hasattr(yaml, 'CSafeLoader'),
+        'phases': {},
+    }
+
+    loaders = [('load_python', yaml.SafeLoader)]
+    if result['libyaml']:
+        loaders.append(('load_libyaml', yaml.CSafeLoader))
+    phases = [(phase, partial(yaml.load, deployment_str, Loader=loader))
+            for phase, loader in loaders]
+    phases.extend([
+        ('validate', lambda: validate_deployment(deployment)),
+        ('plan', lambda: DeploymentPlan(deployment)),
+        ('compile', lambda: compile_deployment(yaml_str=deployment_str)),
+        ('compile_cached', lambda: compile_deployment(yaml_str=deployment_str)),
+        ('compile_template', lambda: compile_deployment(yaml_str=template_str)),
+    ])
+
+    clear_plan_cache()
+    for phase, fn in phases:
+        began = time.time()
+        value = fn()
+        result['phases'][phase] = time.time() - began
+        if phase == 'plan':
+            result['services'] = len(value.services)
+        elif phase == 'compile_template':
+            result['template_services'] = len(value.services)
+
+    result['peak_rss_kb'] = peak_rss()
+    return result
+
+
+def main(argv=None):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not argv:
+        argv = list(sys.argv)
+    argv.pop(0)
+
+    parser = argparse.ArgumentParser("Benchmark EPU Harness startup and teardown")
+    parser.add_argument('-n', '--process-dispatchers', type=int, nargs='+',
+            default=[1], metavar='N', help='process dispatchers to start')
+    parser.add_argument('-m', '--nodes', type=int, nargs='+', default=[1],
+            metavar='M', help='nodes for each process dispatcher')
+    parser.add_argument('-k', '--eeagents', type=int, nargs='+', default=[1],
+            metavar='K', help='eeagents on each node')
+    parser.add_argument('-r', '--repeat', type=int, default=1)
+    parser.add_argument('--stand-in', default='echo',
+            help='executable to run in place of each service')
+    parser.add_argument('-o', '--output', metavar='JSON_FILE', default=None)
+    parser.add_argument('--compile-only', action='store_true',
+            help='only time loading and validating the deployment')
+    args = parser.parse_args(argv)
+
+    results = []
+    for process_dispatchers in args.process_dispatchers:
+        for nodes in args.nodes:
+            for eeagents in args.eeagents:
+                for _ in range(args.repeat):
+                    if args.compile_only:
+                        result = run_compile_benchmark(process_dispatchers,
+                                nodes, eeagents)
+                    else:
+                        result = run_benchmark(process_dispatchers, nodes,
+                                eeagents, stand_in=args.stand_in)
+                    log.info("%(process_dispatchers)s PDs, %(nodes)s nodes, "
+                            "%(eeagents)s eeagents: %(phases)s" % result)
+                    results.append(result)
+
+    report = {
+        'timestamp': time.time(),
+        'hostname': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+    report_json = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report_json)
+    else:
+        print report_json
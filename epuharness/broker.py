@@ -0,0 +1,1006 @@
+import re
+import sys
+import uuid
+import struct
+import signal
+import socket
+import logging
+import itertools
+import collections
+
+import gevent
+import gevent.queue
+import dashi.bootstrap as bootstrap
+
+from gevent.server import StreamServer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+PROTOCOL_HEADER = "AMQP\x00\x00\x09\x01"
+# Older clients, like py-amqp 1.x, send the header RabbitMQ used before 0-9-1
+# had its own protocol id
+PROTOCOL_HEADERS = (PROTOCOL_HEADER, "AMQP\x01\x01\x00\x09")
+
+FRAME_METHOD = 1
+FRAME_HEADER = 2
+FRAME_BODY = 3
+FRAME_HEARTBEAT = 8
+FRAME_END = "\xce"
+
+FRAME_MAX = 131072
+CHANNEL_MAX = 2047
+# Frame type, channel and size, then the payload and the end octet
+FRAME_OVERHEAD = 8
+
+# Reply codes
+REPLY_SUCCESS = 200
+NO_ROUTE = 312
+ACCESS_REFUSED = 403
+NOT_FOUND = 404
+RESOURCE_LOCKED = 405
+PRECONDITION_FAILED = 406
+FRAME_ERROR = 501
+COMMAND_INVALID = 503
+CHANNEL_ERROR = 504
+NOT_ALLOWED = 530
+NOT_IMPLEMENTED = 540
+
+CONNECTION, CHANNEL, EXCHANGE, QUEUE, BASIC, CONFIRM = 10, 20, 40, 50, 60, 85
+
+# The arguments of every method the broker sends or receives, as a string
+# of field codes: o octet, s short, l long, L long long, n short string,
+# S long string, b bit, t table
+METHODS = {
+    (CONNECTION, 10): ('connection.start', 'ootSS'),
+    (CONNECTION, 11): ('connection.start-ok', 'tnSn'),
+    (CONNECTION, 30): ('connection.tune', 'sls'),
+    (CONNECTION, 31): ('connection.tune-ok', 'sls'),
+    (CONNECTION, 40): ('connection.open', 'nnb'),
+    (CONNECTION, 41): ('connection.open-ok', 'n'),
+    (CONNECTION, 50): ('connection.close', 'snss'),
+    (CONNECTION, 51): ('connection.close-ok', ''),
+    (CHANNEL, 10): ('channel.open', 'n'),
+    (CHANNEL, 11): ('channel.open-ok', 'S'),
+    (CHANNEL, 20): ('channel.flow', 'b'),
+    (CHANNEL, 21): ('channel.flow-ok', 'b'),
+    (CHANNEL, 40): ('channel.close', 'snss'),
+    (CHANNEL, 41): ('channel.close-ok', ''),
+    (EXCHANGE, 10): ('exchange.declare', 'snnbbbbbt'),
+    (EXCHANGE, 11): ('exchange.declare-ok', ''),
+    (EXCHANGE, 20): ('exchange.delete', 'snbb'),
+    (EXCHANGE, 21): ('exchange.delete-ok', ''),
+    (QUEUE, 10): ('queue.declare', 'snbbbbbt'),
+    (QUEUE, 11): ('queue.declare-ok', 'nll'),
+    (QUEUE, 20): ('queue.bind', 'snnnbt'),
+    (QUEUE, 21): ('queue.bind-ok', ''),
+    (QUEUE, 30): ('queue.purge', 'snb'),
+    (QUEUE, 31): ('queue.purge-ok', 'l'),
+    (QUEUE, 40): ('queue.delete', 'snbbb'),
+    (QUEUE, 41): ('queue.delete-ok', 'l'),
+    (QUEUE, 50): ('queue.unbind', 'snnnt'),
+    (QUEUE, 51): ('queue.unbind-ok', ''),
+    (BASIC, 10): ('basic.qos', 'lsb'),
+    (BASIC, 11): ('basic.qos-ok', ''),
+    (BASIC, 20): ('basic.consume', 'snnbbbbt'),
+    (BASIC, 21): ('basic.consume-ok', 'n'),
+    (BASIC, 30): ('basic.cancel', 'nb'),
+    (BASIC, 31): ('basic.cancel-ok', 'n'),
+    (BASIC, 40): ('basic.publish', 'snnbb'),
+    (BASIC, 50): ('basic.return', 'snnn'),
+    (BASIC, 60): ('basic.deliver', 'nLbnn'),
+    (BASIC, 70): ('basic.get', 'snb'),
+    (BASIC, 71): ('basic.get-ok', 'Lbnnl'),
+    (BASIC, 72): ('basic.get-empty', 'n'),
+    (BASIC, 80): ('basic.ack', 'Lb'),
+    (BASIC, 90): ('basic.reject', 'Lb'),
+    (BASIC, 100): ('basic.recover-async', 'b'),
+    (BASIC, 110): ('basic.recover', 'b'),
+    (BASIC, 111): ('basic.recover-ok', ''),
+    (BASIC, 120): ('basic.nack', 'Lbb'),
+    (CONFIRM, 10): ('confirm.select', 'b'),
+    (CONFIRM, 11): ('confirm.select-ok', ''),
+}
+
+EXCHANGE_TYPES = ('direct', 'topic', 'fanout')
+
+
+class AMQPError(Exception):
+    """A protocol error, which closes the channel it happened on, or the
+    whole connection if connection is True
+    """
+
+    def __init__(self, code, text, method=None, connection=False):
+        Exception.__init__(self, text)
+        self.code = code
+        self.text = text
+        self.method = method or (0, 0)
+        self.connection = connection
+
+
+class _Reader(object):
+    """Decodes the fields of a method frame"""
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+        self.bits = None
+        self.bit = 0
+
+    def _unpack(self, fmt, size):
+        value, = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += size
+        return value
+
+    def read(self, code):
+        if code == 'b':
+            if self.bits is None or self.bit == 8:
+                self.bits = ord(self.data[self.offset])
+                self.offset += 1
+                self.bit = 0
+            value = bool(self.bits & (1 << self.bit))
+            self.bit += 1
+            return value
+        self.bits = None
+        if code == 'o':
+            return self._unpack('>B', 1)
+        elif code == 's':
+            return self._unpack('>H', 2)
+        elif code == 'l':
+            return self._unpack('>I', 4)
+        elif code == 'L':
+            return self._unpack('>Q', 8)
+        elif code == 'n':
+            size = self._unpack('>B', 1)
+            value = self.data[self.offset:self.offset + size]
+            self.offset += size
+            return value
+        elif code in 'St':
+            # Tables are passed over rather than decoded, since nothing the
+            # broker supports depends on their contents
+            size = self._unpack('>I', 4)
+            value = self.data[self.offset:self.offset + size]
+            self.offset += size
+            return value
+        raise ValueError("Unknown field code %s" % code)
+
+
+def _encode_table(table):
+    fields = []
+    for key, value in sorted(table.iteritems()):
+        fields.append(struct.pack('>B', len(key)) + key)
+        if isinstance(value, bool):
+            fields.append('t' + struct.pack('>B', int(value)))
+        elif isinstance(value, dict):
+            fields.append('F' + _encode_table(value))
+        else:
+            value = str(value)
+            fields.append('S' + struct.pack('>I', len(value)) + value)
+    encoded = "".join(fields)
+    return struct.pack('>I', len(encoded)) + encoded
+
+
+def encode_method(class_id, method_id, *args):
+    """Encode the payload of a method frame"""
+    _, signature = METHODS[(class_id, method_id)]
+    parts = [struct.pack('>HH', class_id, method_id)]
+    bits = []
+    for code, value in zip(signature, args):
+        if code == 'b':
+            bits.append(value)
+            continue
+        if bits:
+            parts.append(_pack_bits(bits))
+            bits = []
+        if code == 'o':
+            parts.append(struct.pack('>B', value))
+        elif code == 's':
+            parts.append(struct.pack('>H', value))
+        elif code == 'l':
+            parts.append(struct.pack('>I', value))
+        elif code == 'L':
+            parts.append(struct.pack('>Q', value))
+        elif code == 'n':
+            value = value[:255]
+            parts.append(struct.pack('>B', len(value)) + value)
+        elif code == 'S':
+            parts.append(struct.pack('>I', len(value)) + value)
+        elif code == 't':
+            parts.append(_encode_table(value or {}))
+    if bits:
+        parts.append(_pack_bits(bits))
+    return "".join(parts)
+
+
+def _pack_bits(bits):
+    octets = []
+    for start in range(0, len(bits), 8):
+        octet = 0
+        for i, bit in enumerate(bits[start:start + 8]):
+            if bit:
+                octet |= 1 << i
+        octets.append(struct.pack('>B', octet))
+    return "".join(octets)
+
+
+def decode_method(payload):
+    """Decode the payload of a method frame
+
+    @return: a tuple of (class_id, method_id) and a list of arguments
+    """
+    class_id, method_id = struct.unpack_from('>HH', payload)
+    method = (class_id, method_id)
+    if method not in METHODS:
+        raise AMQPError(NOT_IMPLEMENTED, "Unsupported method %s.%s" % method,
+                method, connection=True)
+    reader = _Reader(payload, 4)
+    return method, [reader.read(code) for code in METHODS[method][1]]
+
+
+def frame(frame_type, channel, payload):
+    return struct.pack('>BHI', frame_type, channel, len(payload)) + payload + FRAME_END
+
+
+class Message(object):
+    """A published message. Properties are kept in their encoded form, so
+    they're passed on to consumers untouched
+    """
+
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body')
+
+    def __init__(self, exchange, routing_key, properties, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+
+
+class Exchange(object):
+
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+        # routing keys, indexed by queue name
+        self.bindings = {}
+        # queue names, indexed by the routing keys they're bound with.
+        # Topic bindings with wildcards are kept apart, as patterns, so
+        # most messages are routed with one lookup
+        self._exact = collections.defaultdict(set)
+        self._patterns = {}
+
+    def bind(self, queue_name, routing_key):
+        self.bindings.setdefault(queue_name, set()).add(routing_key)
+        if self.type == 'topic' and ('*' in routing_key or '#' in routing_key):
+            if routing_key not in self._patterns:
+                self._patterns[routing_key] = (_topic_pattern(routing_key), set())
+            self._patterns[routing_key][1].add(queue_name)
+        else:
+            self._exact[routing_key].add(queue_name)
+
+    def unbind(self, queue_name, routing_key):
+        keys = self.bindings.get(queue_name)
+        if keys is None or routing_key not in keys:
+            return
+        keys.discard(routing_key)
+        if not keys:
+            del self.bindings[queue_name]
+        for index in (self._exact, dict((key, queues) for key, (_, queues)
+                in self._patterns.iteritems())):
+            queues = index.get(routing_key)
+            if queues is not None:
+                queues.discard(queue_name)
+        if routing_key in self._exact and not self._exact[routing_key]:
+            del self._exact[routing_key]
+        if routing_key in self._patterns and not self._patterns[routing_key][1]:
+            del self._patterns[routing_key]
+
+    def unbind_queue(self, queue_name):
+        for routing_key in list(self.bindings.get(queue_name, ())):
+            self.unbind(queue_name, routing_key)
+
+    def route(self, routing_key):
+        """Returns the names of the queues a message is routed to"""
+        if self.type == 'fanout':
+            return list(self.bindings)
+        queue_names = set(self._exact.get(routing_key, ()))
+        for pattern, queues in self._patterns.itervalues():
+            if pattern.match(routing_key):
+                queue_names.update(queues)
+        return list(queue_names)
+
+
+def _topic_pattern(binding_key):
+    """Compile a topic binding key, where * matches one word and # matches
+    any number of words, including none
+    """
+    words = []
+    for word in binding_key.split('.'):
+        if word == '#':
+            words.append('#')
+        elif word == '*':
+            words.append(r'[^.]*')
+        else:
+            words.append(re.escape(word))
+    pattern = r'\.'.join(words).replace(r'\.#', r'(?:\.[^.]*)*')
+    if pattern == '#':
+        pattern = '.*'
+    elif pattern.startswith(r'#\.'):
+        pattern = r'(?:[^.]*\.)*' + pattern[3:]
+    elif pattern.startswith('#'):
+        pattern = r'[^.]*' + pattern[1:]
+    return re.compile(r'\A' + pattern + r'\Z')
+
+
+class Queue(object):
+
+    def __init__(self, name, exclusive_to=None, auto_delete=False):
+        self.name = name
+        self.exclusive_to = exclusive_to
+        self.auto_delete = auto_delete
+        # pairs of a message and whether it has been delivered before
+        self.messages = collections.deque()
+        # consumers, as (channel, consumer tag, no_ack), taken in turn
+        self.consumers = collections.deque()
+        self.had_consumers = False
+
+
+class Router(object):
+    """Holds the exchanges and queues of a broker, and routes messages from
+    publishers to consumers.
+
+    Everything happens in memory in one process. Messages aren't persisted,
+    so durable exchanges and queues last only as long as the broker. There
+    is one namespace, whatever virtual host clients ask for.
+    """
+
+    def __init__(self):
+        self.exchanges = {}
+        self.queues = {}
+        self.counts = {'published': 0, 'delivered': 0, 'unroutable': 0}
+        for name, type in (('', 'direct'), ('amq.direct', 'direct'),
+                ('amq.topic', 'topic'), ('amq.fanout', 'fanout')):
+            self.exchanges[name] = Exchange(name, type)
+
+    def declare_exchange(self, name, type, passive=False):
+        exchange = self.exchanges.get(name)
+        if passive or exchange is not None:
+            if exchange is None:
+                raise AMQPError(NOT_FOUND, "no exchange '%s'" % name, (EXCHANGE, 10))
+            if not passive and exchange.type != type:
+                raise AMQPError(PRECONDITION_FAILED,
+                        "exchange '%s' is of type %s, not %s" % (name, exchange.type, type),
+                        (EXCHANGE, 10))
+            return exchange
+        if type not in EXCHANGE_TYPES:
+            raise AMQPError(COMMAND_INVALID, "unsupported exchange type %s" % type,
+                    (EXCHANGE, 10), connection=True)
+        exchange = self.exchanges[name] = Exchange(name, type)
+        return exchange
+
+    def delete_exchange(self, name):
+        if name not in self.exchanges:
+            raise AMQPError(NOT_FOUND, "no exchange '%s'" % name, (EXCHANGE, 20))
+        if name.startswith('amq.') or not name:
+            raise AMQPError(ACCESS_REFUSED, "can't delete exchange '%s'" % name,
+                    (EXCHANGE, 20))
+        del self.exchanges[name]
+
+    def get_queue(self, name, method, connection=None):
+        queue = self.queues.get(name)
+        if queue is None:
+            raise AMQPError(NOT_FOUND, "no queue '%s'" % name, method)
+        if queue.exclusive_to is not None and queue.exclusive_to is not connection:
+            raise AMQPError(RESOURCE_LOCKED,
+                    "queue '%s' is exclusive to another connection" % name, method)
+        return queue
+
+    def declare_queue(self, name, connection=None, passive=False,
+            exclusive=False, auto_delete=False):
+        if not name:
+            name = "amq.gen-%s" % uuid.uuid4()
+        if passive or name in self.queues:
+            return self.get_queue(name, (QUEUE, 10), connection)
+        queue = self.queues[name] = Queue(name,
+                exclusive_to=connection if exclusive else None,
+                auto_delete=auto_delete)
+        # every queue is bound to the default exchange by its name
+        self.exchanges[''].bind(name, name)
+        return queue
+
+    def bind(self, queue_name, exchange_name, routing_key, connection=None):
+        self.get_queue(queue_name, (QUEUE, 20), connection)
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            raise AMQPError(NOT_FOUND, "no exchange '%s'" % exchange_name, (QUEUE, 20))
+        if not exchange_name:
+            raise AMQPError(ACCESS_REFUSED, "can't bind to the default exchange",
+                    (QUEUE, 20))
+        exchange.bind(queue_name, routing_key)
+
+    def unbind(self, queue_name, exchange_name, routing_key, connection=None):
+        self.get_queue(queue_name, (QUEUE, 50), connection)
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            raise AMQPError(NOT_FOUND, "no exchange '%s'" % exchange_name, (QUEUE, 50))
+        exchange.unbind(queue_name, routing_key)
+
+    def purge_queue(self, name, connection=None):
+        queue = self.get_queue(name, (QUEUE, 30), connection)
+        count = len(queue.messages)
+        queue.messages.clear()
+        return count
+
+    def delete_queue(self, name, connection=None):
+        queue = self.get_queue(name, (QUEUE, 40), connection)
+        for exchange in self.exchanges.itervalues():
+            exchange.unbind_queue(name)
+        for channel, tag, _ in list(queue.consumers):
+            channel.consumers.pop(tag, None)
+        del self.queues[name]
+        return len(queue.messages)
+
+    def publish(self, exchange_name, routing_key, message):
+        """Route a message to every queue bound to match it
+
+        @return: the number of queues the message was routed to
+        """
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            raise AMQPError(NOT_FOUND, "no exchange '%s'" % exchange_name, (BASIC, 40))
+        self.counts['published'] += 1
+        queue_names = exchange.route(routing_key)
+        if not queue_names:
+            self.counts['unroutable'] += 1
+        for queue_name in queue_names:
+            queue = self.queues.get(queue_name)
+            if queue is not None:
+                queue.messages.append((message, False))
+                self.dispatch(queue)
+        return len(queue_names)
+
+    def dispatch(self, queue):
+        """Deliver a queue's messages to its consumers, in turn, while they
+        have room for them under their prefetch limits
+        """
+        while queue.messages and queue.consumers:
+            for _ in range(len(queue.consumers)):
+                channel, tag, no_ack = queue.consumers[0]
+                queue.consumers.rotate(-1)
+                if channel.can_deliver():
+                    break
+            else:
+                return
+            message, redelivered = queue.messages.popleft()
+            channel.deliver(queue, tag, message, redelivered, no_ack)
+            self.counts['delivered'] += 1
+
+    def add_consumer(self, queue, channel, tag, no_ack):
+        queue.consumers.append((channel, tag, no_ack))
+        queue.had_consumers = True
+        self.dispatch(queue)
+
+    def remove_consumer(self, queue, tag):
+        for consumer in list(queue.consumers):
+            if consumer[1] == tag:
+                queue.consumers.remove(consumer)
+        if queue.auto_delete and queue.had_consumers and not queue.consumers \
+                and queue.name in self.queues:
+            self.delete_queue(queue.name, queue.exclusive_to)
+
+    def requeue(self, queue, messages):
+        """Put unacknowledged messages back at the head of their queue"""
+        if self.queues.get(queue.name) is not queue:
+            return
+        for message in reversed(messages):
+            queue.messages.appendleft((message, True))
+        self.dispatch(queue)
+
+    def close_connection(self, connection):
+        for name, queue in self.queues.items():
+            if queue.exclusive_to is connection:
+                self.delete_queue(name, connection)
+
+    def stats(self):
+        return dict(self.counts, exchanges=len(self.exchanges),
+                queues=len(self.queues),
+                messages=sum(len(queue.messages) for queue in self.queues.itervalues()))
+
+
+class Channel(object):
+
+    def __init__(self, connection, channel_id):
+        self.connection = connection
+        self.router = connection.router
+        self.id = channel_id
+        # queues, indexed by consumer tag
+        self.consumers = {}
+        # (queue, message), indexed by delivery tag
+        self.unacked = collections.OrderedDict()
+        self.delivery_tags = itertools.count(1)
+        self.prefetch_count = 0
+        self.active = True
+        self.confirm = False
+        self.published = 0
+        self.closing = False
+        # a publish waiting for its content: the method's arguments, the
+        # encoded properties, the body size and the body received so far
+        self.incoming = None
+
+    def can_deliver(self):
+        return self.active and not self.closing and (not self.prefetch_count
+                or len(self.unacked) < self.prefetch_count)
+
+    def send(self, class_id, method_id, *args):
+        self.connection.send(frame(FRAME_METHOD, self.id,
+            encode_method(class_id, method_id, *args)))
+
+    def send_content(self, method_payload, message):
+        """Send a method with content, as a method frame, a header frame and
+        as many body frames as it takes, in one write
+        """
+        frames = [frame(FRAME_METHOD, self.id, method_payload),
+                frame(FRAME_HEADER, self.id, struct.pack('>HHQ', BASIC, 0,
+                    len(message.body)) + message.properties)]
+        chunk = self.connection.frame_max - FRAME_OVERHEAD
+        for start in range(0, len(message.body), chunk):
+            frames.append(frame(FRAME_BODY, self.id, message.body[start:start + chunk]))
+        self.connection.send("".join(frames))
+
+    def deliver(self, queue, tag, message, redelivered, no_ack):
+        delivery_tag = self.delivery_tags.next()
+        if not no_ack:
+            self.unacked[delivery_tag] = (queue, message)
+        self.send_content(encode_method(BASIC, 60, tag, delivery_tag,
+            redelivered, message.exchange, message.routing_key), message)
+
+    def handle(self, method, args):
+        if self.closing and method not in ((CHANNEL, 40), (CHANNEL, 41)):
+            # Everything but close is ignored until the client acknowledges
+            # the channel closing
+            return
+        handler = self.HANDLERS.get(method)
+        if handler is None:
+            raise AMQPError(NOT_IMPLEMENTED, "%s isn't supported" % METHODS[method][0],
+                    method, connection=True)
+        handler(self, *args)
+
+    def open(self, reserved):
+        self.send(CHANNEL, 11, '')
+
+    def flow(self, active):
+        self.active = active
+        self.send(CHANNEL, 21, active)
+        if active:
+            self._dispatch_consumed()
+
+    def flow_ok(self, active):
+        pass
+
+    def close(self, reply_code, reply_text, class_id, method_id):
+        self.release()
+        self.send(CHANNEL, 41)
+        self.connection.channels.pop(self.id, None)
+
+    def close_ok(self):
+        self.connection.channels.pop(self.id, None)
+
+    def fail(self, error):
+        """Close the channel because of an error"""
+        self.release()
+        self.closing = True
+        self.send(CHANNEL, 40, error.code, error.text, error.method[0], error.method[1])
+
+    def release(self):
+        """Requeue unacknowledged messages and cancel every consumer"""
+        for tag, queue in self.consumers.items():
+            self.router.remove_consumer(queue, tag)
+        self.consumers = {}
+        self._requeue(self.unacked.keys())
+
+    def _requeue(self, delivery_tags):
+        by_queue = collections.OrderedDict()
+        for delivery_tag in delivery_tags:
+            queue, message = self.unacked.pop(delivery_tag)
+            by_queue.setdefault(queue, []).append(message)
+        for queue, messages in by_queue.iteritems():
+            self.router.requeue(queue, messages)
+
+    def exchange_declare(self, reserved, name, type, passive, durable,
+            auto_delete, internal, nowait, arguments):
+        self.router.declare_exchange(name, type, passive=passive)
+        if not nowait:
+            self.send(EXCHANGE, 11)
+
+    def exchange_delete(self, reserved, name, if_unused, nowait):
+        self.router.delete_exchange(name)
+        if not nowait:
+            self.send(EXCHANGE, 21)
+
+    def queue_declare(self, reserved, name, passive, durable, exclusive,
+            auto_delete, nowait, arguments):
+        queue = self.router.declare_queue(name, self.connection,
+                passive=passive, exclusive=exclusive, auto_delete=auto_delete)
+        if not nowait:
+            self.send(QUEUE, 11, queue.name, len(queue.messages), len(queue.consumers))
+
+    def queue_bind(self, reserved, queue, exchange, routing_key, nowait, arguments):
+        self.router.bind(queue, exchange, routing_key, self.connection)
+        if not nowait:
+            self.send(QUEUE, 21)
+
+    def queue_unbind(self, reserved, queue, exchange, routing_key, arguments):
+        self.router.unbind(queue, exchange, routing_key, self.connection)
+        self.send(QUEUE, 51)
+
+    def queue_purge(self, reserved, queue, nowait):
+        count = self.router.purge_queue(queue, self.connection)
+        if not nowait:
+            self.send(QUEUE, 31, count)
+
+    def queue_delete(self, reserved, queue, if_unused, if_empty, nowait):
+        count = self.router.delete_queue(queue, self.connection)
+        if not nowait:
+            self.send(QUEUE, 41, count)
+
+    def basic_qos(self, prefetch_size, prefetch_count, global_):
+        self.prefetch_count = prefetch_count
+        self.send(BASIC, 11)
+        self._dispatch_consumed()
+
+    def basic_consume(self, reserved, queue_name, tag, no_local, no_ack,
+            exclusive, nowait, arguments):
+        queue = self.router.get_queue(queue_name, (BASIC, 20), self.connection)
+        if not tag:
+            tag = "amq.ctag-%s" % uuid.uuid4()
+        if tag in self.consumers:
+            raise AMQPError(NOT_ALLOWED, "consumer tag %s is in use" % tag,
+                    (BASIC, 20), connection=True)
+        self.consumers[tag] = queue
+        if not nowait:
+            self.send(BASIC, 21, tag)
+        self.router.add_consumer(queue, self, tag, no_ack)
+
+    def basic_cancel(self, tag, nowait):
+        queue = self.consumers.pop(tag, None)
+        if queue is not None:
+            self.router.remove_consumer(queue, tag)
+        if not nowait:
+            self.send(BASIC, 31, tag)
+
+    def basic_publish(self, reserved, exchange, routing_key, mandatory, immediate):
+        self.incoming = [(exchange, routing_key, mandatory), None, None, []]
+
+    def basic_get(self, reserved, queue_name, no_ack):
+        queue = self.router.get_queue(queue_name, (BASIC, 70), self.connection)
+        if not queue.messages:
+            self.send(BASIC, 72, '')
+            return
+        message, redelivered = queue.messages.popleft()
+        delivery_tag = self.delivery_tags.next()
+        if not no_ack:
+            self.unacked[delivery_tag] = (queue, message)
+        self.send_content(encode_method(BASIC, 71, delivery_tag, redelivered,
+            message.exchange, message.routing_key, len(queue.messages)), message)
+
+    def _settled_tags(self, delivery_tag, multiple):
+        if multiple:
+            return [tag for tag in self.unacked if tag <= delivery_tag or not delivery_tag]
+        if delivery_tag not in self.unacked:
+            raise AMQPError(PRECONDITION_FAILED,
+                    "unknown delivery tag %d" % delivery_tag, (BASIC, 80))
+        return [delivery_tag]
+
+    def basic_ack(self, delivery_tag, multiple):
+        for tag in self._settled_tags(delivery_tag, multiple):
+            del self.unacked[tag]
+        self._dispatch_consumed()
+
+    def basic_nack(self, delivery_tag, multiple, requeue):
+        tags = self._settled_tags(delivery_tag, multiple)
+        if requeue:
+            self._requeue(tags)
+        else:
+            for tag in tags:
+                del self.unacked[tag]
+        self._dispatch_consumed()
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.basic_nack(delivery_tag, False, requeue)
+
+    def basic_recover_async(self, requeue):
+        self._requeue(self.unacked.keys())
+
+    def basic_recover(self, requeue):
+        self._requeue(self.unacked.keys())
+        self.send(BASIC, 111)
+
+    def confirm_select(self, nowait):
+        self.confirm = True
+        if not nowait:
+            self.send(CONFIRM, 11)
+
+    def _dispatch_consumed(self):
+        for queue in set(self.consumers.itervalues()):
+            self.router.dispatch(queue)
+
+    def content_header(self, payload):
+        if self.incoming is None or self.incoming[1] is not None:
+            raise AMQPError(FRAME_ERROR, "unexpected content header",
+                    connection=True)
+        body_size, = struct.unpack_from('>Q', payload, 4)
+        self.incoming[1] = payload[12:]
+        self.incoming[2] = body_size
+        if not body_size:
+            self._published()
+
+    def content_body(self, payload):
+        if self.incoming is None or self.incoming[1] is None:
+            raise AMQPError(FRAME_ERROR, "unexpected content body",
+                    connection=True)
+        self.incoming[3].append(payload)
+        if sum(len(part) for part in self.incoming[3]) >= self.incoming[2]:
+            self._published()
+
+    def _published(self):
+        (exchange, routing_key, mandatory), properties, _, body = self.incoming
+        self.incoming = None
+        message = Message(exchange, routing_key, properties, "".join(body))
+        routed = self.router.publish(exchange, routing_key, message)
+        if not routed and mandatory:
+            self.send_content(encode_method(BASIC, 50, NO_ROUTE, "NO_ROUTE",
+                exchange, routing_key), message)
+        if self.confirm:
+            self.published += 1
+            self.send(BASIC, 80, self.published, False)
+
+    HANDLERS = {
+        (CHANNEL, 10): open,
+        (CHANNEL, 20): flow,
+        (CHANNEL, 21): flow_ok,
+        (CHANNEL, 40): close,
+        (CHANNEL, 41): close_ok,
+        (EXCHANGE, 10): exchange_declare,
+        (EXCHANGE, 20): exchange_delete,
+        (QUEUE, 10): queue_declare,
+        (QUEUE, 20): queue_bind,
+        (QUEUE, 30): queue_purge,
+        (QUEUE, 40): queue_delete,
+        (QUEUE, 50): queue_unbind,
+        (BASIC, 10): basic_qos,
+        (BASIC, 20): basic_consume,
+        (BASIC, 30): basic_cancel,
+        (BASIC, 40): basic_publish,
+        (BASIC, 70): basic_get,
+        (BASIC, 80): basic_ack,
+        (BASIC, 90): basic_reject,
+        (BASIC, 100): basic_recover_async,
+        (BASIC, 110): basic_recover,
+        (BASIC, 120): basic_nack,
+        (CONFIRM, 10): confirm_select,
+    }
+
+
+class Connection(object):
+    """One client's AMQP connection. Frames are read in the connection's
+    own greenlet, and everything sent to the client goes through a queue
+    written by another, so a slow consumer never holds up a publisher.
+    """
+
+    def __init__(self, router, sock, address, heartbeat=0):
+        self.router = router
+        self.sock = sock
+        self.address = address
+        self.heartbeat = heartbeat
+        self.frame_max = FRAME_MAX
+        self.channels = {}
+        self.outbox = gevent.queue.Queue()
+        self._buffer = ""
+        self._closed = False
+
+    def send(self, data):
+        if not self._closed:
+            self.outbox.put(data)
+
+    def _write_loop(self):
+        while True:
+            data = self.outbox.get()
+            chunks = [data]
+            # write everything queued up since the last write in one call
+            while data is not None and not self.outbox.empty():
+                data = self.outbox.get_nowait()
+                chunks.append(data)
+            if chunks[-1] is None:
+                chunks.pop()
+            if chunks:
+                self.sock.sendall("".join(chunks))
+            if data is None:
+                return
+
+    def _heartbeat_loop(self):
+        while True:
+            gevent.sleep(self.heartbeat / 2.0)
+            self.send(frame(FRAME_HEARTBEAT, 0, ""))
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError()
+            self._buffer += data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def serve(self):
+        writer = gevent.spawn(self._write_loop)
+        heartbeater = None
+        try:
+            header = self._read(len(PROTOCOL_HEADER))
+            if header not in PROTOCOL_HEADERS:
+                self.sock.sendall(PROTOCOL_HEADER)
+                return
+            self.send(frame(FRAME_METHOD, 0, encode_method(CONNECTION, 10, 0, 9,
+                {'product': 'epu-harness broker',
+                 'capabilities': {'publisher_confirms': True,
+                                  'basic.nack': True}},
+                'PLAIN AMQPLAIN', 'en_US')))
+            while not self._closed:
+                frame_type, channel_id, size = struct.unpack('>BHI', self._read(7))
+                payload = self._read(size)
+                if self._read(1) != FRAME_END:
+                    raise AMQPError(FRAME_ERROR, "bad frame end", connection=True)
+                if heartbeater is None and self.heartbeat:
+                    heartbeater = gevent.spawn(self._heartbeat_loop)
+                self._handle_frame(frame_type, channel_id, payload)
+        except AMQPError, e:
+            log.warning("Closing connection from %s: %s" % (self.address, e.text))
+            self.send(frame(FRAME_METHOD, 0, encode_method(CONNECTION, 50,
+                e.code, e.text, e.method[0], e.method[1])))
+        except (EOFError, socket.error):
+            pass
+        finally:
+            if heartbeater is not None:
+                heartbeater.kill()
+            self._close()
+            self.outbox.put(None)
+            self._closed = True
+            writer.join(timeout=1)
+            writer.kill()
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
+    def _close(self):
+        for channel in self.channels.values():
+            channel.release()
+        self.channels = {}
+        self.router.close_connection(self)
+
+    def _handle_frame(self, frame_type, channel_id, payload):
+        if frame_type == FRAME_HEARTBEAT:
+            return
+        if frame_type == FRAME_METHOD:
+            method, args = decode_method(payload)
+            if channel_id == 0:
+                self._handle_connection_method(method, args)
+                return
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                if method != (CHANNEL, 10):
+                    raise AMQPError(CHANNEL_ERROR, "channel %d isn't open" % channel_id,
+                            method, connection=True)
+                channel = self.channels[channel_id] = Channel(self, channel_id)
+            try:
+                channel.handle(method, args)
+            except AMQPError, e:
+                if e.connection:
+                    raise
+                channel.fail(e)
+            return
+
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            raise AMQPError(CHANNEL_ERROR, "channel %d isn't open" % channel_id,
+                    connection=True)
+        try:
+            if frame_type == FRAME_HEADER:
+                channel.content_header(payload)
+            elif frame_type == FRAME_BODY:
+                channel.content_body(payload)
+            else:
+                raise AMQPError(FRAME_ERROR, "unknown frame type %d" % frame_type,
+                        connection=True)
+        except AMQPError, e:
+            if e.connection:
+                raise
+            channel.fail(e)
+
+    def _handle_connection_method(self, method, args):
+        if method == (CONNECTION, 11):
+            # Any credentials are accepted
+            self.send(frame(FRAME_METHOD, 0, encode_method(CONNECTION, 30,
+                CHANNEL_MAX, FRAME_MAX, self.heartbeat)))
+        elif method == (CONNECTION, 31):
+            channel_max, frame_max, heartbeat = args
+            if frame_max:
+                self.frame_max = min(frame_max, FRAME_MAX)
+            self.heartbeat = heartbeat
+        elif method == (CONNECTION, 40):
+            self.send(frame(FRAME_METHOD, 0, encode_method(CONNECTION, 41, '')))
+        elif method == (CONNECTION, 50):
+            self._close()
+            self.send(frame(FRAME_METHOD, 0, encode_method(CONNECTION, 51)))
+            self._closed = True
+        elif method == (CONNECTION, 51):
+            self._closed = True
+        else:
+            raise AMQPError(COMMAND_INVALID, "%s isn't allowed on channel 0" %
+                    METHODS[method][0], method, connection=True)
+
+
+class BrokerServer(object):
+    """A lightweight AMQP 0-9-1 broker, for running deployments without
+    RabbitMQ.
+
+    It supports what dashi and kombu need: direct, topic and fanout
+    exchanges, exclusive and auto-delete queues, consumers with prefetch
+    limits, acknowledgements and publisher confirms. Messages are only
+    kept in memory, and only one virtual host is served.
+    """
+
+    name = "epu-harness broker"
+
+    def __init__(self, host=DEFAULT_HOST, port=5672, heartbeat=0):
+        """
+        @param host: the address to listen on
+        @param port: the port to listen on
+        @param heartbeat: seconds between heartbeats offered to clients, or 0
+        """
+        self.router = Router()
+        self.heartbeat = heartbeat
+        self.connections = set()
+        self.server = StreamServer((host, port), self._handle)
+
+    @property
+    def address(self):
+        return self.server.address
+
+    def start(self):
+        self.server.start()
+        log.info("%s listening on %s:%s" % (self.name, self.address[0],
+            self.address[1]))
+
+    def serve_forever(self):
+        self.start()
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.stop()
+        log.info("%s stopped. %s" % (self.name, self.router.stats()))
+
+    def _handle(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(self.router, sock, address, heartbeat=self.heartbeat)
+        self.connections.add(connection)
+        try:
+            connection.serve()
+        finally:
+            self.connections.discard(connection)
+
+
+def main(argv=None):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+    if not argv:
+        argv = list(sys.argv)
+    if len(argv) != 2:
+        print >>sys.stderr, "usage: %s CONFIG_FILE" % argv[0]
+        return 1
+
+    CFG = bootstrap.configure([argv[1]])
+    config = CFG.broker
+    server = BrokerServer(host=config.get('host', DEFAULT_HOST), port=config.port,
+            heartbeat=config.get('heartbeat', 0))
+    gevent.signal(signal.SIGTERM, server.stop)
+    server.serve_forever()
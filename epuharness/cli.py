@@ -1,6 +1,8 @@
 import gevent.monkey ; gevent.monkey.patch_all()
+import gevent
 import os
 import sys
+import json
 import logging
 try:
     import argparse
@@ -9,13 +11,93 @@ except ImportError:
     print "Couldn't import argparse. Use Python 2.7"
 
 
-from harness import EPUHarness
+from pidantic.state_machine import PIDanticState
+from harness import EPUHarness, format_status, watch_status
+from monitor import format_stats
+from logs import parse_timestamp
+from daemon import HarnessDaemon, HarnessClient
+from registry import HarnessRegistry, format_entries
 from exceptions import HarnessException
 
 log = logging.getLogger(__name__)
 
 ERROR_RETURN = 1
 
+
+def report_timings(epuharness, args):
+    if args.timings:
+        print epuharness.timings.format_summary()
+    if args.timings_file:
+        epuharness.timings.dump(args.timings_file)
+
+
+def watch(epuharness, args):
+    try:
+        for change in watch_status(epuharness.status_report,
+                services=args.extras, interval=args.interval):
+            if args.json:
+                print json.dumps(change)
+            else:
+                print format_status(change)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
+def top(epuharness, args):
+    try:
+        while True:
+            stats = epuharness.resource_stats(services=args.extras,
+                    interval=args.interval)
+            if args.json:
+                print json.dumps(stats)
+            else:
+                # clear the screen, like top
+                print "\x1b[2J\x1b[H" + format_stats(stats)
+            sys.stdout.flush()
+            gevent.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    timestamp = parse_timestamp(value)
+    if timestamp is None:
+        timestamp = float(value)
+    return timestamp
+
+
+def search_logs(epuharness, args):
+    ids = {}
+    for id_arg in args.id:
+        name, _, value = id_arg.partition('=')
+        ids[name] = value
+    results = epuharness.search_logs(services=args.extras[1:],
+            levels=args.level, start=parse_time(args.since),
+            end=parse_time(args.until), text=args.grep, ids=ids,
+            limit=args.limit)
+    for timestamp, source, line in results:
+        print "%s | %s" % (source, line)
+
+
+def print_logs(epuharness, args):
+    if args.extras and args.extras[0] == 'search':
+        return search_logs(epuharness, args)
+    if args.follow:
+        entries = epuharness.follow_logs(services=args.extras,
+                interval=args.interval)
+    else:
+        entries = epuharness.read_logs(services=args.extras)
+    try:
+        for timestamp, source, line in entries:
+            print "%s | %s" % (source, line)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+
+
 def main(argv=None):
 
 
@@ -24,21 +106,79 @@ def main(argv=None):
     command = argv.pop(0)
 
     parser = argparse.ArgumentParser("Start EPU Services Locally")
-    parser.add_argument('-f', '--force', action='store_true')
+    parser.add_argument('-f', '--force', action='store_true',
+            help='with stop, ignore programs that can not be killed')
+    parser.add_argument('--follow', action='store_true',
+            help='with logs, follow them as they grow')
     parser.add_argument('-c', '--config', metavar='CONFIG_FILE', default=None)
     parser.add_argument('-x', '--exchange', metavar='EXCHANGE_NAME',
             default=None)
     parser.add_argument('-s', '--sysname', metavar='SYSNAME',
             default=None)
-    parser.add_argument('action', metavar='ACTION', help='start or stop')
-    parser.add_argument('extras', help='deployment config file for start, or services to stop',
+    parser.add_argument('-n', '--namespace', metavar='NAMESPACE', default=None,
+            help="keep this harness's programs, logs and exchange apart from "
+            "other harnesses on the host. 'auto' picks a unique one")
+    parser.add_argument('-b', '--local-broker', action='store_true', default=None,
+            help='with start, run a local AMQP broker instead of using RabbitMQ')
+    parser.add_argument('-t', '--timings', action='store_true',
+            help='print how long each phase took')
+    parser.add_argument('--timings-file', metavar='TRACE_FILE', default=None,
+            help='write phase timings to a Chrome trace JSON file')
+    parser.add_argument('--json', action='store_true',
+            help='print status as JSON, one object per program')
+    parser.add_argument('-w', '--watch', action='store_true',
+            help='keep printing status changes until interrupted')
+    parser.add_argument('--interval', type=float, default=1.0,
+            help='seconds between polls for status --watch, top and logs --follow')
+    parser.add_argument('--level', action='append', default=[],
+            help='with logs search, match lines at this level. Can be repeated')
+    parser.add_argument('--since', metavar='TIME', default=None,
+            help="with logs search, match lines logged at or after TIME, "
+            "like '2012-05-01 16:20:01' or seconds since the epoch")
+    parser.add_argument('--until', metavar='TIME', default=None,
+            help='with logs search, match lines logged at or before TIME')
+    parser.add_argument('--grep', metavar='TEXT', default=None,
+            help='with logs search, match lines containing TEXT')
+    parser.add_argument('--id', metavar='NAME=VALUE', action='append', default=[],
+            help='with logs search, match lines mentioning a correlation id, '
+            'like upid=abc or node_id=xyz')
+    parser.add_argument('--limit', type=int, default=None,
+            help='with logs search, print at most this many lines')
+    parser.add_argument('-d', '--daemon-socket', metavar='SOCKET',
+            default=os.environ.get('EPUHARNESS_DAEMON_SOCKET'),
+            help='run the action in the epu-harness daemon listening on SOCKET')
+    parser.add_argument('action', metavar='ACTION', help='start, apply, stop, restart, reset, status, top, logs, list or daemon')
+    parser.add_argument('extras', help='deployment config file for start or apply, '
+            'or services to stop, restart or get the status of. Services can be '
+            'selected by name, or with conditions like type=eeagent or node=nodeone',
             default=[], nargs='*')
     args = parser.parse_args(argv)
 
-    epuharness = EPUHarness(exchange=args.exchange, config=args.config, sysname=args.sysname)
-
     action = args.action.lower()
-    if action == 'start':
+    if action == 'list':
+        entries = HarnessRegistry().entries()
+        if args.json:
+            print json.dumps(entries, indent=2)
+        else:
+            print format_entries(entries)
+        return
+    elif action == 'daemon':
+        epuharness = EPUHarness(exchange=args.exchange, config=args.config, sysname=args.sysname,
+                local_broker=args.local_broker, namespace=args.namespace)
+        daemon = HarnessDaemon(epuharness, socket_path=args.daemon_socket)
+        try:
+            daemon.serve_forever()
+        except HarnessException, e:
+            log.error("Problem running daemon: %s" % e.message)
+            sys.exit(ERROR_RETURN)
+        return
+    elif args.daemon_socket:
+        epuharness = HarnessClient(args.daemon_socket)
+    else:
+        epuharness = EPUHarness(exchange=args.exchange, config=args.config, sysname=args.sysname,
+                local_broker=args.local_broker, namespace=args.namespace)
+
+    if action in ('start', 'apply'):
         configs = args.extras
         if len(configs) > 0:
             config = configs[0]
@@ -52,10 +192,19 @@ def main(argv=None):
             deployment_file = None
 
         try:
-            epuharness.start(deployment_file)
+            if action == 'apply':
+                changes = epuharness.apply(deployment_file)
+                for change in ('started', 'restarted', 'stopped', 'announced', 'removed_nodes'):
+                    if changes[change]:
+                        log.info("%s: %s" % (change.replace('_', ' ').capitalize(),
+                            ", ".join(changes[change])))
+            else:
+                epuharness.start(deployment_file)
         except HarnessException, e:
             log.error("Problem starting services: %s" % e.message)
             sys.exit(ERROR_RETURN)
+        finally:
+            report_timings(epuharness, args)
     elif action == 'stop':
         services = getattr(args, 'extras')
         force = args.force
@@ -64,12 +213,56 @@ def main(argv=None):
         except HarnessException, e:
             log.error("Problem stopping services: %s" % e.message)
             sys.exit(ERROR_RETURN)
+        finally:
+            report_timings(epuharness, args)
+    elif action == 'restart':
+        try:
+            epuharness.restart(args.extras)
+        except HarnessException, e:
+            log.error("Problem restarting services: %s" % e.message)
+            sys.exit(ERROR_RETURN)
+        finally:
+            report_timings(epuharness, args)
+    elif action == 'reset':
+        try:
+            epuharness.reset()
+        except HarnessException, e:
+            log.error("Problem resetting services: %s" % e.message)
+            sys.exit(ERROR_RETURN)
+        finally:
+            report_timings(epuharness, args)
     elif action == 'status':
         try:
-            epuharness.status()
+            if args.watch:
+                watch(epuharness, args)
+            elif args.json:
+                report = epuharness.status_report(services=args.extras)
+                print json.dumps(report, indent=2)
+                running = all(row['state'] == PIDanticState.STATE_RUNNING for row in report)
+                sys.exit(0 if running else ERROR_RETURN)
+            else:
+                epuharness.status(services=args.extras)
         except HarnessException, e:
             log.error("Problem getting status: %s" % e.message)
             sys.exit(ERROR_RETURN)
+    elif action == 'logs':
+        try:
+            print_logs(epuharness, args)
+        except HarnessException, e:
+            log.error("Problem reading logs: %s" % e.message)
+            sys.exit(ERROR_RETURN)
+    elif action == 'top':
+        try:
+            top(epuharness, args)
+        except HarnessException, e:
+            log.error("Problem monitoring services: %s" % e.message)
+            sys.exit(ERROR_RETURN)
+    elif action == 'shutdown' and args.daemon_socket:
+        try:
+            epuharness.shutdown()
+        except HarnessException, e:
+            log.error("Problem shutting down daemon: %s" % e.message)
+            sys.exit(ERROR_RETURN)
     else:
         usage()
         sys.exit(ERROR_RETURN)
@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import socket
+import logging
+import gevent
+import gevent.coros
+
+from functools import partial
+from gevent.server import StreamServer
+from pidantic.state_machine import PIDanticState
+
+from logs import LogStream, DEFAULT_LOG_INTERVAL
+from timing import Timings
+from exceptions import HarnessException, DeploymentDescriptionError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/tmp/epuharness.sock"
+
+
+def get_socket_path(socket_path=None):
+    return (socket_path or os.environ.get('EPUHARNESS_DAEMON_SOCKET') or
+            DEFAULT_SOCKET)
+
+
+class SocketServer(object):
+    """Serves a dictionary of actions over a local Unix socket. Requests are
+    handled one at a time.
+
+    The protocol is one JSON object per line in each direction. Requests
+    look like {"action": "start", "kwargs": {...}}, and responses like
+    {"result": ...} or {"error": "message"}.
+    """
+
+    name = "server"
+
+    def __init__(self, socket_path, actions):
+        self.socket_path = socket_path
+        self.actions = actions
+        self.server = None
+        self._lock = gevent.coros.Semaphore()
+
+    def serve_forever(self):
+        self._remove_stale_socket()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(50)
+
+        self.server = StreamServer(listener, self._handle)
+        log.info("%s listening on %s" % (self.name, self.socket_path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self._cleanup()
+
+    def stop(self):
+        if self.server:
+            self.server.stop()
+
+    def _shutdown(self):
+        gevent.spawn_later(0, self.stop)
+        return True
+
+    def _cleanup(self):
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+
+        try:
+            SocketClient(self.socket_path).ping()
+        except HarnessException:
+            raise
+        except Exception:
+            log.debug("Removing stale socket %s", self.socket_path)
+            os.remove(self.socket_path)
+        else:
+            msg = "An %s is already listening on %s" % (self.name,
+                self.socket_path)
+            raise HarnessException(msg)
+
+    def _handle(self, sock, address):
+        sock_file = sock.makefile()
+        try:
+            for line in sock_file:
+                if not line.strip():
+                    continue
+                response = self._dispatch(line)
+                sock_file.write(json.dumps(response) + "\n")
+                sock_file.flush()
+        finally:
+            sock_file.close()
+            sock.close()
+
+    def _dispatch(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'error': "Couldn't parse request"}
+
+        action = request.get('action')
+        handler = self.actions.get(action)
+        if handler is None:
+            return {'error': "Unknown action '%s'" % action}
+
+        kwargs = dict((str(key), value) for key, value in
+                (request.get('kwargs') or {}).iteritems())
+        with self._lock:
+            try:
+                return {'result': handler(**kwargs)}
+            except (HarnessException, DeploymentDescriptionError), e:
+                return {'error': str(e)}
+            except Exception, e:
+                log.exception("Problem handling '%s'" % action)
+                return {'error': "%s: %s" % (type(e).__name__, e)}
+
+
+class SocketClient(object):
+    """Calls the actions of a SocketServer
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._sock = None
+        self._sock_file = None
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.socket_path)
+            self._sock_file = self._sock.makefile()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock_file.close()
+            self._sock.close()
+            self._sock = None
+            self._sock_file = None
+
+    def call(self, action, **kwargs):
+        self._connect()
+        self._sock_file.write(json.dumps({'action': action, 'kwargs': kwargs}) + "\n")
+        self._sock_file.flush()
+        line = self._sock_file.readline()
+        if not line:
+            self.close()
+            raise HarnessException("%s closed the connection" % self.socket_path)
+
+        response = json.loads(line)
+        if response.get('error'):
+            raise HarnessException(response['error'])
+        return response.get('result')
+
+    def ping(self):
+        return self.call('ping')
+
+
+class HarnessDaemon(SocketServer):
+    """Serves an EPUHarness over a local Unix socket.
+
+    The harness, its dashi connection and its supervisord factory are kept
+    between requests, so clients don't pay to set them up on each call.
+    """
+
+    name = "epu-harness daemon"
+
+    def __init__(self, harness, socket_path=None):
+        self.harness = harness
+        SocketServer.__init__(self, get_socket_path(socket_path), {
+            'ping': lambda: 'pong',
+            'start': self._start,
+            'apply': self._apply,
+            'stop': self._stop,
+            'restart': self._restart,
+            'reset': self._reset,
+            'status': self._status,
+            'status_report': self._status_report,
+            'resource_stats': self._resource_stats,
+            'logfiles': self._logfiles,
+            'search_logs': self._search_logs,
+            'dashi_stats': self._dashi_stats,
+            'timings': lambda: self.harness.timings.events,
+            'shutdown': self._shutdown,
+        })
+
+    def _start(self, **kwargs):
+        return self.harness.start(**kwargs)
+
+    def _apply(self, **kwargs):
+        return self.harness.apply(**kwargs)
+
+    def _stop(self, **kwargs):
+        kwargs['disconnect'] = False
+        return self.harness.stop(**kwargs)
+
+    def _restart(self, **kwargs):
+        return self.harness.restart(**kwargs)
+
+    def _reset(self, **kwargs):
+        return self.harness.reset(**kwargs)
+
+    def _status(self, **kwargs):
+        kwargs['exit'] = False
+        status = self.harness.status(**kwargs)
+        return_code = 0
+        for name, state in status:
+            if state != PIDanticState.STATE_RUNNING:
+                return_code = 1
+        return {'instances': status, 'return_code': return_code}
+
+    def _status_report(self, **kwargs):
+        return self.harness.status_report(**kwargs)
+
+    def _resource_stats(self, **kwargs):
+        return self.harness.resource_stats(**kwargs)
+
+    def _logfiles(self, **kwargs):
+        self.harness._load_manifest()
+        return self.harness.get_logfiles(**kwargs)
+
+    def _search_logs(self, **kwargs):
+        return self.harness.search_logs(**kwargs)
+
+    def _dashi_stats(self, **kwargs):
+        return self.harness.dashi_stats(**kwargs)
+
+    def _cleanup(self):
+        SocketServer._cleanup(self)
+        try:
+            self.harness.dashi.cancel()
+            self.harness.dashi.disconnect()
+        except Exception:
+            log.debug("Problem disconnecting dashi", exc_info=True)
+
+
+class HarnessClient(SocketClient):
+    """Talks to a HarnessDaemon. Has the same start, apply, stop, restart and
+    status methods as EPUHarness, so it can be used in its place.
+    """
+
+    def __init__(self, socket_path=None):
+        SocketClient.__init__(self, get_socket_path(socket_path))
+
+    def start(self, deployment_file=None, deployment_str=None, **kwargs):
+        if deployment_file:
+            deployment_file = os.path.abspath(deployment_file)
+        return self.call('start', deployment_file=deployment_file,
+                deployment_str=deployment_str, **kwargs)
+
+    def apply(self, deployment_file=None, deployment_str=None, **kwargs):
+        if deployment_file:
+            deployment_file = os.path.abspath(deployment_file)
+        return self.call('apply', deployment_file=deployment_file,
+                deployment_str=deployment_str, **kwargs)
+
+    def stop(self, **kwargs):
+        return self.call('stop', **kwargs)
+
+    def restart(self, services, **kwargs):
+        return self.call('restart', services=services, **kwargs)
+
+    def reset(self, **kwargs):
+        return self.call('reset', **kwargs)
+
+    def status(self, exit=True, **kwargs):
+        status = self.call('status', **kwargs)
+        for name, state in status['instances']:
+            log.info("%s is %s" % (name, state))
+        if exit:
+            sys.exit(status['return_code'])
+        else:
+            return status['instances']
+
+    def status_report(self, services=None):
+        return self.call('status_report', services=services)
+
+    def resource_stats(self, services=None, interval=None):
+        return self.call('resource_stats', services=services, interval=interval)
+
+    def get_logfiles(self, services=None):
+        return self.call('logfiles', services=services)
+
+    def search_logs(self, services=None, **query):
+        return self.call('search_logs', services=services, **query)
+
+    def dashi_stats(self, operations=None):
+        return self.call('dashi_stats', operations=operations)
+
+    def read_logs(self, services=None):
+        return LogStream(partial(self.get_logfiles, services=services)).poll()
+
+    def follow_logs(self, services=None, from_start=True, interval=DEFAULT_LOG_INTERVAL):
+        stream = LogStream(partial(self.get_logfiles, services=services),
+                from_start=from_start)
+        return stream.follow(interval=interval)
+
+    @property
+    def timings(self):
+        timings = Timings()
+        timings.events = self.call('timings')
+        return timings
+
+    def shutdown(self):
+        result = self.call('shutdown')
+        self.close()
+        return result
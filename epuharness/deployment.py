@@ -1,6 +1,15 @@
 import yaml
+import hashlib
+import collections
+
+# libyaml's loader is many times faster, when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 from exceptions import *
+from schema import validate_deployment
 
 DEFAULT_DEPLOYMENT = """---
 process-dispatchers:
@@ -19,7 +28,7 @@ nodes:
     eeagents:
       eeagent_nodeone:
         launch_type: supd
-        logfile: /tmp/eeagent_nodeone.log
+        logfile: eeagent_nodeone.log
 provisioners:
   provisioner_0:
     config:
@@ -34,25 +43,395 @@ epums:
       epumanagement:
         default_user: default
         provisioner_topic: provisioner_0
-      logging:
-        handlers:
-          file:
-            filename: /tmp/epum_0.log
 """
 
 
+# Each section of a deployment, and the type of service it defines
+SECTION_TYPES = collections.OrderedDict([
+    ('mock-clouds', 'mock-cloud'),
+    ('provisioners', 'provisioner'),
+    ('dt_registries', 'dtrs'),
+    ('epums', 'epum'),
+    ('process-dispatchers', 'process-dispatcher'),
+    ('nodes', 'node'),
+    ('pyon-process-dispatchers', 'pyon-process-dispatcher'),
+    ('pyon-http-gateways', 'pyon-http-gateway'),
+    ('pyon-nodes', 'pyon-node'),
+    ('phantom-instances', 'phantom'),
+])
+
+# How many compiled plans to keep
+PLAN_CACHE_SIZE = 32
+
+# Keys of service templates which aren't part of the services' specs
+TEMPLATE_KEYS = ('template', 'count', 'start')
+NODE_TEMPLATE_KEYS = ('eeagents_per_node', 'eeagent')
+DEFAULT_EEAGENT_TEMPLATE = "eeagent_{node}_{j}"
+
+# One service defined by a deployment. spec is its section of the
+# deployment, and node is the node an eeagent belongs to
+ServiceSpec = collections.namedtuple('ServiceSpec', ['name', 'type', 'section',
+    'spec', 'node'])
+
+_plans = collections.OrderedDict()
+
+
 def parse_deployment(yaml_path=None, yaml_str=None):
     if yaml_path and yaml_str:
-        ProgrammingError("Cannot handle both a yaml file and a yaml string")
+        raise ProgrammingError("Cannot handle both a yaml file and a yaml string")
     elif not yaml_path and not yaml_str:
         msg = "Please provide a path to a yaml file or a yaml string to parse"
-        ProgrammingError(msg)
+        raise ProgrammingError(msg)
 
     parsed_yaml = None
     if yaml_path:
         with open(yaml_path) as yaml_file:
-            parsed_yaml = yaml.load(yaml_file)
+            parsed_yaml = yaml.load(yaml_file, Loader=SafeLoader)
     else:
-        parsed_yaml = yaml.load(yaml_str)
+        parsed_yaml = yaml.load(yaml_str, Loader=SafeLoader)
 
     return parsed_yaml
+
+
+def compile_deployment(yaml_path=None, yaml_str=None):
+    """Parse and validate a deployment into a DeploymentPlan
+
+    Plans are cached by the digest of the document, so compiling the same
+    deployment again, from a file or a string, doesn't parse it again.
+    """
+    if yaml_path and yaml_str:
+        raise ProgrammingError("Cannot handle both a yaml file and a yaml string")
+    elif not yaml_path and not yaml_str:
+        msg = "Please provide a path to a yaml file or a yaml string to parse"
+        raise ProgrammingError(msg)
+
+    if yaml_path:
+        with open(yaml_path) as yaml_file:
+            yaml_str = yaml_file.read()
+
+    if isinstance(yaml_str, unicode):
+        digest = hashlib.sha1(yaml_str.encode('utf-8')).hexdigest()
+    else:
+        digest = hashlib.sha1(yaml_str).hexdigest()
+    plan = _plans.pop(digest, None)
+    if plan is None:
+        plan = DeploymentPlan(parse_deployment(yaml_str=yaml_str), digest=digest)
+    _plans[digest] = plan
+    while len(_plans) > PLAN_CACHE_SIZE:
+        _plans.popitem(last=False)
+    return plan
+
+
+def expand_templates(deployment):
+    """Expand service templates in a deployment
+
+    A section may be a template rather than a mapping of service names, or
+    a list of templates and mappings. A template names its services with
+    'template', a pattern like 'node_{i}', and makes 'count' of them,
+    numbered from 'start' (0 by default). Its other keys are the spec of
+    every service it makes, where {i} in strings is replaced by the index,
+    and {cycle: [a, b]} takes the values in turn. For example:
+
+        nodes:
+          template: node_{i}
+          count: 200
+          process-dispatcher: {cycle: [pd_0, pd_1]}
+          eeagents_per_node: 4
+          eeagent:
+            launch_type: fork
+
+    Node templates make 'eeagents_per_node' eeagents per node from the
+    'eeagent' spec, named 'eeagent_{node}_{j}' unless it has a template of
+    its own.
+
+    Templates are expanded eagerly, when a plan is compiled, into a plain
+    mapping of every service, because validation and planning look at each
+    service anyway. Expansion takes time and memory in proportion to the
+    number of services made. Specs without anything to replace are shared
+    rather than copied.
+
+    @return: the deployment with every template expanded. It is the same
+             object if there were no templates
+    """
+    if not isinstance(deployment, dict):
+        return deployment
+
+    expanded = None
+    for section, services in deployment.iteritems():
+        if not _is_template(services) and not isinstance(services, list):
+            continue
+        if expanded is None:
+            expanded = dict(deployment)
+
+        if not isinstance(services, list):
+            services = [services]
+        expanded[section] = {}
+        for services_or_template in services:
+            if _is_template(services_or_template):
+                generated = _expand_template(section, services_or_template)
+            elif isinstance(services_or_template, dict):
+                generated = services_or_template.iteritems()
+            else:
+                msg = "Section '%s' should list templates or mappings of services" % section
+                raise DeploymentDescriptionError(msg)
+
+            for name, spec in generated:
+                if name in expanded[section]:
+                    msg = "Service name '%s' in '%s' is made more than once" % (name, section)
+                    raise DeploymentDescriptionError(msg)
+                expanded[section][name] = spec
+
+    if expanded is None:
+        return deployment
+    return expanded
+
+
+def _is_template(value):
+    return isinstance(value, dict) and 'template' in value
+
+
+def _template_range(section, template):
+    count = template.get('count')
+    start = template.get('start', 0)
+    for key, value in (('count', count), ('start', start)):
+        if not isinstance(value, (int, long)) or isinstance(value, bool) or value < 0:
+            msg = "Template '%s' in '%s' needs a '%s' that is a whole number, not %r" % (
+                template.get('template'), section, key, value)
+            raise DeploymentDescriptionError(msg)
+    return xrange(start, start + count)
+
+
+def _expand_template(section, template):
+    """Yield (name, spec) for each service a template makes
+    """
+    reserved = TEMPLATE_KEYS
+    if section in ('nodes', 'pyon-nodes'):
+        reserved += NODE_TEMPLATE_KEYS
+    spec = dict((key, value) for key, value in template.iteritems()
+            if key not in reserved)
+
+    eeagents_per_node = template.get('eeagents_per_node')
+    eeagent = dict(template.get('eeagent') or {})
+    eeagent_template = eeagent.pop('template', DEFAULT_EEAGENT_TEMPLATE)
+    if eeagents_per_node is not None and (not isinstance(eeagents_per_node, (int, long))
+            or eeagents_per_node < 0):
+        msg = "Template '%s' in '%s' needs an 'eeagents_per_node' that is a whole number" % (
+            template['template'], section)
+        raise DeploymentDescriptionError(msg)
+
+    for i in _template_range(section, template):
+        name = _substitute(template['template'], {'i': i}, i)
+        service = _substitute(spec, {'i': i}, i)
+        if eeagents_per_node:
+            service = dict(service)
+            eeagents = dict(service.get('eeagents') or {})
+            for j in xrange(eeagents_per_node):
+                substitutions = {'i': i, 'j': j, 'node': name}
+                eeagent_name = _substitute(eeagent_template, substitutions, j)
+                eeagents[eeagent_name] = _substitute(eeagent, substitutions, j)
+            service['eeagents'] = eeagents
+        yield name, service
+
+
+def _substitute(value, substitutions, index):
+    """Replace {names} in the strings of value, and pick from cycles by
+    index. Values with nothing to replace are returned as they are.
+    """
+    if isinstance(value, basestring):
+        if '{' not in value:
+            return value
+        try:
+            return value.format(**substitutions)
+        except (KeyError, IndexError, ValueError), e:
+            msg = "Can't fill in '%s' in a template: %s" % (value, e)
+            raise DeploymentDescriptionError(msg)
+
+    elif isinstance(value, dict):
+        if value.keys() == ['cycle'] and isinstance(value['cycle'], list) and value['cycle']:
+            return _substitute(value['cycle'][index % len(value['cycle'])],
+                    substitutions, index)
+        substituted = {}
+        changed = False
+        for key, item in value.iteritems():
+            new_key = _substitute(key, substitutions, index)
+            new_item = _substitute(item, substitutions, index)
+            changed = changed or new_key is not key or new_item is not item
+            substituted[new_key] = new_item
+        if changed:
+            return substituted
+        return value
+
+    elif isinstance(value, list):
+        substituted = [_substitute(item, substitutions, index) for item in value]
+        if any(new is not old for new, old in zip(substituted, value)):
+            return substituted
+        return value
+
+    return value
+
+
+def clear_plan_cache():
+    """Forget every compiled plan"""
+    _plans.clear()
+
+
+class DeploymentPlan(object):
+    """A validated deployment, with a spec for every service it defines and
+    the order they can be started in.
+
+    Plans are shared between everything that compiles the same document, so
+    they must not be modified. They can be read like the deployment
+    dictionary they were made from, and every section is always present.
+    """
+
+    def __init__(self, deployment, digest=None):
+        """
+        @param deployment: a parsed deployment dictionary
+        @param digest: a digest of the document it was parsed from
+        """
+        if deployment is None:
+            deployment = {}
+        deployment = expand_templates(deployment)
+        validate_deployment(deployment)
+
+        self.deployment = dict(deployment)
+        for section in SECTION_TYPES:
+            services = self.deployment.get(section) or {}
+            # A service with nothing to configure may be left empty
+            self.deployment[section] = dict((name, spec if spec is not None else {})
+                    for name, spec in services.iteritems())
+
+        if digest is None:
+            digest = hashlib.sha1(yaml.dump(self.deployment)).hexdigest()
+        self.digest = digest
+
+        self.services = self._service_specs()
+        self.dependencies = get_service_dependencies(self.deployment)
+        self.waves = get_startup_waves(self.dependencies)
+
+    def _service_specs(self):
+        services = collections.OrderedDict()
+        for section, service_type in SECTION_TYPES.iteritems():
+            for name, spec in sorted(self.deployment[section].iteritems()):
+                services[name] = ServiceSpec(name, service_type, section, spec, None)
+                if section not in ('nodes', 'pyon-nodes'):
+                    continue
+
+                eeagent_type = 'eeagent' if section == 'nodes' else 'pyon-eeagent'
+                for eeagent_name, eeagent in sorted((spec.get('eeagents') or {}).iteritems()):
+                    services[eeagent_name] = ServiceSpec(eeagent_name, eeagent_type,
+                            section, eeagent, name)
+        return services
+
+    def services_of_type(self, service_type):
+        """Returns the specs of every service of a type, in name order"""
+        return [service for service in self.services.itervalues()
+                if service.type == service_type]
+
+    def get(self, section, default=None):
+        return self.deployment.get(section, default)
+
+    def __getitem__(self, section):
+        return self.deployment[section]
+
+    def __contains__(self, section):
+        return section in self.deployment
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, DeploymentPlan) and self.digest == other.digest
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<DeploymentPlan %s: %d services>" % (self.digest[:8], len(self.services))
+
+
+def get_service_dependencies(deployment):
+    """Returns a dictionary mapping the name of each service in a deployment
+    to the set of services in the same deployment it must wait for.
+
+    References to services that aren't part of the deployment (for example
+    a provisioner started elsewhere) are ignored.
+    """
+
+    dependencies = {}
+
+    def add_service(name, section):
+        if name in dependencies:
+            msg = "Service name '%s' in '%s' is already used in this deployment" % (
+                name, section)
+            raise DeploymentDescriptionError(msg)
+        dependencies[name] = set()
+
+    for section in ('mock-clouds', 'provisioners', 'dt_registries', 'epums',
+            'process-dispatchers', 'pyon-process-dispatchers',
+            'pyon-http-gateways', 'phantom-instances'):
+        for name in deployment.get(section, {}):
+            add_service(name, section)
+
+    for section in ('nodes', 'pyon-nodes'):
+        for node_name, node in deployment.get(section, {}).iteritems():
+            add_service(node_name, section)
+            for eeagent_name in (node.get('eeagents') or {}):
+                add_service(eeagent_name, section)
+
+    def depend(name, on):
+        if on and on in dependencies and on != name:
+            dependencies[name].add(on)
+
+    for name, provisioner in deployment.get('provisioners', {}).iteritems():
+        config = provisioner.get('config', {})
+        depend(name, config.get('provisioner', {}).get('dtrs_service_name'))
+        for site in (config.get('sites') or {}).itervalues():
+            if isinstance(site, dict):
+                depend(name, site.get('mock_cloud'))
+
+    for name, epum in deployment.get('epums', {}).iteritems():
+        config = epum.get('config', {})
+        depend(name, config.get('epumanagement', {}).get('provisioner_topic'))
+
+    for section in ('nodes', 'pyon-nodes'):
+        for node_name, node in deployment.get(section, {}).iteritems():
+            depend(node_name, node.get('process-dispatcher'))
+            for eeagent_name, eeagent in (node.get('eeagents') or {}).iteritems():
+                dispatcher = eeagent.get('process-dispatcher') or \
+                    node.get('process-dispatcher')
+                depend(eeagent_name, dispatcher)
+
+    # Phantom is a frontend to the EPUMs and DTRSes, so start it last
+    for name in deployment.get('phantom-instances', {}):
+        for epum_name in deployment.get('epums', {}):
+            depend(name, epum_name)
+        for dtrs_name in deployment.get('dt_registries', {}):
+            depend(name, dtrs_name)
+
+    return dependencies
+
+
+def get_startup_waves(dependencies):
+    """Groups services into waves that can be started concurrently.
+
+    Every service in a wave depends only on services in earlier waves.
+
+    @param dependencies: a dictionary as returned by get_service_dependencies
+    """
+
+    remaining = dict((name, set(deps)) for name, deps in dependencies.iteritems())
+    waves = []
+    while remaining:
+        wave = sorted(name for name, deps in remaining.iteritems() if not deps)
+        if not wave:
+            msg = "Deployment has a dependency cycle between %s" % (
+                ", ".join(sorted(remaining)))
+            raise DeploymentDescriptionError(msg)
+        for name in wave:
+            del remaining[name]
+        for deps in remaining.itervalues():
+            deps.difference_update(wave)
+        waves.append(wave)
+
+    return waves
@@ -1,6 +1,5 @@
 import os
 import tempfile
-from socket import timeout
 import logging
 
 from epu.dashiproc.processdispatcher import ProcessDispatcherClient
@@ -9,8 +8,13 @@ from epu.dashiproc.provisioner import ProvisionerClient
 from epu.dashiproc.epumanagement import EPUManagementClient
 from eeagent.client import EEAgentClient
 
-from epuharness.deployment import parse_deployment
+from epuharness.deployment import compile_deployment
+from epuharness.mockcloud import MockCloudNodeDriver, DRIVER_CLASS
 from epuharness.harness import EPUHarness
+from epuharness.daemon import HarnessClient
+from epuharness.pool import get_pool
+from epuharness.readiness import check_readiness
+from epuharness.rpcstats import RPCStats, instrument
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +25,8 @@ class TestFixture(object):
     epuharness = None
     libcloud_drivers = None
     dashi = None
+    rpc_stats = None
+    harness_pool = None
 
     def setup_harness(self, *args, **kwargs):
 
@@ -30,8 +36,37 @@ class TestFixture(object):
 
         self.dashi = self.epuharness.dashi
 
+    def setup_harness_client(self, socket_path=None):
+        """Use a running epu-harness daemon instead of starting a harness in
+        this process. The daemon's harness is already connected, so start,
+        stop and status return without any setup cost.
+
+        Tests still need their own dashi connection to talk to services.
+        """
+        self.epuharness = HarnessClient(socket_path)
+        self.epuharness.ping()
+
+    def checkout_harness(self, deployment_str=None, deployment_file=None,
+            pool=None, ready_timeout=None):
+        """Use a running harness from a pool instead of starting one. A
+        harness that an earlier test used with the same deployment is reset,
+        rather than stopped and started again. teardown_harness gives it
+        back to the pool.
+
+        @param pool: a HarnessPool. Defaults to the process's pool
+        """
+        self.harness_pool = pool or get_pool()
+        self.epuharness = self.harness_pool.checkout(deployment_str=deployment_str,
+                deployment_file=deployment_file, ready_timeout=ready_timeout)
+        self.dashi = self.epuharness.dashi
+        return self.epuharness
+
     def teardown_harness(self, remove_dir=True):
-        if self.epuharness:
+        if self.epuharness and self.harness_pool:
+            self.harness_pool.checkin(self.epuharness)
+            self.harness_pool = None
+            self.epuharness = None
+        elif self.epuharness:
             try:
                 self.epuharness.stop(remove_dir=remove_dir)
             except Exception:
@@ -52,88 +87,55 @@ class TestFixture(object):
 
     cleanup_harness = teardown_harness
 
+    def instrument_dashi(self, dashi):
+        """Wrap a dashi connection so the latency, timeouts and payload
+        sizes of its operations are recorded in self.rpc_stats. That is the
+        harness's own RPCStats when the harness runs in this process.
+        """
+        if self.rpc_stats is None:
+            self.rpc_stats = getattr(self.epuharness, 'rpc_stats', None) or RPCStats()
+        return instrument(dashi, self.rpc_stats)
+
     def get_clients(self, deployment_str, dashi):
         """returns a dictionary of epu clients, indexed by their topic name
         """
 
-        deployment = parse_deployment(yaml_str=deployment_str)
+        plan = compile_deployment(yaml_str=deployment_str)
+        dashi = self.instrument_dashi(dashi)
 
         clients = {}
 
-        for provisioner_name in deployment.get('provisioners', {}).iterkeys():
-            client = ProvisionerClient(dashi, topic=provisioner_name)
-            clients[provisioner_name] = client
+        for service in plan.services_of_type('provisioner'):
+            clients[service.name] = ProvisionerClient(dashi, topic=service.name)
 
-        for epum_name in deployment.get('epums', {}).iterkeys():
-            client = EPUManagementClient(dashi, epum_name)
-            clients[epum_name] = client
+        for service in plan.services_of_type('epum'):
+            clients[service.name] = EPUManagementClient(dashi, service.name)
 
-        for node in deployment.get('nodes', {}).itervalues():
-            for eeagent_name in node.get('eeagents', {}).iterkeys():
-                client = EEAgentClient(dashi=dashi, ee_name=eeagent_name,
-                        handle_heartbeat=False)
-                clients[eeagent_name] = client
+        for service in plan.services_of_type('eeagent'):
+            clients[service.name] = EEAgentClient(dashi=dashi,
+                    ee_name=service.name, handle_heartbeat=False)
 
-        for pd_name in deployment.get('process-dispatchers', {}).iterkeys():
-            client = ProcessDispatcherClient(dashi, pd_name)
-            clients[pd_name] = client
+        for service in plan.services_of_type('process-dispatcher'):
+            clients[service.name] = ProcessDispatcherClient(dashi, service.name)
 
-        for dt_name in deployment.get('dt_registries', {}).iterkeys():
-            client = DTRSClient(dashi, topic=dt_name)
-            clients[dt_name] = client
+        for service in plan.services_of_type('dtrs'):
+            clients[service.name] = DTRSClient(dashi, topic=service.name)
 
         return clients
 
-    def block_until_ready(self, deployment_str, dashi):
+    def block_until_ready(self, deployment_str, dashi, timeout=None):
         """Blocks until all of the services in a deployment are contacted
-        """
-
-        deployment = parse_deployment(yaml_str=deployment_str)
-
-        for provisioner_name in deployment.get('provisioners', {}).iterkeys():
-            provisioner = ProvisionerClient(dashi, topic=provisioner_name)
-            self._block_on_call(provisioner.describe_nodes)
-
-        for epum_name in deployment.get('epums', {}).iterkeys():
-            epum = EPUManagementClient(dashi, epum_name)
-            self._block_on_call(epum.list_domains)
-
-        for node in deployment.get('nodes', {}).itervalues():
-            for eeagent_name in node.get('eeagents', {}).iterkeys():
-                eeagent = EEAgentClient(dashi=dashi, ee_name=eeagent_name,
-                        handle_heartbeat=False)
-                self._block_on_call(eeagent.dump, kwargs={'rpc': True})
-
-        for pd_name in deployment.get('process-dispatchers', {}).iterkeys():
-            pd = ProcessDispatcherClient(dashi, pd_name)
-            self._block_on_call(pd.describe_processes)
 
-        for dt_name in deployment.get('dt_registries', {}).iterkeys():
-            dtrs = DTRSClient(dashi, topic=dt_name)
-            self._block_on_call(dtrs.list_sites)
+        Services are probed in parallel. Returns a ReadinessReport with the
+        time each service took to answer.
+        """
 
-    def _block_on_call(self, fn_to_block_on, attempts=None, kwargs={}):
-        if not attempts:
-            attempts = 10
+        plan = compile_deployment(yaml_str=deployment_str)
 
-        print "Block on %s" % fn_to_block_on.__name__
-        for i in range(0, attempts):
-            try:
-                fn_to_block_on(**kwargs)
-                break
-            except timeout:
-                continue
-            except:
-                #call worked, but got some mystery error
-                raise
-        else:
-            try:
-                msg = "Wasn't able to call %s.%s" % (
-                    fn_to_block_on.im_class.__name__,
-                    fn_to_block_on.__name__)
-            except AttributeError:  # Not a member of a class
-                msg = "Wasn't able to call %s.%s" % fn_to_block_on.__name__
-            assert False, msg
+        report = check_readiness(plan, self.instrument_dashi(dashi), timeout=timeout)
+        assert report.ready, "Wasn't able to contact %s" % (
+            ", ".join(report.unready_services()))
+        return report
 
     def make_fake_libcloud_site(self, site_name="ec2-fake", needs_elastic_ip=None):
         """makes a fake libcloud site and driver.
@@ -164,3 +166,27 @@ class TestFixture(object):
         }
 
         return fake_site, driver
+
+    def make_mock_cloud_site(self, site_name="mock-cloud", cloud_name="mockcloud"):
+        """makes a site on a mock cloud started by the harness, which is
+        shared by every provisioner in the deployment and kept in memory.
+
+        Returns tuple of the site definition, and a MockCloudNodeDriver. Its
+        client can describe many VMs in one call, like
+        driver.client.describe_nodes(ids=[...], states=['running'])
+        """
+        if self.libcloud_drivers is None:
+            self.libcloud_drivers = {}
+
+        socket_path = self.epuharness.mock_cloud_socket(cloud_name)
+        driver = self.libcloud_drivers.get(site_name)
+        if driver is None:
+            driver = MockCloudNodeDriver(socket_path=socket_path)
+            self.libcloud_drivers[site_name] = driver
+
+        mock_site = {
+            'driver_class': DRIVER_CLASS,
+            'driver_kwargs': {'socket_path': socket_path},
+        }
+
+        return mock_site, driver
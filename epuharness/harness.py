@@ -1,27 +1,77 @@
 import os
+import re
 import sys
 import uuid
+import zlib
 import time
+import json
 import yaml
+import signal
+import hashlib
+import random
 import shutil
 import logging
 import tempfile
 import collections
+import gevent
+import gevent.coros
+import gevent.event
 import dashi.bootstrap as bootstrap
 
 from socket import timeout
+from functools import partial
 from pidantic.supd.pidsupd import SupDPidanticFactory
 from pidantic.state_machine import PIDanticState
-from epu.states import InstanceState
+from epu.states import InstanceState, ProcessState
 from epu.dashiproc.processdispatcher import ProcessDispatcherClient
 from epu.processdispatcher.engines import domain_id_from_engine
 
-from util import get_config_paths
-from deployment import parse_deployment, DEFAULT_DEPLOYMENT
+from util import get_config_paths, free_port
+from deployment import compile_deployment, DEFAULT_DEPLOYMENT
+from index import InstanceIndex
+from supd import SupDAdapter
+import procstat
+from timing import Timings, timed
+from monitor import ResourceMonitor
+from logs import LogCollector, LogStream, DEFAULT_LOG_INTERVAL, log_source
+from logsearch import LogIndex
+from rpcstats import RPCStats, instrument
+from simulator import DEFAULT_AGENTS_PER_WORKER
+from mockcloud import DRIVER_CLASS as MOCK_CLOUD_DRIVER
+from readiness import check_readiness, ping_port, DEFAULT_READY_TIMEOUT
+from registry import HarnessRegistry, DEFAULT_NAME as DEFAULT_REGISTRY_NAME
 from exceptions import DeploymentDescriptionError, HarnessException
 
 log = logging.getLogger(__name__)
 ADVERTISE_RETRIES = 10
+ADVERTISE_MAX_WAIT = 30
+
+DEFAULT_STOP_TIMEOUT = 30
+STOP_POLL_INTERVAL = 0.2
+
+# Resource monitor samples are saved with the logs under this name
+RESOURCES_FILE = "resources.json"
+# So are the stats of dashi operations made by the harness
+RPC_STATS_FILE = "rpcstats.json"
+
+# The service name of the workers hosting simulated eeagents
+SIMULATOR_SERVICE = "eeagent-simulator"
+
+# The program name of the harness's local AMQP broker, and where it listens
+BROKER_SERVICE = "epu-harness-broker"
+LOCAL_BROKER_HOST = "127.0.0.1"
+
+# supervisord names a program's output logs PROGRAM-CHANNEL---IDENTIFIER-*.log
+SUPERVISOR_LOG_PATTERN = re.compile(r"^(.+)-(stdout|stderr)---")
+
+# pidantic states in which a program may still have a live process
+LIVE_STATES = (PIDanticState.STATE_PENDING, PIDanticState.STATE_STARTING,
+    PIDanticState.STATE_RUNNING, PIDanticState.STATE_STOPPING,
+    PIDanticState.STATE_STOPPING_RESTART)
+
+# A program to be run under SupervisorD for one replica of a service
+Program = collections.namedtuple('Program', ['name', 'service', 'type',
+    'command', 'directory', 'autorestart', 'replica', 'node'])
 
 
 def complainy_on_error(function, path, excinfo):
@@ -35,31 +85,142 @@ def careful_rmtree(directory):
         shutil.rmtree(directory, ignore_errors=False, onerror=complainy_on_error)
 
 
+def remove_directories(directories):
+    """Remove each directory that exists with careful_rmtree. Directories
+    inside others in the list are left for their parent's removal.
+    """
+    roots = []
+    for directory in sorted(set(os.path.abspath(d) for d in directories)):
+        if not any(directory.startswith(root + os.sep) for root in roots):
+            roots.append(directory)
+    for directory in roots:
+        if not os.path.exists(directory):
+            continue
+        try:
+            careful_rmtree(directory)
+        except Exception:
+            log.exception("Problem removing directory")
+
+
 class EPUHarness(object):
     """EPUHarness. Sets up Process Dispatchers and EEAgents for testing.
     """
 
-    def __init__(self, exchange=None, pidantic_dir=None, amqp_uri=None, config=None, sysname=None):
+    def __init__(self, exchange=None, pidantic_dir=None, amqp_uri=None, config=None, sysname=None,
+            local_broker=None, namespace=None):
+        """
+        @param local_broker: when True, run a lightweight AMQP broker for
+                             the deployment instead of using RabbitMQ.
+                             Defaults to epuharness.local_broker
+        @param namespace: keeps this harness apart from others on the same
+                          host. Its pidantic directory, log directory,
+                          exchange and sysname are all named after the
+                          namespace, unless given. 'auto' picks a unique
+                          one. Defaults to $EPUHARNESS_NAMESPACE, then
+                          epuharness.namespace
+        """
 
         configs = ["epuharness"]
         config_files = get_config_paths(configs)
         if config:
             config_files.append(config)
         self.CFG = bootstrap.configure(config_files)
-        self.sysname = sysname
+
+        namespace = (namespace or os.environ.get('EPUHARNESS_NAMESPACE') or
+                self.CFG.epuharness.get('namespace'))
+        if namespace == 'auto':
+            namespace = uuid.uuid4().hex[:8]
+        self.namespace = namespace
+        self.sysname = sysname or namespace
 
         self.logdir = self.CFG.epuharness.logdir
-        self.pidantic_dir = (pidantic_dir or
-                os.environ.get('EPUHARNESS_PERSISTENCE_DIR') or
-                self.CFG.epuharness.pidantic_dir)
+        if pidantic_dir is None:
+            pidantic_dir = (os.environ.get('EPUHARNESS_PERSISTENCE_DIR') or
+                    self.CFG.epuharness.pidantic_dir)
+            if namespace:
+                pidantic_dir = "%s-%s" % (pidantic_dir.rstrip(os.sep), namespace)
+        self.pidantic_dir = pidantic_dir
+        if namespace:
+            self.logdir = os.path.join(self.logdir, "epuharness-%s" % namespace)
+            exchange = exchange or "epuharness.%s" % namespace
         self.exchange = exchange or self.CFG.server.amqp.get('exchange', None) or str(uuid.uuid4())
         self.CFG.server.amqp.exchange = self.exchange
-        self.CFG.dashi.sysname = sysname
-        self.dashi = bootstrap.dashi_connect(self.CFG.dashi.topic, self.CFG, amqp_uri=amqp_uri, sysname=sysname)
+        self.CFG.dashi.sysname = self.sysname
+        self.registry = HarnessRegistry(self.CFG.epuharness.get('registry_dir'))
+
+        # The broker's port is kept in the pidantic directory, so a harness
+        # made later to stop or check on the deployment finds it
+        self.broker_path = os.path.join(self.pidantic_dir, "broker.yml")
+        self.broker_port = self._local_broker_port(local_broker)
+        if self.broker_port:
+            amqp = self.CFG.server.amqp
+            amqp.host = LOCAL_BROKER_HOST
+            amqp.port = self.broker_port
+            amqp.username = 'guest'
+            amqp.password = 'guest'
+            amqp.vhost = '/'
+
+        # Every call and fire the harness and its tests make is timed
+        self.rpc_stats = RPCStats()
+        self.dashi = instrument(bootstrap.dashi_connect(self.CFG.dashi.topic,
+            self.CFG, amqp_uri=amqp_uri, sysname=self.sysname), self.rpc_stats)
         self.amqp_cfg = dict(self.CFG.server.amqp)
 
         self.factory = None
+        self.supd = None
+        # pidantic talks to supervisord over a single HTTP connection, which
+        # can't carry two requests at once, so greenlets take turns with it
+        self.supd_lock = gevent.coros.Semaphore()
         self.savelogs_dir = None
+        self.launch_timings = None
+        self.timings = Timings()
+
+        # Rendered service configs are kept together, with a manifest of
+        # which files and directories belong to each program
+        self.config_dir = os.path.join(self.pidantic_dir, "configs")
+        self.manifest_path = os.path.join(self.config_dir, "manifest.yml")
+        self.manifest = {}
+        self._pending_configs = {}
+        self.index_path = os.path.join(self.pidantic_dir, "index.yml")
+        self.index = InstanceIndex()
+        self.log_index_path = os.path.join(self.pidantic_dir, "logs.db")
+        self.monitor = None
+        self.log_collector = None
+
+    def _local_broker_port(self, local_broker):
+        """Returns the port of the local broker, or None when the harness
+        uses an external broker
+        """
+        if os.path.exists(self.broker_path):
+            with open(self.broker_path) as broker_file:
+                return yaml.safe_load(broker_file)['port']
+        if local_broker is None:
+            local_broker = self.CFG.epuharness.get('local_broker', False)
+        if not local_broker:
+            return None
+        return self.CFG.epuharness.get('local_broker_port') or free_port(LOCAL_BROKER_HOST)
+
+    @property
+    def registry_name(self):
+        return self.namespace or DEFAULT_REGISTRY_NAME
+
+    def _register_harness(self):
+        """Record this harness in the host's registry of live harnesses"""
+        try:
+            self.registry.register(self.registry_name, self.pidantic_dir,
+                    namespace=self.namespace, logdir=os.path.abspath(self.logdir),
+                    exchange=self.exchange, sysname=self.sysname,
+                    broker_port=self.broker_port)
+        except (IOError, OSError):
+            log.exception("Problem registering harness. Proceeding.")
+
+    def _reload_instances(self):
+        with self.supd_lock:
+            return self.factory.reload_instances()
+
+    def _poll_instances(self):
+        with self.supd_lock:
+            self.factory.poll()
 
     def _setup_factory(self):
 
@@ -72,32 +233,161 @@ class EPUHarness(object):
         except Exception:
             log.debug("Problem Connecting to SupervisorD", exc_info=True)
             raise HarnessException("Could not connect to supervisord. Was epu-harness started?")
+        self.supd = SupDAdapter(self.factory)
 
-    def status(self, exit=True):
+    def status(self, exit=True, services=None):
         """Get status of services that were previously started by epuharness
-        """
 
-        self._setup_factory()
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
+        """
 
-        instances = self.factory.reload_instances()
-        self.factory.poll()
+        report = self.status_report(services=services)
         return_code = 0
         status = []
-        for name, instance in instances.iteritems():
-            state = instance.get_state()
-            status.append((name, status))
-            if state != PIDanticState.STATE_RUNNING:
+        for row in report:
+            status.append((row['name'], row['state']))
+            if row['state'] != PIDanticState.STATE_RUNNING:
                 return_code = 1
 
-            log.info("%s is %s" % (name, instance.get_state()))
+            log.info(format_status(row))
         if exit:
             sys.exit(return_code)
         else:
             return status
 
-    def get_logfiles(self):
+    def status_report(self, services=None):
+        """Get detailed status of services that were previously started by
+        epuharness
+
+        Process details for every program come from a single
+        getAllProcessInfo call to supervisord, and CPU and memory use are
+        read from /proc, so this costs the same however many programs run.
+
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
+        @return: a list of dictionaries, one per program, sorted by name
+        """
+        self._setup_factory()
+
+        instances = self._reload_instances()
+        self._load_manifest()
+        if services:
+            instances = self._select_instances(services, instances)
+        self._poll_instances()
+        process_info = self._process_info()
+        uptime = procstat.system_uptime()
+
+        report = []
+        for name in sorted(instances):
+            entry = self.manifest.get(name, {})
+            info = process_info.get(name, {})
+            row = {
+                'name': name,
+                'service': entry.get('service', name),
+                'type': entry.get('type'),
+                'state': instances[name].get_state(),
+                'supervisor_state': info.get('statename'),
+                'pid': info.get('pid') or None,
+                'uptime': None,
+                'restarts': entry.get('restarts', 0),
+                'rss': None,
+                'cpu_percent': None,
+                'threads': None,
+            }
+            if row['pid']:
+                if info.get('start') and info.get('now'):
+                    row['uptime'] = info['now'] - info['start']
+                stats = procstat.read_process(row['pid'], uptime=uptime)
+                if stats is not None:
+                    row['rss'] = stats['rss']
+                    row['cpu_percent'] = round(stats['cpu_percent'], 2)
+                    row['threads'] = stats['threads']
+            report.append(row)
+        return report
+
+    def start_monitor(self, interval=None):
+        """Start sampling the resource use of every program in the background
+
+        @param interval: seconds between samples. Defaults to
+                         epuharness.monitor_interval, or 5 seconds if
+                         that isn't set
+        """
+        if self.monitor is None:
+            self.monitor = ResourceMonitor(self, interval=interval)
+        elif interval is not None:
+            self.monitor.interval = interval
+        self.monitor.start()
+        return self.monitor
+
+    def stop_monitor(self):
+        """Stop the resource monitor, saving its samples with the logs
+        """
+        if self.monitor is None:
+            return
+        self.monitor.stop()
+        if self.savelogs_dir:
+            try:
+                self.monitor.dump(os.path.join(self.savelogs_dir, RESOURCES_FILE))
+            except Exception:
+                log.exception("Problem saving resource samples. Proceeding.")
+        self.monitor = None
+
+    def dashi_stats(self, operations=None):
+        """Get the latency, timeouts, errors and payload sizes of the dashi
+        operations made through the harness's connection, since it was made
+
+        @param operations: names of operations to include, like
+                           describe_processes. Defaults to all
+        @return: a dictionary of stats, indexed by operation
+        """
+        return self.rpc_stats.summary(operations)
+
+    def _save_dashi_stats(self):
+        self.rpc_stats.stop_reporting()
+        self.rpc_stats.log_window()
+        if self.savelogs_dir and self.rpc_stats.operations:
+            try:
+                with open(os.path.join(self.savelogs_dir, RPC_STATS_FILE), "w") as f:
+                    json.dump(self.rpc_stats.summary(), f, indent=2)
+            except Exception:
+                log.exception("Problem saving dashi stats. Proceeding.")
+
+    def resource_stats(self, services=None, interval=None):
+        """Get CPU, memory, file descriptor and thread use of services
+
+        Starts the resource monitor if it isn't running already.
+
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
+        @param interval: seconds between samples, if the monitor is started
+        @return: a dictionary of stats, indexed by service
+        """
+        self._setup_factory()
+        self._load_manifest()
+        if self.monitor is None or not self.monitor.running:
+            self.start_monitor(interval=interval)
+            self.monitor.sample()
+
+        selected = None
+        if services:
+            selected = set(self.manifest.get(name, {}).get('service', name)
+                    for name in self.index.select(services))
+        return self.monitor.stats(selected)
+
+    def get_logfiles(self, services=None):
         """Returns a list of logfile paths relevant to epuharness instance
+
+        These are supervisord's logs of each program's output, and the
+        logfiles named in the configs of the programs in the manifest.
+
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
         """
+        names = None
+        if services:
+            names = self.index.select(services)
+
         # pretty hacky. we could get these over the supd API instead.
         # but that's certainly slower and not really better.
         pidantic_dir = os.path.abspath(self.pidantic_dir)
@@ -105,20 +395,111 @@ class EPUHarness(object):
 
         logfiles = []
         for f in os.listdir(epuharness_dir):
-            if os.path.splitext(f)[1].lower() == ".log":
-                logfiles.append(os.path.join(epuharness_dir, f))
+            if os.path.splitext(f)[1].lower() != ".log":
+                continue
+            if names is not None:
+                match = SUPERVISOR_LOG_PATTERN.match(f)
+                if not match or match.group(1) not in names:
+                    continue
+            logfiles.append(os.path.join(epuharness_dir, f))
+
+        for name, entry in sorted(self.manifest.iteritems()):
+            if names is not None and name not in names:
+                continue
+            for logfile in entry.get('logfiles', []):
+                if logfile not in logfiles and os.path.exists(logfile):
+                    logfiles.append(logfile)
         return logfiles
 
-    def stop(self, services=None, force=False, remove_dir=True):
+    def read_logs(self, services=None):
+        """Read the log lines written so far by every service, merged in
+        time order
+
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
+        @return: a list of (timestamp, source, line) tuples
+        """
+        self._load_manifest()
+        return LogStream(partial(self.get_logfiles, services=services)).poll()
+
+    def follow_logs(self, services=None, from_start=True, interval=None):
+        """Yield log lines from every service, merged in time order, as they
+        are written
+
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
+        @param from_start: whether to include lines already written
+        @return: a generator of (timestamp, source, line) tuples
+        """
+        if interval is None:
+            interval = self.CFG.epuharness.get('log_interval', DEFAULT_LOG_INTERVAL)
+        self._load_manifest()
+        stream = LogStream(partial(self.get_logfiles, services=services),
+                from_start=from_start)
+        return stream.follow(interval=interval)
+
+    def search_logs(self, services=None, **query):
+        """Search the logs of every service
+
+        The search index is brought up to date with whatever has been logged
+        since the last search before it is queried.
+
+        @param services: a list of selectors, as accepted by InstanceIndex.
+                         Defaults to every service
+        @param query: levels, start, end, text, ids and limit, as accepted
+                      by LogIndex.search
+        @return: a list of (timestamp, source, line) tuples, in time order
+        """
+        self._load_manifest()
+        index = LogIndex(self.log_index_path)
+        try:
+            with self.timings.phase("index_logs"):
+                index.update(self.get_logfiles())
+            sources = None
+            if services:
+                sources = [log_source(path) for path in self.get_logfiles(services=services)]
+            return index.search(sources=sources, **query)
+        finally:
+            index.close()
+
+    def start_log_collector(self, output_dir):
+        """Start copying logfiles to output_dir as they are written
+
+        Compression and size caps come from epuharness.log_compression and
+        epuharness.log_max_bytes.
+        """
+        if self.log_collector is None:
+            self.log_collector = LogCollector(self.get_logfiles, output_dir,
+                    compression=self.CFG.epuharness.get('log_compression'),
+                    max_bytes=self.CFG.epuharness.get('log_max_bytes'),
+                    interval=self.CFG.epuharness.get('log_interval', DEFAULT_LOG_INTERVAL))
+            self.log_collector.start()
+        return self.log_collector
+
+    def stop(self, services=None, force=False, remove_dir=True, disconnect=True,
+            timeout=None):
         """Stop services that were previously started by epuharness
 
+        Every program is sent termination at once. Programs still running
+        when the timeout expires are killed with SIGKILL.
+
         @param force: When False raises an exception when there is something
                       that can't be killed.
+        @param disconnect: When False the dashi connection is left open, so
+                           the harness can be started again
+        @param timeout: seconds to wait for programs to exit before killing
+                        them. Defaults to epuharness.stop_timeout
+        @return: a dictionary of how long each program took to stop,
+                 indexed by program name
         """
         cleanup = False
+        began = time.time()
+
+        if timeout is None:
+            timeout = self.CFG.epuharness.get('stop_timeout', DEFAULT_STOP_TIMEOUT)
 
         self._setup_factory()
-        instances = self.factory.reload_instances()
+        instances = self._reload_instances()
 
         # If we're killing everything, perform cleanup
         if services == instances.keys():
@@ -127,32 +508,262 @@ class EPUHarness(object):
             cleanup = True
             services = instances.keys()
 
+        self._load_manifest()
+
         log.info("Stopping %s" % ", ".join(services))
-        for service in services:
-            instances_to_kill = filter(lambda x: x.startswith(service), instances.keys())
-            for instance_name in instances_to_kill:
-                instance = instances[instance_name]
-                self._clean_instance_config(instance)
-                if not cleanup:
+        instances_to_kill = self._select_instances(services, instances)
+
+        latencies = self._terminate_instances(instances_to_kill, timeout)
+
+        directories = []
+        if not cleanup:
+            for instance_name, instance in instances_to_kill.iteritems():
+                with self.supd_lock:
                     instance.cleanup()
+                directories.extend(self._clean_program_files(instance_name))
+            self._save_manifest()
 
         if cleanup:
-            if self.savelogs_dir:
+            if self.log_collector is not None:
+                try:
+                    self.log_collector.stop()
+                except Exception:
+                    log.exception("Problem collecting logs. Proceeding.")
+                self.log_collector = None
+            elif self.savelogs_dir:
                 try:
                     self._save_logs(self.savelogs_dir)
                 except Exception:
                     log.exception("Problem saving logs. Proceeding.")
+            self.stop_monitor()
+            self._save_dashi_stats()
 
             try:
-                self.factory.terminate()
+                with self.timings.phase("terminate"):
+                    with self.supd_lock:
+                        self.factory.terminate()
             except Exception as e:
                 log.warning("Problem terminating factory, continuing : %s" % e)
+            self.factory = None
+            self.supd = None
+
+            # Configs all live in the config directory, so only
+            # directories outside of it need to be removed one by one
+            for entry in self.manifest.itervalues():
+                directories.extend(entry.get('directories', []))
+            self.manifest = {}
+            self.index = InstanceIndex()
+            self.registry.unregister(self.registry_name)
 
             if remove_dir:
-                careful_rmtree(self.pidantic_dir)
+                directories.append(self.pidantic_dir)
+            else:
+                directories.append(self.config_dir)
+
+        with self.timings.phase("remove_directories"):
+            remove_directories(directories)
+
+        self.timings.record("stop", began, time.time() - began)
+
+        if disconnect:
+            self.dashi.cancel()
+            self.dashi.disconnect()
+
+        return latencies
+
+    def restart(self, services, timeout=None):
+        """Restart some of the services started by epuharness
+
+        Terminated programs can't be started again through pidantic, so
+        each one is removed and registered again with the command,
+        directory and autorestart recorded in the manifest, the way apply()
+        replaces programs that changed.
+
+        @param services: a list of selectors, as accepted by InstanceIndex
+        @param timeout: seconds to wait for programs to exit before killing
+                        them. Defaults to epuharness.stop_timeout
+        @return: the names of the programs that were restarted
+        """
+        if timeout is None:
+            timeout = self.CFG.epuharness.get('stop_timeout', DEFAULT_STOP_TIMEOUT)
+
+        self._setup_factory()
+        instances = self._reload_instances()
+        self._load_manifest()
+
+        to_restart = self._select_instances(services, instances)
+        for name in sorted(to_restart):
+            if 'command' not in self.manifest.get(name, {}):
+                log.warning("%s isn't in the manifest, so it can't be restarted" % name)
+                del to_restart[name]
+        log.info("Restarting %s" % ", ".join(sorted(to_restart)))
+        self._terminate_instances(to_restart, timeout)
+
+        programs = []
+        for name, instance in sorted(to_restart.iteritems()):
+            entry = self.manifest[name]
+            programs.append(Program(name, entry.get('service', name),
+                entry.get('type'), entry['command'],
+                entry.get('directory') or self.pidantic_dir,
+                entry.get('autorestart', False), entry.get('replica'),
+                entry.get('node')))
+            with self.supd_lock:
+                instance.cleanup()
+        self._start_wave(self._register(programs))
+
+        # supervisord forgets about restarts, so keep count in the manifest
+        for name in to_restart:
+            entry = self.manifest.get(name)
+            if entry is not None:
+                entry['restarts'] = entry.get('restarts', 0) + 1
+        self._save_manifest()
+        return sorted(to_restart)
+
+    def reset(self, timeout=None):
+        """Return a running deployment to a clean state, so it can be reused
+        by another test without starting it again.
+
+        Processes still running are terminated, then the process
+        dispatchers are restarted, which makes them forget every process
+        they knew about, and the deployment's nodes are announced to them
+        again. Everything else keeps running.
+
+        @param timeout: seconds to wait for processes to be terminated.
+                        Defaults to epuharness.stop_timeout
+        @return: the names of the process dispatcher programs restarted
+        """
+        if timeout is None:
+            timeout = self.CFG.epuharness.get('stop_timeout', DEFAULT_STOP_TIMEOUT)
+
+        began = time.time()
+        manifest = self._load_manifest()
+        process_dispatchers = sorted(set(entry['service']
+            for entry in manifest.itervalues()
+            if entry.get('type') == 'process-dispatcher'))
+        self._terminate_processes(process_dispatchers, timeout)
+
+        restarted = self.restart(['type=process-dispatcher'])
+        nodes = [(name, entry.get('engine', 'default'), entry['process_dispatcher'])
+                for name, entry in sorted(self.manifest.iteritems())
+                if entry.get('type') == 'node']
+        unannounced = self.announce_nodes(nodes)
+        if unannounced:
+            msg = "Nodes weren't announced after reset: %s" % ", ".join(unannounced)
+            raise HarnessException(msg)
 
-        self.dashi.cancel()
-        self.dashi.disconnect()
+        self.timings.record("reset", began, time.time() - began)
+        return restarted
+
+    def _terminate_processes(self, process_dispatchers, wait_timeout):
+        """Ask process dispatchers to terminate all of their live processes,
+        and wait for them to go
+
+        @param process_dispatchers: the names of the pds
+        @param wait_timeout: seconds to wait for the processes to be terminated
+        """
+        clients = dict((name, ProcessDispatcherClient(self.dashi, name))
+                for name in process_dispatchers)
+
+        def live_processes(name):
+            try:
+                processes = clients[name].describe_processes()
+            except timeout:
+                log.warning("Couldn't describe the processes of %s" % name)
+                return []
+            return [process['upid'] for process in processes
+                    if process['state'] < ProcessState.TERMINATED]
+
+        for name in process_dispatchers:
+            for upid in live_processes(name):
+                clients[name].terminate_process(upid)
+
+        deadline = time.time() + wait_timeout
+        while time.time() < deadline:
+            if not any(live_processes(name) for name in process_dispatchers):
+                return
+            gevent.sleep(STOP_POLL_INTERVAL)
+        log.warning("Processes were still running after %ss. Proceeding." % wait_timeout)
+
+    def _select_instances(self, selectors, instances):
+        """Select pidantic instances with the instance index
+
+        @param selectors: a list of selectors, as accepted by InstanceIndex
+        @param instances: a dictionary of pidantic objects, indexed by name
+        @return: the selected subset of instances
+        """
+        selected = {}
+        for selector in selectors:
+            names = self.index.lookup(selector)
+            # Programs started outside of a deployment aren't indexed
+            if not names and selector in instances:
+                names = set([selector])
+            if not names:
+                log.warning("No programs match '%s'" % selector)
+            for name in names:
+                if name in instances:
+                    selected[name] = instances[name]
+        return selected
+
+    def _terminate_instances(self, instances, timeout):
+        """Terminate pidantic instances all at once, and wait for them to
+        exit. Any still running after timeout seconds are sent SIGKILL.
+
+        Each instance moves to its stopping state through pidantic, but the
+        stop requests are sent to supervisord back to back, without waiting
+        for each program to stop as pidantic would.
+
+        @param instances: a dictionary of pidantic objects, indexed by name
+        @return: a dictionary of how long each one took to stop
+        """
+        began = time.time()
+        with self.supd_lock:
+            self.supd.terminate(instances)
+
+        latencies = {}
+        running = dict(instances)
+        deadline = began + timeout
+        while running:
+            self._poll_instances()
+            now = time.time()
+            for name, instance in running.items():
+                if instance.get_state() not in LIVE_STATES:
+                    latencies[name] = now - began
+                    self.timings.record("shutdown", began, now - began,
+                            service=name, killed=False)
+                    del running[name]
+            if not running or now >= deadline:
+                break
+            gevent.sleep(STOP_POLL_INTERVAL)
+
+        if running:
+            log.warning("%s didn't stop after %ss. Killing them." % (
+                ", ".join(sorted(running)), timeout))
+            process_info = self._process_info()
+            for name in running:
+                pid = process_info.get(name, {}).get('pid')
+                if pid:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        log.debug("Couldn't kill %s (pid %s)", name, pid, exc_info=True)
+                latencies[name] = time.time() - began
+                self.timings.record("shutdown", began, latencies[name],
+                        service=name, killed=True)
+
+        for name in sorted(latencies):
+            log.debug("%s stopped in %.2fs" % (name, latencies[name]))
+        return latencies
+
+    def _process_info(self):
+        """Returns supervisord's process info for each program, indexed by
+        name, from one call to getAllProcessInfo
+        """
+        try:
+            with self.supd_lock:
+                return self.supd.process_info()
+        except Exception, e:
+            log.warning("Couldn't get process info from supervisord: %s" % e)
+            return {}
 
     def _save_logs(self, output_dir):
         for logfile in self.get_logfiles():
@@ -163,27 +774,8 @@ class EPUHarness(object):
             except Exception:
                 log.exception("Error copying logfile %s", logfile)
 
-    def _clean_instance_config(self, instance):
-        try:
-            # Clean up config files
-            command = instance._program_object.command
-            command = command.split()
-            for config in command:
-                if config.endswith('.yml'):
-                    _cf = yaml.load(config)
-                    with open(_cf) as cf:
-                        cfg = yaml.load(cf)
-                        try:
-                            persistence = cfg['apps'][0]['config']['eeagent']['launch_type']['persistence_directory']
-                            careful_rmtree(persistence)
-                        except Exception:
-                            pass
-                    os.remove(config)
-        except Exception, e:
-            # Perhaps instance internals have changed
-            log.warning("Couldn't delete temporary config files: %s" % e)
-
-    def start(self, deployment_file=None, deployment_str=None, remove_old_persistence=True):
+    def start(self, deployment_file=None, deployment_str=None, remove_old_persistence=True,
+            wait=False, ready_timeout=None):
         """Start services defined in the deployment file provided. If a
         deployment file isn't provided, then start a standard set of one
         Process Dispatcher and one eeagent.
@@ -191,14 +783,19 @@ class EPUHarness(object):
         @param deployment_str: A deployment description in str form
         @param deployment_file: The path to a deployment file. Format is in the
                                 README
+        @param wait: when True, block until every service answers, and return
+                     a ReadinessReport
+        @param ready_timeout: seconds to wait for services when wait is True.
+                              Defaults to epuharness.ready_timeout
         """
+        began = time.time()
 
         try:
             os.makedirs(self.pidantic_dir)
         except OSError:
             if remove_old_persistence is True:
                 self._setup_factory()
-                instances = self.factory.reload_instances()
+                instances = self._reload_instances()
 
                 if len(instances) > 0:
                     if len(instances) == 1:
@@ -215,6 +812,7 @@ class EPUHarness(object):
                     log.error(msg)
                     careful_rmtree(self.pidantic_dir)
                     self.factory = None
+                    self.supd = None
                     os.makedirs(self.pidantic_dir)
             else:
                 log.debug("Problem making pidantic dir", exc_info=True)
@@ -222,51 +820,145 @@ class EPUHarness(object):
                     self.pidantic_dir)
                 raise HarnessException(msg)
 
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+        self._register_harness()
         self._setup_factory()
 
-        if deployment_str:
-            deployment = parse_deployment(yaml_str=deployment_str)
-        elif deployment_file:
-            deployment = parse_deployment(yaml_path=deployment_file)
-        else:
-            deployment = parse_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+        deployment = self._load_deployment(deployment_file, deployment_str)
+        programs, announcements = self._plan_deployment(deployment)
+
+        # Services connect to the broker as soon as they start, so a local
+        # broker has to be listening first
+        broker = programs.pop(BROKER_SERVICE, None)
+        if broker:
+            with open(self.broker_path, "w") as broker_file:
+                yaml.safe_dump({'port': self.broker_port}, broker_file)
+            self.launch([broker])
+            self.wait_for_broker(timeout=ready_timeout)
+
+        # Every program is registered up front, then services that don't
+        # depend on each other are started together, one wave at a time
+        self.launch(self._program_waves(deployment, programs))
+        log.info("Started %d programs in %.2fs" % (self.launch_timings['programs'],
+            self.launch_timings['register'] + self.launch_timings['start']))
+
+        unannounced = self.announce_nodes(announcements)
+        if unannounced:
+            msg = "Nodes weren't announced: %s" % ", ".join(unannounced)
+            raise HarnessException(msg)
+
+        if self.CFG.epuharness.get('monitor_interval'):
+            self.start_monitor()
+        if self.CFG.epuharness.get('rpc_stats_interval'):
+            self.rpc_stats.start_reporting(self.CFG.epuharness.rpc_stats_interval)
+
+        report = None
+        if wait:
+            report = self.wait_until_ready(deployment, timeout=ready_timeout)
+
+        self.savelogs_dir = self._get_savelogs_dir()
+        if self.savelogs_dir:
+
+            # by printing out this funny format, Jenkins will pick up these
+            # files and include them in the test results UI as attachments.
+            # Note that we print out the path the file will be COPIED to when
+            # the harness is stopped. We can't just wait and print it out when
+            # we actually copy it because that happens during tearDown, output
+            # from which is apparently difficult for nose to capture.
+            if self.CFG.epuharness.get('stream_logs'):
+                # Logs are copied as they're written, rather than at stop
+                collector = self.start_log_collector(self.savelogs_dir)
+                for logfile in self.get_logfiles():
+                    print "[[ATTACHMENT|%s]]" % collector.destination(logfile)
+            else:
+                for logfile in self.get_logfiles():
+                    basename = os.path.basename(logfile)
+                    print "[[ATTACHMENT|%s]]" % os.path.join(self.savelogs_dir, basename)
+            if self.monitor is not None:
+                print "[[ATTACHMENT|%s]]" % os.path.join(self.savelogs_dir, RESOURCES_FILE)
+
+        self.timings.record("start", began, time.time() - began)
+        return report
+
+    def _load_deployment(self, deployment_file=None, deployment_str=None):
+        """Returns a compiled DeploymentPlan
+        """
+        with self.timings.phase("parse_deployment"):
+            if deployment_str:
+                return compile_deployment(yaml_str=deployment_str)
+            elif deployment_file:
+                return compile_deployment(yaml_path=deployment_file)
+            else:
+                return compile_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+
+    def _plan_deployment(self, deployment):
+        """Render the configs for every service in a deployment, and record
+        them in the manifest.
+
+        @param deployment: a DeploymentPlan
+        @return: a tuple of a dictionary of lists of Programs, indexed by
+                 service name, and a list of node announcements
+        """
 
-        # Start Provisioners
+        self.mock_clouds = deployment.get('mock-clouds', {})
         self.provisioners = deployment.get('provisioners', {})
+        self.dtrses = deployment.get('dt_registries', {})
+        self.epums = deployment.get('epums', {})
+        self.process_dispatchers = deployment.get('process-dispatchers', {})
+        self.pyon_process_dispatchers = deployment.get('pyon-process-dispatchers', {})
+        self.pyon_http_gateways = deployment.get('pyon-http-gateways', {})
+        self.phantom_instances = deployment.get('phantom-instances', {})
+        nodes = deployment.get('nodes', {})
+        pyon_nodes = deployment.get('pyon-nodes', {})
+
+        # Each service's programs are keyed by the same name as the
+        # dependency graph. Nodes are announced separately, once everything
+        # is started
+        programs = {}
+        announcements = []
+        simulated = []
+
+        if self.broker_port:
+            programs[BROKER_SERVICE] = self._plan_broker()
+
+        for cloud_name, cloud in self.mock_clouds.iteritems():
+            programs[cloud_name] = self._plan_mock_cloud(cloud_name, cloud)
+
         for prov_name, provisioner in self.provisioners.iteritems():
-            self._start_provisioner(prov_name, provisioner.get('config', {}))
+            programs[prov_name] = self._plan_provisioner(prov_name,
+                    provisioner.get('config', {}))
 
-        # Start DTRS
-        self.dtrses = deployment.get('dt_registries', {})
         for dtrs_name, dtrs in self.dtrses.iteritems():
-            self._start_dtrs(dtrs_name, dtrs.get('config', {}))
+            programs[dtrs_name] = self._plan_dtrs(dtrs_name,
+                    dtrs.get('config', {}))
 
-        # Start EPUMs
-        self.epums = deployment.get('epums', {})
         for epum_name, epum in self.epums.iteritems():
-            self._start_epum(epum_name, epum.get('config', {}))
+            programs[epum_name] = self._plan_epum(epum_name,
+                    epum.get('config', {}))
 
-        # Start Process Dispatchers
-        self.process_dispatchers = deployment.get('process-dispatchers', {})
         for pd_name, pd in self.process_dispatchers.iteritems():
-            self._start_process_dispatcher(pd_name, pd.get('config', {}))
+            programs[pd_name] = self._plan_process_dispatcher(pd_name,
+                    pd.get('config', {}))
 
-        # Start Nodes and EEAgents
-        nodes = deployment.get('nodes', {})
         for node_name, node in nodes.iteritems():
+            announcements.append(self._plan_node(node_name,
+                    node.get('engine', 'default'), node['process-dispatcher']))
 
-            if 'process-dispatcher' not in node:
-                msg = "No process-dispatcher specified for node '%s'" % (
-                    node_name)
-                raise DeploymentDescriptionError(msg)
-
-            self.announce_node(node_name, node.get('engine', 'default'),
-                    node['process-dispatcher'])
-
-            for eeagent_name, eeagent in node.get('eeagents', {}).iteritems():
+            for eeagent_name, eeagent in (node.get('eeagents') or {}).iteritems():
                 dispatcher = eeagent.get('process-dispatcher') or \
                     node.get('process-dispatcher', '')
-                self._start_eeagent(eeagent_name, dispatcher, node_name,
+                if eeagent['launch_type'] == 'simulated':
+                    simulated.append({'name': eeagent_name, 'node_id': node_name,
+                        'process_dispatcher': dispatcher,
+                        'slots': eeagent.get('slots'),
+                        'heartbeat': eeagent.get('heartbeat'),
+                        'launch_latency': eeagent.get('launch_latency'),
+                        'terminate_latency': eeagent.get('terminate_latency'),
+                        'failure_rate': eeagent.get('failure_rate')})
+                    continue
+                programs[eeagent_name] = self._plan_eeagent(
+                    eeagent_name, dispatcher, node_name,
                     eeagent['launch_type'],
                     pyon_directory=eeagent.get('pyon_directory'),
                     logfile=eeagent.get('logfile'),
@@ -275,47 +967,210 @@ class EPUHarness(object):
                     supd_directory=os.path.join(self.pidantic_dir, eeagent_name),
                     heartbeat=eeagent.get('heartbeat'))
 
-        # Start Pyon Process Dispatchers
-        self.pyon_process_dispatchers = deployment.get('pyon-process-dispatchers', {})
         for pd_name, pd in self.pyon_process_dispatchers.iteritems():
-            self._start_pyon_process_dispatcher(pd_name, pd.get('config', {}))
+            programs[pd_name] = self._plan_pyon_process_dispatcher(
+                    pd_name, pd.get('config', {}))
 
-        # Start Pyon Gateway
-        self.pyon_http_gateways = deployment.get('pyon-http-gateways', {})
         for gateway_name, gateway in self.pyon_http_gateways.iteritems():
-            self._start_pyon_http_gateway(gateway_name, gateway.get('config', {}))
+            programs[gateway_name] = self._plan_pyon_http_gateway(
+                    gateway_name, gateway.get('config', {}))
 
-        # Start Pyon Nodes and EEAgents
-        pyon_nodes = deployment.get('pyon-nodes', {})
         for node_name, node in pyon_nodes.iteritems():
             # TODO when Pyon PD is ready
-            self.announce_node(node_name, node.get('engine', 'default'),
-                    node['process-dispatcher'])
+            announcements.append(self._plan_node(node_name,
+                    node.get('engine', 'default'), node['process-dispatcher']))
 
-            for eeagent_name, eeagent in node.get('eeagents', {}).iteritems():
+            for eeagent_name, eeagent in (node.get('eeagents') or {}).iteritems():
                 config = eeagent.get('config', {})
-                self._start_pyon_eeagent(name=eeagent_name,
-                        node_name=node_name, config=config)
+                programs[eeagent_name] = self._plan_pyon_eeagent(
+                        name=eeagent_name, node_name=node_name, config=config)
 
-        # Start Phantom
-        self.phantom_instances = deployment.get('phantom-instances', {})
         for phantom_name, phantom in self.phantom_instances.iteritems():
             port = phantom.get('port')
             users = phantom.get('users', [])
-            self._start_phantom(phantom_name, phantom.get('config', {}), users, port=port)
+            programs[phantom_name] = self._plan_phantom(phantom_name,
+                    phantom.get('config', {}), users, port=port)
 
-        self.savelogs_dir = self._get_savelogs_dir()
-        if self.savelogs_dir:
+        if simulated:
+            programs[SIMULATOR_SERVICE] = self._plan_simulators(simulated)
 
-            # by printing out this funny format, Jenkins will pick up these
-            # files and include them in the test results UI as attachments.
-            # Note that we print out the path the file will be COPIED to when
-            # the harness is stopped. We can't just wait and print it out when
-            # we actually copy it because that happens during tearDown, output
-            # from which is apparently difficult for nose to capture.
-            for logfile in self.get_logfiles():
-                basename = os.path.basename(logfile)
-                print "[[ATTACHMENT|%s]]" % os.path.join(self.savelogs_dir, basename)
+        return programs, announcements
+
+    def _program_waves(self, deployment, programs, only=None):
+        """Group programs into the waves they can be started in
+
+        @param only: if given, a set of program names to include
+        """
+        waves = []
+        for wave in deployment.waves:
+            wave = [program for name in wave for program in programs.get(name, [])
+                    if only is None or program.name in only]
+            if wave:
+                waves.append(wave)
+
+        # Programs that aren't services in the deployment, like the workers
+        # hosting simulated eeagents, start once everything else has
+        services = set(name for wave in deployment.waves for name in wave)
+        last_wave = [program for name in sorted(programs) if name not in services
+                for program in programs[name] if only is None or program.name in only]
+        if last_wave:
+            waves.append(last_wave)
+        return waves
+
+    def _plan_node(self, node_name, engine, process_dispatcher):
+        """Record a node announcement in the manifest, so that apply can
+        tell when it changes
+        """
+        entry = self._manifest_entry(node_name)
+        entry.update(service=node_name, type='node', engine=engine,
+                process_dispatcher=process_dispatcher)
+        entry['hash'] = hashlib.sha1("%s %s" % (engine, process_dispatcher)).hexdigest()
+        return (node_name, engine, process_dispatcher)
+
+    def apply(self, deployment_file=None, deployment_str=None, wait=False,
+            ready_timeout=None):
+        """Bring running services in line with a deployment, without
+        restarting the ones that haven't changed.
+
+        Services that are new in the deployment are started, services
+        whose rendered config or command changed are restarted, and running
+        services that are no longer in the deployment are stopped. New nodes
+        are announced to their process dispatchers, and removed nodes are
+        announced as terminated. If nothing is running, this is the same
+        as start().
+
+        @return: a dictionary listing the programs that were started,
+                 restarted and stopped, and the nodes that were announced
+                 and removed
+        """
+        if not os.path.exists(self.pidantic_dir):
+            self.start(deployment_file=deployment_file,
+                    deployment_str=deployment_str, wait=wait,
+                    ready_timeout=ready_timeout)
+            started = sorted(name for name, entry in self.manifest.iteritems()
+                    if entry.get('type') != 'node')
+            nodes = sorted(name for name, entry in self.manifest.iteritems()
+                    if entry.get('type') == 'node')
+            return {'started': started, 'restarted': [], 'stopped': [],
+                    'announced': nodes, 'removed_nodes': []}
+
+        began = time.time()
+        self._setup_factory()
+        instances = self._reload_instances()
+        old_manifest = self._load_manifest()
+
+        deployment = self._load_deployment(deployment_file, deployment_str)
+        self.manifest = {}
+        self._pending_configs = {}
+        programs, announcements = self._plan_deployment(deployment)
+        new_manifest = self.manifest
+
+        planned = set(program.name for service_programs in programs.itervalues()
+                for program in service_programs)
+        running = set(instances)
+        added = planned - running
+        removed = running - planned
+        changed = set(name for name in planned & running
+                if old_manifest.get(name, {}).get('hash') != new_manifest[name].get('hash'))
+
+        old_nodes = dict((name, entry) for name, entry in old_manifest.iteritems()
+                if entry.get('type') == 'node')
+        new_nodes = [announcement for announcement in announcements
+                if old_nodes.get(announcement[0], {}).get('hash') !=
+                new_manifest[announcement[0]]['hash']]
+        removed_nodes = [name for name in old_nodes if name not in new_manifest]
+
+        for name in planned & running:
+            if name not in changed and 'restarts' in old_manifest[name]:
+                new_manifest[name]['restarts'] = old_manifest[name]['restarts']
+
+        log.info("Applying deployment: starting %s, restarting %s, stopping %s" % (
+            ", ".join(sorted(added)) or "nothing",
+            ", ".join(sorted(changed)) or "nothing",
+            ", ".join(sorted(removed)) or "nothing"))
+
+        for name in removed | changed:
+            with self.supd_lock:
+                instances[name].cleanup()
+
+        # Files for restarted programs are rewritten in place, so only
+        # removed programs need cleaning up
+        self.manifest = old_manifest
+        directories = []
+        for name in removed:
+            directories.extend(self._clean_program_files(name))
+        remove_directories(directories)
+        self.manifest = new_manifest
+
+        self._write_configs()
+        self._save_manifest()
+        self.launch(self._program_waves(deployment, programs, only=added | changed))
+
+        for name in removed_nodes:
+            entry = old_manifest[name]
+            self.announce_node(name, entry.get('engine', 'default'),
+                    entry['process_dispatcher'], state=InstanceState.TERMINATED)
+        unannounced = self.announce_nodes(new_nodes)
+        if unannounced:
+            msg = "Nodes weren't announced: %s" % ", ".join(unannounced)
+            raise HarnessException(msg)
+
+        if wait:
+            self.wait_until_ready(deployment, timeout=ready_timeout)
+
+        self.timings.record("apply", began, time.time() - began)
+        return {
+            'started': sorted(added),
+            'restarted': sorted(changed),
+            'stopped': sorted(removed),
+            'announced': sorted(node[0] for node in new_nodes),
+            'removed_nodes': sorted(removed_nodes),
+        }
+
+    def wait_until_ready(self, deployment, timeout=None):
+        """Block until every service in a deployment answers
+
+        @param deployment: a parsed deployment
+        @param timeout: seconds to wait. Defaults to epuharness.ready_timeout
+        @return: a ReadinessReport
+        """
+        if timeout is None:
+            timeout = self.CFG.epuharness.get('ready_timeout', DEFAULT_READY_TIMEOUT)
+
+        sockets = dict((service.name, self.mock_cloud_socket(service.name))
+                for service in deployment.services_of_type('mock-cloud'))
+
+        began = time.time()
+        report = check_readiness(deployment, self.dashi, timeout=timeout,
+                sockets=sockets)
+        for name in sorted(report):
+            self.timings.record("readiness", began,
+                    report[name]['time_to_ready'] or time.time() - began,
+                    service=name, ready=report[name]['ready'],
+                    attempts=report[name]['attempts'])
+            if report[name]['ready']:
+                log.info("%s ready after %.2fs" % (name, report[name]['time_to_ready']))
+        if not report.ready:
+            msg = "Services weren't ready after %ss: %s" % (
+                timeout, ", ".join(report.unready_services()))
+            raise HarnessException(msg)
+        return report
+
+    def wait_for_broker(self, timeout=None):
+        """Block until the local broker accepts connections
+
+        @param timeout: seconds to wait. Defaults to epuharness.ready_timeout
+        """
+        if timeout is None:
+            timeout = self.CFG.epuharness.get('ready_timeout', DEFAULT_READY_TIMEOUT)
+        began = time.time()
+        with self.timings.phase("broker"):
+            while not ping_port(LOCAL_BROKER_HOST, self.broker_port):
+                if time.time() - began > timeout:
+                    raise HarnessException("Local broker wasn't listening on port %s after %ss" % (
+                        self.broker_port, timeout))
+        log.info("Local broker listening on port %s after %.2fs" % (
+            self.broker_port, time.time() - began))
 
     def _get_savelogs_dir(self):
         savelogs_dir = os.environ.get("EPUHARNESS_SAVELOGS_DIR")
@@ -331,22 +1186,222 @@ class EPUHarness(object):
 
         return savelogs_dir
 
+    def _render_config(self, proc_name, contents, suffix=".yml"):
+        """Queue a config file for proc_name to be written by _write_configs
+
+        @param proc_name: the program the config file belongs to
+        @param contents: a str, or a dict to be dumped as yaml
+        @return: the path the config will be written to
+        """
+        if not isinstance(contents, basestring):
+            # Remember where the program logs, so its logs can be collected.
+            # Relative log files go in the harness's log directory, so
+            # harnesses in different namespaces don't share them
+            handler = contents.get('logging', {}).get('handlers', {}).get('file', {})
+            logfile = handler.get('filename')
+            if logfile and logfile != os.devnull:
+                if not os.path.isabs(logfile):
+                    logfile = handler['filename'] = os.path.join(self.logdir, logfile)
+                self._manifest_entry(proc_name).setdefault('logfiles', []).append(logfile)
+            contents = yaml.dump(contents)
+
+        filename = os.path.join(self.config_dir, "%s%s" % (proc_name, suffix))
+        self._pending_configs[filename] = contents
+        self._manifest_entry(proc_name)['files'].append(filename)
+        return filename
+
+    def _manifest_entry(self, proc_name):
+        return self.manifest.setdefault(proc_name,
+                {'files': [], 'directories': []})
+
+    @timed("write_configs")
+    def _write_configs(self):
+        """Write every config queued by _render_config, and the manifest,
+        to the config directory in one pass
+        """
+        if not self._pending_configs:
+            return
+
+        try:
+            os.makedirs(self.config_dir)
+        except OSError:
+            log.debug("%s already exists. Continuing.", self.config_dir)
+
+        for filename, contents in self._pending_configs.iteritems():
+            with open(filename, "w") as config_f:
+                config_f.write(contents)
+        self._pending_configs = {}
+
+        self._save_manifest()
+
+    def _save_manifest(self):
+        """Save the manifest, and the instance index built from it, next to
+        the pidantic state
+        """
+        self.index = InstanceIndex.from_manifest(self.manifest)
+        if os.path.exists(self.pidantic_dir):
+            self.index.save(self.index_path)
+
+        if not os.path.exists(self.config_dir):
+            return
+        with open(self.manifest_path, "w") as manifest_f:
+            manifest_f.write(yaml.safe_dump(self.manifest))
+
+    def _load_manifest(self):
+        """Load the manifest of files written for each running program,
+        and the instance index
+        """
+        try:
+            with open(self.manifest_path) as manifest_f:
+                manifest = yaml.safe_load(manifest_f)
+        except IOError:
+            manifest = None
+        self.manifest = manifest or {}
+
+        try:
+            self.index = InstanceIndex.load(self.index_path)
+        except IOError:
+            self.index = InstanceIndex.from_manifest(self.manifest)
+        return self.manifest
+
+    def _clean_program_files(self, proc_name):
+        """Remove the config files recorded for a program
+
+        @return: the directories recorded for the program, which the caller
+                 should remove
+        """
+        entry = self.manifest.pop(proc_name, None)
+        if not entry:
+            return []
+
+        for filename in entry.get('files', []):
+            try:
+                os.remove(filename)
+            except OSError:
+                log.debug("Couldn't remove %s", filename, exc_info=True)
+        return entry.get('directories', [])
+
+    def _launch(self, programs):
+        """Register programs with SupervisorD and start them
+        """
+        self.launch([programs])
+
+    def launch(self, waves, batch=None):
+        """Launch programs with SupervisorD.
+
+        Every program is registered with the pidantic factory in one pass,
+        then each wave of programs is started with one supervisord config
+        write and reload, one wave at a time. The time spent in each step
+        is kept in launch_timings.
+
+        @param waves: a list of lists of Programs
+        @param batch: when False, register and start each program in turn
+                      instead, with a supervisord reload for each.
+                      Defaults to epuharness.batch_launch
+        @return: a dictionary of pidantic objects, indexed by program name
+        """
+        if batch is None:
+            batch = self.CFG.epuharness.get('batch_launch', True)
+
+        self._write_configs()
+
+        timings = {'programs': 0, 'register': 0.0, 'start': 0.0}
+        pids = {}
+        if batch:
+            began = time.time()
+            for wave in waves:
+                pids.update(self._register(wave))
+            timings['register'] = time.time() - began
+
+            began = time.time()
+            for i, wave in enumerate(waves):
+                log.debug("Starting wave %d of %d: %s", i + 1, len(waves),
+                        ", ".join(program.name for program in wave))
+                self._start_wave(dict((program.name, pids[program.name])
+                    for program in wave))
+            timings['start'] = time.time() - began
+        else:
+            for wave in waves:
+                for program in wave:
+                    began = time.time()
+                    pids.update(self._register([program]))
+                    registered = time.time()
+                    self._start_pid(program.name, pids[program.name])
+                    timings['register'] += registered - began
+                    timings['start'] += time.time() - registered
+
+        timings['programs'] = len(pids)
+        self.launch_timings = timings
+        log.debug("Registered %d programs in %.3fs, started them in %.3fs" % (
+            timings['programs'], timings['register'], timings['start']))
+
+        return pids
+
+    def _register(self, programs):
+        """Register programs with the pidantic factory without starting them
+        """
+        pids = {}
+        for program in programs:
+            log.debug("Registering command '%s'" % program.command)
+            with self.timings.phase("get_pidantic", service=program.name):
+                pids[program.name] = self.factory.get_pidantic(command=program.command,
+                        process_name=program.name, directory=program.directory,
+                        autorestart=program.autorestart)
+        return pids
+
+    def _start_pid(self, name, pid):
+        with self.timings.phase("pid.start", service=name):
+            with self.supd_lock:
+                pid.start()
+
+    def _start_wave(self, pids):
+        """Start programs together, with one supervisord config write and
+        one multicall, rather than pidantic's rewrite and reload of the
+        config for each program
+
+        @param pids: a dictionary of pidantic objects, indexed by name
+        """
+        with self.timings.phase("start_wave", programs=len(pids)):
+            with self.supd_lock:
+                self.supd.start(pids)
+
+    def _program(self, proc_name, service, kind, command, directory=None,
+            autorestart=False, replica=None, node=None):
+        """Describe a program to be launched, and record it in the manifest
+        """
+        if directory is None:
+            directory = self.pidantic_dir
+
+        # The hash covers the command and every config file rendered for the
+        # program, so apply can tell when a program needs restarting
+        entry = self._manifest_entry(proc_name)
+        program_hash = hashlib.sha1(command)
+        for filename in entry['files']:
+            program_hash.update(self._pending_configs.get(filename, ''))
+        entry.update(service=service, type=kind, replica=replica, node=node,
+                command=command, directory=directory, autorestart=autorestart,
+                hash=program_hash.hexdigest())
+        return Program(proc_name, service, kind, command, directory,
+                autorestart, replica, node)
+
     def _start_phantom(self, name, config, users, port=None, exe_name='phantomcherrypy'):
+        self._launch(self._plan_phantom(name, config, users, port=port,
+                exe_name=exe_name))
+
+    def _plan_phantom(self, name, config, users, port=None, exe_name='phantomcherrypy'):
 
         if not port:
             port = 8080
 
         log.info("Starting Phantom '%s'" % name)
-        authz_file = self._build_phantom_authz_file(users)
+        authz_file = self._build_phantom_authz_file(users, name=name)
 
         config_file = self._build_phantom_config(name, self.exchange, config, authz_file)
         cmd = "%s %s %s" % (exe_name, config_file, port)
-        log.debug("Running command '%s'" % cmd)
-        pid = self.factory.get_pidantic(command=cmd, process_name=name,
-                directory=self.pidantic_dir)
-        pid.start()
+        return [self._program(name, name, 'phantom', cmd)]
 
-    def _build_phantom_authz_file(self, users):
+    @timed("build_config")
+    def _build_phantom_authz_file(self, users, name='phantom'):
         """expects a list of user/passwords like:
 
         [
@@ -360,13 +1415,9 @@ class EPUHarness(object):
         for user in users:
             pw_file_contents += "%s\n%s\n" % (user.get('user', ''), user.get('password', ''))
 
-        (os_handle, pw_filename) = tempfile.mkstemp()
-        os.close(os_handle)
-        with open(pw_filename, "w") as pw_f:
-            pw_f.write(pw_file_contents)
-
-        return pw_filename
+        return self._render_config(name, pw_file_contents, suffix=".authz")
 
+    @timed("build_config")
     def _build_phantom_config(self, name, exchange, config, authz_file, logfile=None):
 
         if not logfile:
@@ -376,11 +1427,11 @@ class EPUHarness(object):
             'phantom': {
                 'system': {
                     'type': 'epu',
-                    'broker': 'localhost',
-                    'broker_port': 5672,
+                    'broker': self.amqp_cfg.get('host', 'localhost'),
+                    'broker_port': self.amqp_cfg.get('port', 5672),
                     'broker_ssl': 'False',
-                    'rabbit_user': 'guest',
-                    'rabbit_pw': 'guest',
+                    'rabbit_user': self.amqp_cfg.get('username', 'guest'),
+                    'rabbit_pw': self.amqp_cfg.get('password', 'guest'),
                     'rabbit_exchange': exchange
                 },
                 'authz': {
@@ -392,14 +1443,7 @@ class EPUHarness(object):
 
         merged_config = dict_merge(default, config)
 
-        config_yaml = yaml.dump(merged_config)
-
-        (os_handle, config_filename) = tempfile.mkstemp(suffix='.yml')
-        os.close(os_handle)
-        with open(config_filename, "w") as config_f:
-            config_f.write(config_yaml)
-
-        return config_filename
+        return self._render_config(name, merged_config)
 
     def _start_epum(self, name, config,
             exe_name="epu-management-service"):
@@ -408,20 +1452,24 @@ class EPUHarness(object):
         @param name: name of epum to start
         @param config: an epum config
         """
+        self._launch(self._plan_epum(name, config, exe_name=exe_name))
+
+    def _plan_epum(self, name, config, exe_name="epu-management-service"):
 
         log.info("Starting EPUM '%s'" % name)
 
+        programs = []
         replica_count = config.get('replica_count', 1)
         for instance in range(0, replica_count):
             proc_name = "%s-%s" % (name, instance)
             config_file = self._build_epum_config(name, self.exchange, config, instance=instance, proc_name=proc_name)
 
             cmd = "%s %s" % (exe_name, config_file)
-            log.debug("Running command '%s'" % cmd)
-            pid = self.factory.get_pidantic(command=cmd, process_name=proc_name,
-                    directory=self.pidantic_dir)
-            pid.start()
+            programs.append(self._program(proc_name, name, 'epum', cmd,
+                    replica=instance))
+        return programs
 
+    @timed("build_config")
     def _build_epum_config(self, name, exchange, config, logfile=None, instance=None, proc_name=None):
 
         if instance:
@@ -434,9 +1482,7 @@ class EPUHarness(object):
 
         default = {
             'server': {
-                'amqp': {
-                    'exchange': exchange
-                }
+                'amqp': self._amqp_config(exchange),
             },
             'dashi': {
             },
@@ -468,14 +1514,7 @@ class EPUHarness(object):
 
         merged_config = dict_merge(default, config)
 
-        config_yaml = yaml.dump(merged_config)
-
-        (os_handle, config_filename) = tempfile.mkstemp(suffix='.yml')
-        os.close(os_handle)
-        with open(config_filename, "w") as config_f:
-            config_f.write(config_yaml)
-
-        return config_filename
+        return self._render_config(proc_name or name, merged_config)
 
     def _start_provisioner(self, name, config,
             exe_name="epu-provisioner-service"):
@@ -484,9 +1523,13 @@ class EPUHarness(object):
         @param name: name of provisioner to start
         @param config: a provisioner config
         """
+        self._launch(self._plan_provisioner(name, config, exe_name=exe_name))
+
+    def _plan_provisioner(self, name, config, exe_name="epu-provisioner-service"):
 
         log.info("Starting Provisioner '%s'" % name)
 
+        programs = []
         replica_count = config.get('replica_count', 1)
         for instance in range(0, replica_count):
             proc_name = "%s-%s" % (name, instance)
@@ -494,11 +1537,11 @@ class EPUHarness(object):
                 name, self.exchange, config, instance=instance, proc_name=proc_name)
 
             cmd = "%s %s" % (exe_name, config_file)
-            log.debug("Running command '%s'" % cmd)
-            pid = self.factory.get_pidantic(command=cmd, process_name=proc_name,
-                    directory=self.pidantic_dir)
-            pid.start()
+            programs.append(self._program(proc_name, name, 'provisioner', cmd,
+                    replica=instance))
+        return programs
 
+    @timed("build_config")
     def _build_provisioner_config(self, name, exchange, config, logfile=None, instance=None, proc_name=None):
 
         if instance:
@@ -511,9 +1554,7 @@ class EPUHarness(object):
 
         default = {
             'server': {
-                'amqp': {
-                    'exchange': exchange
-                }
+                'amqp': self._amqp_config(exchange),
             },
             'dashi': {
             },
@@ -543,21 +1584,126 @@ class EPUHarness(object):
         if self.sysname:
             default['dashi']['sysname'] = self.sysname
 
+        # Sites on a mock cloud use its driver, pointed at its socket
+        sites = config.get('sites') or {}
+        if any(isinstance(site, dict) and site.get('mock_cloud') for site in sites.itervalues()):
+            config = dict(config, sites=dict(sites))
+            for site_name, site in sites.iteritems():
+                if isinstance(site, dict) and site.get('mock_cloud'):
+                    site = dict(site)
+                    socket_path = self.mock_cloud_socket(site.pop('mock_cloud'))
+                    site['driver_class'] = MOCK_CLOUD_DRIVER
+                    site['driver_kwargs'] = dict(site.get('driver_kwargs') or {},
+                            socket_path=socket_path)
+                    config['sites'][site_name] = site
+
         dt_path = config.get('provisioner', {}).get('dt_path', None)
         if not dt_path:
-            dt_path = tempfile.mkdtemp()
+            dt_path = os.path.join(self.config_dir, "%s.dt" % (proc_name or name))
+            try:
+                os.makedirs(dt_path)
+            except OSError:
+                log.debug("%s already exists. Continuing.", dt_path)
+            self._manifest_entry(proc_name or name)['directories'].append(dt_path)
         default['provisioner']['dt_path'] = dt_path
 
         merged_config = dict_merge(default, config)
 
-        config_yaml = yaml.dump(merged_config)
+        return self._render_config(proc_name or name, merged_config)
+
+    def _amqp_config(self, exchange):
+        """Returns the server.amqp config of a service on exchange, which
+        points at the same broker as the harness
+        """
+        return dict(self.amqp_cfg, exchange=exchange)
+
+    def _plan_broker(self, exe_name="epu-harness-broker"):
+
+        log.info("Starting local broker on port %s" % self.broker_port)
 
-        (os_handle, config_filename) = tempfile.mkstemp(suffix='.yml')
-        os.close(os_handle)
-        with open(config_filename, "w") as config_f:
-            config_f.write(config_yaml)
+        config_file = self._build_broker_config()
+        cmd = "%s %s" % (exe_name, config_file)
+        return [self._program(BROKER_SERVICE, BROKER_SERVICE, 'broker', cmd,
+            autorestart=True)]
 
-        return config_filename
+    @timed("build_config")
+    def _build_broker_config(self, logfile=None):
+        """Builds a yaml config file for the local broker
+
+        @param logfile: the log file for the broker
+        """
+        if not logfile:
+            logfile = os.path.join(self.logdir, "%s.log" % BROKER_SERVICE)
+
+        config = {
+            'broker': {
+                'host': LOCAL_BROKER_HOST,
+                'port': self.broker_port,
+            },
+            'logging': {
+                'loggers': {
+                    'epuharness': {
+                        'level': 'INFO',
+                        'handlers': ['file', 'console']
+                    }
+                },
+                'root': {
+                    'handlers': ['file', 'console']
+                },
+                'handlers': {
+                    'file': {
+                        'filename': logfile,
+                    }
+                }
+            }
+        }
+        return self._render_config(BROKER_SERVICE, config)
+
+    def mock_cloud_socket(self, name):
+        """Returns the Unix socket a mock cloud listens on"""
+        return os.path.join(self.pidantic_dir, "%s.sock" % name)
+
+    def _plan_mock_cloud(self, name, spec, exe_name="epu-harness-mockcloud"):
+
+        log.info("Starting Mock Cloud '%s'" % name)
+
+        config_file = self._build_mock_cloud_config(name, spec)
+        cmd = "%s %s" % (exe_name, config_file)
+        return [self._program(name, name, 'mock-cloud', cmd, autorestart=True)]
+
+    @timed("build_config")
+    def _build_mock_cloud_config(self, name, spec, logfile=None):
+        """Builds a yaml config file for a mock cloud
+
+        @param name: name of the mock cloud
+        @param spec: the mock cloud's section of the deployment
+        @param logfile: the log file for the mock cloud
+        """
+        if not logfile:
+            logfile = os.path.join(self.logdir, "%s.log" % name)
+
+        mockcloud = dict(spec)
+        mockcloud['socket_path'] = self.mock_cloud_socket(name)
+        config = {
+            'mockcloud': mockcloud,
+            'logging': {
+                'loggers': {
+                    'epuharness': {
+                        'level': 'INFO',
+                        'handlers': ['file', 'console']
+                    }
+                },
+                'root': {
+                    'handlers': ['file', 'console']
+                },
+                'handlers': {
+                    'file': {
+                        'filename': logfile,
+                    }
+                }
+            }
+        }
+        return self._render_config(name, config)
 
     def _start_dtrs(self, name, config, exe_name="epu-dtrs"):
         """Starts a dtrs with SupervisorD
@@ -565,20 +1711,24 @@ class EPUHarness(object):
         @param name: name of dtrs to start
         @param config: a dtrs config
         """
+        self._launch(self._plan_dtrs(name, config, exe_name=exe_name))
+
+    def _plan_dtrs(self, name, config, exe_name="epu-dtrs"):
 
         log.info("Starting DTRS '%s'" % name)
 
+        programs = []
         replica_count = config.get('replica_count', 1)
         for instance in range(0, replica_count):
             proc_name = "%s-%s" % (name, instance)
             config_file = self._build_dtrs_config(name, self.exchange, config, instance=instance, proc_name=proc_name)
 
             cmd = "%s %s" % (exe_name, config_file)
-            log.debug("Running command '%s'" % cmd)
-            pid = self.factory.get_pidantic(command=cmd, process_name=proc_name,
-                    directory=self.pidantic_dir)
-            pid.start()
+            programs.append(self._program(proc_name, name, 'dtrs', cmd,
+                    replica=instance))
+        return programs
 
+    @timed("build_config")
     def _build_dtrs_config(self, name, exchange, config, logfile=None, instance=None, proc_name=None):
 
         if instance:
@@ -591,9 +1741,7 @@ class EPUHarness(object):
 
         default = {
             'server': {
-                'amqp': {
-                    'exchange': exchange
-                }
+                'amqp': self._amqp_config(exchange),
             },
             'dashi': {
             },
@@ -625,14 +1773,7 @@ class EPUHarness(object):
 
         merged_config = dict_merge(default, config)
 
-        config_yaml = yaml.dump(merged_config)
-
-        (os_handle, config_filename) = tempfile.mkstemp(suffix='.yml')
-        os.close(os_handle)
-        with open(config_filename, "w") as config_f:
-            config_f.write(config_yaml)
-
-        return config_filename
+        return self._render_config(proc_name or name, merged_config)
 
     def _start_process_dispatcher(self, name, config, logfile=None,
             exe_name="epu-processdispatcher-service"):
@@ -643,24 +1784,31 @@ class EPUHarness(object):
                 Process Dispatcher config file
         @param exe_name: the name of the process dispatcher executable
         """
+        self._launch(self._plan_process_dispatcher(name, config,
+                logfile=logfile, exe_name=exe_name))
+
+    def _plan_process_dispatcher(self, name, config, logfile=None,
+            exe_name="epu-processdispatcher-service"):
 
         log.info("Starting Process Dispatcher '%s'" % name)
 
+        programs = []
         replica_count = config.get('replica_count', 1)
         for instance in range(0, replica_count):
 
+            proc_name = "%s-%s" % (name, instance)
             config_file = self._build_process_dispatcher_config(self.exchange,
-                    name, config, logfile=logfile, instance=instance)
+                    name, config, logfile=logfile, instance=instance,
+                    proc_name=proc_name)
 
-            proc_name = "%s-%s" % (name, instance)
             cmd = "%s %s" % (exe_name, config_file)
-            log.debug("Running command '%s'" % cmd)
-            pid = self.factory.get_pidantic(command=cmd, process_name=proc_name,
-                    directory=self.pidantic_dir)
-            pid.start()
+            programs.append(self._program(proc_name, name, 'process-dispatcher',
+                    cmd, replica=instance))
+        return programs
 
+    @timed("build_config")
     def _build_process_dispatcher_config(self, exchange, name, config,
-            logfile=None, static_resources=True, instance=None):
+            logfile=None, static_resources=True, instance=None, proc_name=None):
         """Builds a yaml config file to feed to the process dispatcher
 
         @param exchange: the AMQP exchange the service should be on
@@ -680,7 +1828,7 @@ class EPUHarness(object):
 
         default = {
             'server': {
-                'amqp': self.amqp_cfg,
+                'amqp': self._amqp_config(exchange),
             },
             'dashi': {
             },
@@ -704,21 +1852,14 @@ class EPUHarness(object):
                 }
             }
         }
-        default['server']['amqp']['exchange'] = exchange
 
         if self.sysname:
             default['dashi']['sysname'] = self.sysname
 
         merged_config = dict_merge(default, config)
 
-        config_yaml = yaml.dump(merged_config)
-
-        (os_handle, config_filename) = tempfile.mkstemp(prefix="%s_" % name, suffix='.yml')
-        os.close(os_handle)
-        with open(config_filename, "w") as config_f:
-            config_f.write(config_yaml)
-
-        return config_filename
+        return self._render_config(proc_name or "%s%s" % (name, instance_tag),
+                merged_config)
 
     def _start_eeagent(self, name, process_dispatcher, node_name, launch_type,
             pyon_directory=None, logfile=None, exe_name="eeagent", slots=None,
@@ -737,6 +1878,15 @@ class EPUHarness(object):
         @param system_name: pyon system name
         @param heartbeat: how often heartbeat is sent
         """
+        self._launch(self._plan_eeagent(name, process_dispatcher, node_name,
+                launch_type, pyon_directory=pyon_directory, logfile=logfile,
+                exe_name=exe_name, slots=slots, system_name=system_name,
+                supd_directory=supd_directory, heartbeat=heartbeat))
+
+    def _plan_eeagent(self, name, process_dispatcher, node_name, launch_type,
+            pyon_directory=None, logfile=None, exe_name="eeagent", slots=None,
+            system_name=None, supd_directory=None, heartbeat=None):
+
         log.info("Starting EEAgent '%s'" % name)
 
         config_file = self._build_eeagent_config(self.exchange, name,
@@ -744,10 +1894,87 @@ class EPUHarness(object):
                 logfile=logfile, slots=slots, supd_directory=supd_directory,
                 system_name=system_name, heartbeat=heartbeat)
         cmd = "%s %s" % (exe_name, config_file)
-        pid = self.factory.get_pidantic(command=cmd, process_name=name,
-                directory=self.pidantic_dir, autorestart=True)
-        pid.start()
+        return [self._program(name, name, 'eeagent', cmd, autorestart=True,
+                node=node_name)]
+
+    def _plan_simulators(self, agents, exe_name="epu-harness-simulator"):
+        """Plan the workers hosting simulated eeagents, which each run their
+        eeagents as greenlets. There are enough workers for about
+        epuharness.simulator_agents_per_worker eeagents each.
+
+        Each eeagent goes to a worker picked by a checksum of its name, so
+        adding or removing eeagents only changes the workers they were on,
+        and apply() leaves the rest running. Changing the number of workers
+        moves most eeagents.
+
+        @param agents: a list of dictionaries describing each simulated eeagent
+        @return: a list of Programs
+        """
+        per_worker = self.CFG.epuharness.get('simulator_agents_per_worker',
+                DEFAULT_AGENTS_PER_WORKER)
+        workers = max(1, (len(agents) + per_worker - 1) // per_worker)
+
+        log.info("Starting %d simulated EEAgents" % len(agents))
+
+        assigned = collections.defaultdict(list)
+        for agent in sorted(agents, key=lambda agent: agent['name']):
+            worker = (zlib.crc32(agent['name']) & 0xffffffff) % workers
+            assigned[worker].append(agent)
+
+        programs = []
+        for worker in sorted(assigned):
+            proc_name = "%s-%s" % (SIMULATOR_SERVICE, worker)
+            worker_agents = assigned[worker]
+            config_file = self._build_simulator_config(proc_name, worker_agents)
+            self._manifest_entry(proc_name)['agents'] = [agent['name']
+                    for agent in worker_agents]
+
+            cmd = "%s %s" % (exe_name, config_file)
+            programs.append(self._program(proc_name, SIMULATOR_SERVICE,
+                    'eeagent-simulator', cmd, autorestart=True, replica=worker))
+        return programs
+
+    @timed("build_config")
+    def _build_simulator_config(self, proc_name, agents):
+        """Builds a yaml config file for a worker hosting simulated eeagents
+
+        @param proc_name: the name of the worker
+        @param agents: a list of dictionaries describing each simulated eeagent
+        """
+        logfile = os.path.join(self.logdir, "%s.log" % proc_name)
+        config = {
+            'server': {
+                'amqp': self._amqp_config(self.exchange),
+            },
+            'dashi': {
+            },
+            'simulator': {
+                'agents': agents,
+            },
+            'logging': {
+                'loggers': {
+                    'epuharness': {
+                        'level': 'INFO',
+                        'handlers': ['file', 'console']
+                    }
+                },
+                'root': {
+                    'handlers': ['file', 'console']
+                },
+                'handlers': {
+                    'file': {
+                        'filename': logfile,
+                    }
+                }
+            }
+        }
 
+        if self.sysname:
+            config['dashi']['sysname'] = self.sysname
+
+        return self._render_config(proc_name, config)
+
+    @timed("build_config")
     def _build_eeagent_config(self, exchange, name, process_dispatcher,
             node_name, launch_type, pyon_directory=None, logfile=None,
             supd_directory=None, slots=None, system_name=None, heartbeat=None):
@@ -791,7 +2018,7 @@ class EPUHarness(object):
 
         config = {
             'server': {
-                'amqp': self.amqp_cfg,
+                'amqp': self._amqp_config(exchange),
             },
             'dashi': {
             },
@@ -827,46 +2054,90 @@ class EPUHarness(object):
                 }
             }
         }
-        config['server']['amqp']['exchange'] = exchange
 
         if self.sysname:
             config['dashi']['sysname'] = self.sysname
 
-        config_yaml = yaml.dump(config)
+        return self._render_config(name, config)
 
-        (os_handle, config_filename) = tempfile.mkstemp(suffix='.yml')
-        os.close(os_handle)
-        with open(config_filename, "w") as config_f:
-            config_f.write(config_yaml)
+    def announce_nodes(self, nodes, state=None):
+        """Announce many nodes to their process dispatchers concurrently.
 
-        return config_filename
+        Returns once every process dispatcher has acknowledged its nodes, or
+        the announcements have run out of retries.
+
+        @param nodes: a list of (node_name, engine, process_dispatcher) tuples
+        @param state: the state to advertise to the pds
+        @return: a list of the names of nodes that weren't acknowledged
+        """
+        pd_ready = collections.defaultdict(gevent.event.Event)
+        greenlets = []
+        for node_name, engine, process_dispatcher in nodes:
+            greenlet = gevent.spawn(self.announce_node, node_name, engine,
+                    process_dispatcher, state=state,
+                    pd_ready=pd_ready[process_dispatcher])
+            greenlets.append((node_name, greenlet))
+
+        gevent.joinall([greenlet for _, greenlet in greenlets])
+
+        unannounced = []
+        for node_name, greenlet in greenlets:
+            # get() re-raises with the greenlet's own traceback
+            if not greenlet.get():
+                unannounced.append(node_name)
+        return unannounced
 
     def announce_node(self, node_name, engine, process_dispatcher,
-            state=None):
+            state=None, pd_ready=None):
         """Announce a node to each process dispatcher.
 
         @param node_name: the name of the node to advertise
         @param engine: the execution engine of the node
         @param process_dispatcher: the pd to announce to
         @param state: the state to advertise to the pd
+        @param pd_ready: an Event that is set once the pd has acknowledged
+                         an announcement. Announcements sharing it retry as
+                         soon as it is set, rather than waiting out their
+                         backoff. Once it is set, they back off as usual
+        @return: True if the pd acknowledged the announcement
         """
         if not state:
             state = InstanceState.RUNNING
+        if pd_ready is None:
+            pd_ready = gevent.event.Event()
 
         pd_client = ProcessDispatcherClient(self.dashi, process_dispatcher)
         log.info("Announcing %s of engine %s is '%s' to %s" % (node_name,
             engine, state, process_dispatcher))
         domain_id = domain_id_from_engine(engine)
         for i in range(1, ADVERTISE_RETRIES):
+            began = time.time()
             try:
                 pd_client.node_state(node_name, domain_id, state)
-                break
+                self.timings.record("announce_node", began, time.time() - began,
+                        service=node_name, attempt=i, acknowledged=True)
+                pd_ready.set()
+                return True
             except timeout:
-                wait_time = i * i  # Exponentially increasing wait
-                log.warning("PD '%s' not available yet. Waiting %ss" % (process_dispatcher, wait_time))
-                time.sleep(2 ** i)
+                self.timings.record("announce_node", began, time.time() - began,
+                        service=node_name, attempt=i, acknowledged=False)
+                # Capped exponential backoff, with jitter so that many nodes
+                # waiting on the same pd don't retry in lockstep
+                wait_time = min(2 ** i, ADVERTISE_MAX_WAIT) * random.uniform(0.5, 1.0)
+                log.warning("PD '%s' not available yet. Waiting up to %.1fs" % (
+                    process_dispatcher, wait_time))
+                if pd_ready.is_set():
+                    gevent.sleep(wait_time)
+                else:
+                    pd_ready.wait(wait_time)
+
+        log.error("PD '%s' never acknowledged node '%s'" % (process_dispatcher, node_name))
+        return False
 
     def _start_pyon_http_gateway(self, name=None, config=None):
+        self._launch(self._plan_pyon_http_gateway(name=name, config=config))
+
+    def _plan_pyon_http_gateway(self, name=None, config=None):
         if name is None:
             name = 'gateway'
         if config is None:
@@ -881,11 +2152,14 @@ class EPUHarness(object):
         pyon_directory = updated_config.get('pyon_directory')
         sysname = updated_config.get('system', {}).get('name')
 
-        self._start_rel(name=name, module=gateway_module, cls=gateway_class,
+        return self._plan_rel(name=name, module=gateway_module, cls=gateway_class,
                 config=updated_config, pyon_directory=pyon_directory,
-                sysname=sysname)
+                sysname=sysname, kind='pyon-http-gateway')
 
     def _start_pyon_process_dispatcher(self, name=None, config=None):
+        self._launch(self._plan_pyon_process_dispatcher(name=name, config=config))
+
+    def _plan_pyon_process_dispatcher(self, name=None, config=None):
         if name is None:
             name = 'process_dispatcher'
         if config is None:
@@ -900,10 +2174,11 @@ class EPUHarness(object):
         pyon_directory = updated_config.get('pyon_directory')
         sysname = updated_config.get('system', {}).get('name')
 
-        self._start_rel(name=name, module=pd_module, cls=pd_class,
+        return self._plan_rel(name=name, module=pd_module, cls=pd_class,
                 config=updated_config, pyon_directory=pyon_directory,
-                sysname=sysname)
+                sysname=sysname, kind='pyon-process-dispatcher')
 
+    @timed("build_config")
     def _build_pyon_pd_config(self, config=None):
         if config is None:
             config = {}
@@ -916,6 +2191,10 @@ class EPUHarness(object):
         return merged_config
 
     def _start_pyon_eeagent(self, name=None, node_name=None, config=None):
+        self._launch(self._plan_pyon_eeagent(name=name, node_name=node_name,
+                config=config))
+
+    def _plan_pyon_eeagent(self, name=None, node_name=None, config=None):
         if name is None:
             name = 'eeagent'
         if node_name is None:
@@ -931,15 +2210,24 @@ class EPUHarness(object):
 
         persistence_directory = updated_config['eeagent']['launch_type'].get('persistence_directory')
         if persistence_directory:
-            os.makedirs(persistence_directory)
+            try:
+                os.makedirs(persistence_directory)
+            except OSError:
+                log.debug("%s already exists. Continuing.", persistence_directory)
+            self._manifest_entry(name)['directories'].append(persistence_directory)
+
+        supd_directory = updated_config['eeagent']['launch_type'].get('supd_directory')
+        if supd_directory and not os.path.exists(supd_directory):
+            os.makedirs(supd_directory)
 
         pyon_directory = updated_config['eeagent']['launch_type'].get('pyon_directory')
         sysname = updated_config.get('system', {}).get('name')
 
-        self._start_rel(name=name, module=eea_module, cls=eea_class,
+        return self._plan_rel(name=name, module=eea_module, cls=eea_class,
                 config=updated_config, pyon_directory=pyon_directory,
-                sysname=sysname)
+                sysname=sysname, kind='pyon-eeagent', node=node_name)
 
+    @timed("build_config")
     def _build_pyon_eeagent_config(self, node_name, config=None):
         if config is None:
             config = {}
@@ -952,7 +2240,8 @@ class EPUHarness(object):
                 'slots': 80,
                 'launch_type': {
                     'name': 'pyon',
-                    'supd_directory': '/tmp/'
+                    'supd_directory': os.path.join(self.pidantic_dir,
+                        "eeagent_%s" % node_name)
                 }
             }
         }
@@ -962,6 +2251,11 @@ class EPUHarness(object):
 
     def _start_rel(self, name=None, module=None, cls=None, config=None,
             pyon_directory=None, sysname=None):
+        self._launch(self._plan_rel(name=name, module=module, cls=cls,
+                config=config, pyon_directory=pyon_directory, sysname=sysname))
+
+    def _plan_rel(self, name=None, module=None, cls=None, config=None,
+            pyon_directory=None, sysname=None, kind='pyon', node=None):
         if name is None or module is None or cls is None:
             msg = "You must provide a name, module and class to start_rel"
             raise HarnessException(msg)
@@ -993,20 +2287,75 @@ class EPUHarness(object):
             ]
 
         }
-        rel_yaml = yaml.dump(rel)
-
-        (os_handle, rel_filename) = tempfile.mkstemp(suffix='.yml')
-        os.close(os_handle)
-        with open(rel_filename, "w") as rel_f:
-            rel_f.write(rel_yaml)
+        rel_filename = self._render_config(name, rel)
 
         pycc_path = os.path.join(pyon_directory, 'bin/pycc')
         cmd = "%s -D --rel %s --noshell" % (pycc_path, rel_filename)
         if sysname is not None:
             cmd = "%s --sysname %s" % (cmd, sysname)
-        pid = self.factory.get_pidantic(command=cmd, process_name=name,
-                directory=pyon_directory, autorestart=True)
-        pid.start()
+        return [self._program(name, name, kind, cmd, directory=pyon_directory,
+                autorestart=True, node=node)]
+
+
+def format_status(row):
+    """Describe one row of a status report in a line
+    """
+    details = []
+    if row.get('pid'):
+        details.append("pid %d" % row['pid'])
+    if row.get('uptime') is not None:
+        details.append("up %ds" % row['uptime'])
+    if row.get('restarts'):
+        details.append("%d restarts" % row['restarts'])
+    if row.get('rss') is not None:
+        details.append("rss %.1fMB" % (row['rss'] / (1024.0 * 1024.0)))
+    if row.get('cpu_percent') is not None:
+        details.append("cpu %.1f%%" % row['cpu_percent'])
+    if details:
+        return "%s is %s (%s)" % (row['name'], row['state'], ", ".join(details))
+    return "%s is %s" % (row['name'], row['state'])
+
+
+def status_changes(previous, report):
+    """Compare two status reports
+
+    @param previous: a dictionary of status rows, indexed by name
+    @param report: a list of status rows, as returned by status_report
+    @return: a list of changes, each a status row with 'previous_state'
+             added. A changed pid with the same state counts as a change
+    """
+    changes = []
+    names = set()
+    for row in report:
+        names.add(row['name'])
+        old = previous.get(row['name'])
+        if old is None or old['state'] != row['state'] or old['pid'] != row['pid']:
+            change = dict(row)
+            change['previous_state'] = old['state'] if old else None
+            changes.append(change)
+    for name in sorted(set(previous) - names):
+        change = dict(previous[name])
+        change.update(state=None, pid=None, previous_state=previous[name]['state'])
+        changes.append(change)
+    return changes
+
+
+def watch_status(status_report, services=None, interval=1.0):
+    """Poll status reports and yield changes as they happen
+
+    The first poll reports every program. Programs which disappear are
+    reported with a state of None.
+
+    @param status_report: a callable like EPUHarness.status_report
+    @param interval: seconds between polls
+    """
+    previous = {}
+    while True:
+        report = status_report(services=services)
+        for change in status_changes(previous, report):
+            yield change
+        previous = dict((row['name'], row) for row in report)
+        gevent.sleep(interval)
 
 
 # dict_merge from: http://appdelegateinc.com/blog/2011/01/12/merge-deeply-nested-dicts-in-python/
@@ -0,0 +1,160 @@
+import math
+
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9, 100)
+
+
+class Histogram(object):
+    """Records a distribution of values, like latencies, in constant memory.
+
+    Like HdrHistogram, values are counted in buckets that are exact for
+    small values and logarithmic above that, so every percentile is
+    accurate to the given number of significant figures however many
+    values are recorded. Values are given in seconds and kept as integers
+    of unit seconds, microseconds by default.
+    """
+
+    def __init__(self, significant_figures=2, unit=1e-6):
+        """
+        @param significant_figures: decimal digits of precision, from 1 to 5
+        @param unit: the smallest value told apart, in seconds
+        """
+        self.significant_figures = significant_figures
+        self.unit = unit
+        # enough exact buckets to tell values apart to the precision asked
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** significant_figures, 2)))
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value < (1 << self.sub_bucket_bits):
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (value >> shift) << shift
+
+    def _bucket_top(self, bucket):
+        """The highest value counted in a bucket"""
+        if bucket < (1 << self.sub_bucket_bits):
+            return bucket
+        shift = bucket.bit_length() - self.sub_bucket_bits
+        return bucket + (1 << shift) - 1
+
+    def record(self, value, count=1):
+        """Record a value, in seconds, count times"""
+        scaled = max(0, int(round(value / self.unit)))
+        bucket = self._bucket(scaled)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values recorded by another histogram with the same unit
+        and precision
+        """
+        for bucket, count in other.buckets.iteritems():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percentile):
+        """Returns the value, in seconds, at or below which percentile
+        percent of the recorded values fall, or None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        target = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(self._bucket_top(bucket) * self.unit, self.max)
+        return self.max
+
+    def percentiles(self, percentiles=DEFAULT_PERCENTILES):
+        """Returns a dictionary of values, indexed by percentile"""
+        return dict((p, self.percentile(p)) for p in percentiles)
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES):
+        """Returns the count, min, mean and max, and each percentile as
+        p50, p99.9 and so on
+        """
+        summary = {'count': self.count, 'min': self.min, 'mean': self.mean,
+                'max': self.max}
+        for p, value in self.percentiles(percentiles).iteritems():
+            summary["p%g" % p] = value
+        return summary
+
+    def format_distribution(self, scale=1000.0, ticks_per_half=5):
+        """Format the percentile distribution in HdrHistogram's text format,
+        which its plotters read. Values are in milliseconds by default.
+
+        @param scale: what to multiply values in seconds by
+        @param ticks_per_half: how many percentiles to report between each
+                               halving of the distance to 100%
+        """
+        lines = ["%12s %14s %10s %14s" % ("Value", "Percentile", "TotalCount",
+            "1/(1-Percentile)"), ""]
+        if self.count:
+            reported = set()
+            percentile = 0.0
+            # percentiles get closer together towards the tail, like 50,
+            # 75, 87.5 and so on, until every value is accounted for
+            while True:
+                value = self.percentile(percentile)
+                total = self._count_at_or_below(value)
+                if total not in reported or percentile == 0.0:
+                    reported.add(total)
+                    fraction = percentile / 100.0
+                    if fraction < 1:
+                        inverse = "%14.2f" % (1 / (1 - fraction))
+                    else:
+                        inverse = ""
+                    lines.append("%12.3f %14.12f %10d %s" % (value * scale,
+                        fraction, total, inverse))
+                if total >= self.count:
+                    break
+                remaining = 100.0 - percentile
+                half = 2 ** int(math.floor(math.log(100.0 / remaining, 2)) + 1)
+                percentile += 100.0 / (half * ticks_per_half)
+                percentile = min(percentile, 100.0)
+        mean = self.mean or 0
+        lines.append("#[Mean    = %12.3f, Max     = %12.3f]" % (mean * scale,
+            (self.max or 0) * scale))
+        lines.append("#[Total count    = %12d]" % self.count)
+        return "\n".join(lines)
+
+    def _count_at_or_below(self, value):
+        scaled = int(round(value / self.unit))
+        return sum(count for bucket, count in self.buckets.iteritems()
+                if bucket <= scaled)
+
+    def to_dict(self):
+        return {'significant_figures': self.significant_figures,
+                'unit': self.unit, 'buckets': self.buckets.items(),
+                'count': self.count, 'total': self.total, 'min': self.min,
+                'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls(significant_figures=d['significant_figures'], unit=d['unit'])
+        histogram.buckets = dict((int(bucket), count) for bucket, count in d['buckets'])
+        histogram.count = d['count']
+        histogram.total = d['total']
+        histogram.min = d['min']
+        histogram.max = d['max']
+        return histogram
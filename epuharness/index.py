@@ -0,0 +1,90 @@
+import yaml
+import collections
+
+from exceptions import HarnessException
+
+# Fields programs can be selected by, as in "type=eeagent"
+FIELDS = ('service', 'type', 'replica', 'node')
+
+
+class InstanceIndex(object):
+    """Indexes the programs started by a harness by name, service, type,
+    replica number and node, so they can be selected without scanning
+    every program.
+
+    Selectors are either a service or program name, like "pd_0" or
+    "pd_0-1", or comma separated field=value conditions which must all
+    match, like "type=eeagent" or "type=eeagent,node=nodeone".
+    """
+
+    def __init__(self):
+        self.programs = {}
+        self._fields = dict((field, collections.defaultdict(set)) for field in FIELDS)
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        index = cls()
+        for name, entry in manifest.iteritems():
+            # nodes are recorded in the manifest, but aren't programs
+            if entry.get('type') == 'node':
+                continue
+            index.add(name, **dict((field, entry.get(field)) for field in FIELDS))
+        return index
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as index_file:
+            programs = yaml.safe_load(index_file) or {}
+        index = cls()
+        for name, fields in programs.iteritems():
+            index.add(name, **fields)
+        return index
+
+    def save(self, path):
+        with open(path, "w") as index_file:
+            index_file.write(yaml.safe_dump(self.programs))
+
+    def add(self, name, service=None, type=None, replica=None, node=None):
+        self.remove(name)
+        fields = {'service': service, 'type': type, 'replica': replica, 'node': node}
+        self.programs[name] = fields
+        for field, value in fields.iteritems():
+            if value is not None:
+                self._fields[field][str(value)].add(name)
+
+    def remove(self, name):
+        fields = self.programs.pop(name, None)
+        if not fields:
+            return
+        for field, value in fields.iteritems():
+            if value is not None:
+                names = self._fields[field][str(value)]
+                names.discard(name)
+                if not names:
+                    del self._fields[field][str(value)]
+
+    def lookup(self, selector):
+        """Returns the set of program names matching one selector"""
+        if '=' not in selector:
+            names = set(self._fields['service'].get(selector, ()))
+            if selector in self.programs:
+                names.add(selector)
+            return names
+
+        names = None
+        for condition in selector.split(','):
+            field, _, value = condition.partition('=')
+            field = field.strip()
+            if field not in self._fields:
+                msg = "Can't select by '%s'. Use one of %s" % (field, ", ".join(FIELDS))
+                raise HarnessException(msg)
+            matches = self._fields[field].get(value.strip(), set())
+            names = set(matches) if names is None else names & matches
+        return names
+
+    def select(self, selectors):
+        """Returns the set of program names matching any of selectors"""
+        names = set()
+        for selector in selectors:
+            names |= self.lookup(selector)
+        return names
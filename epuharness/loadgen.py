@@ -0,0 +1,296 @@
+import sys
+import json
+import time
+import uuid
+import logging
+import argparse
+import itertools
+
+import gevent
+import gevent.event
+
+from epu.states import ProcessState
+from epu.dashiproc.processdispatcher import ProcessDispatcherClient
+
+from histogram import Histogram
+
+log = logging.getLogger(__name__)
+
+ERROR_RETURN = 1
+
+DEFINITION_ID = "epuharness-loadgen"
+# The process each scheduled process runs. It is terminated after its
+# lifetime, so it only needs to keep running until then
+EXECUTABLE = {'exec': '/bin/sleep', 'argv': ['86400']}
+
+# States in which a scheduled process has got as far as running
+STARTED_STATES = (ProcessState.RUNNING, ProcessState.EXITED)
+FAILED_STATES = (ProcessState.FAILED, ProcessState.REJECTED)
+
+
+def pd_clients(clients):
+    """Pick the process dispatcher clients out of the clients returned by
+    TestFixture.get_clients
+    """
+    return dict((name, client) for name, client in clients.iteritems()
+            if isinstance(client, ProcessDispatcherClient))
+
+
+class LoadGenerator(object):
+    """Schedules and terminates processes on process dispatchers at a steady
+    rate, and measures how long each takes to reach RUNNING.
+
+    Processes are scheduled open-loop at rate per second, spread over the
+    process dispatchers in turn, with at most concurrency alive at once.
+    Each process dispatcher's processes are polled with one
+    describe_processes call every poll_interval, so latencies are measured
+    to within that interval.
+    """
+
+    def __init__(self, clients, rate=10.0, concurrency=100, count=None,
+            duration=None, lifetime=0, timeout=60, poll_interval=0.1,
+            execution_engine_id=None, executable=None):
+        """
+        @param clients: ProcessDispatcherClients, indexed by name
+        @param rate: processes to schedule each second
+        @param concurrency: the most processes alive at once
+        @param count: stop after scheduling this many processes
+        @param duration: stop scheduling after this many seconds
+        @param lifetime: seconds to leave each process running before
+                         terminating it
+        @param timeout: seconds to wait for a process to start before
+                        counting it as timed out
+        @param poll_interval: seconds between polls of each process dispatcher
+        @param execution_engine_id: the engine to schedule processes on
+        @param executable: the executable of the process definition
+        """
+        if not clients:
+            raise ValueError("A load generator needs at least one process dispatcher")
+        if count is None and duration is None:
+            raise ValueError("Give a load generator a count or a duration")
+
+        self.clients = clients
+        self.rate = rate
+        self.concurrency = concurrency
+        self.count = count
+        self.duration = duration
+        self.lifetime = lifetime
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.execution_engine_id = execution_engine_id
+        self.executable = executable or EXECUTABLE
+
+        self.latency = Histogram()
+        self.schedule_latency = Histogram()
+        self.counts = dict((name, {'scheduled': 0, 'started': 0, 'failed': 0,
+            'timed_out': 0, 'errors': 0}) for name in clients)
+        self.throttled = 0
+
+        # processes waiting to start: upid -> (pd name, time scheduled)
+        self.pending = {}
+        self.alive = 0
+        self._slot_freed = gevent.event.Event()
+        self._scheduling = []
+        self._greenlets = []
+
+    def _pick_pd(self):
+        return self._pd_cycle.next()
+
+    def run(self):
+        """Generate load until count processes are scheduled or duration
+        passes, then wait for the last processes to start or time out
+
+        @return: a report, as from report()
+        """
+        self._pd_cycle = itertools.cycle(sorted(self.clients))
+        for client in self.clients.itervalues():
+            client.create_definition(DEFINITION_ID, "supd", self.executable,
+                    name=DEFINITION_ID, description="epu-harness load generator")
+
+        self.started = time.time()
+        pollers = [gevent.spawn(self._poll, name) for name in sorted(self.clients)]
+        try:
+            self._schedule_all()
+            # The last processes may not have been added to pending yet
+            gevent.joinall(self._scheduling)
+            while self.pending:
+                gevent.sleep(self.poll_interval)
+        finally:
+            gevent.killall(pollers)
+        gevent.joinall(self._scheduling + self._greenlets)
+        self.finished = time.time()
+        return self.report()
+
+    def _schedule_all(self):
+        scheduled = 0
+        next_time = self.started
+        interval = 1.0 / self.rate
+        while True:
+            if self.count is not None and scheduled >= self.count:
+                break
+            if self.duration is not None and time.time() - self.started >= self.duration:
+                break
+
+            while self.alive >= self.concurrency:
+                self.throttled += 1
+                self._slot_freed.clear()
+                self._slot_freed.wait()
+
+            # Keep to the rate on average, rather than sleeping a fixed
+            # interval after each call, which would drift as calls slow down
+            delay = next_time - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+            next_time += interval
+
+            self._scheduling.append(gevent.spawn(self._schedule, self._pick_pd()))
+            scheduled += 1
+
+    def _schedule(self, pd_name):
+        client = self.clients[pd_name]
+        upid = "loadgen-%s" % uuid.uuid4().hex
+        self.alive += 1
+        began = time.time()
+        self.pending[upid] = (pd_name, began)
+        try:
+            client.schedule_process(upid, DEFINITION_ID,
+                    execution_engine_id=self.execution_engine_id)
+        except Exception:
+            log.exception("Couldn't schedule %s on %s" % (upid, pd_name))
+            self.pending.pop(upid, None)
+            self.counts[pd_name]['errors'] += 1
+            self._release()
+            return
+        self.schedule_latency.record(time.time() - began)
+        self.counts[pd_name]['scheduled'] += 1
+
+    def _release(self):
+        self.alive -= 1
+        self._slot_freed.set()
+
+    def _poll(self, pd_name):
+        client = self.clients[pd_name]
+        while True:
+            gevent.sleep(self.poll_interval)
+            try:
+                processes = client.describe_processes()
+            except Exception:
+                # Keep polling, or this pd's processes would never start or
+                # time out, and run() would wait for them forever
+                log.exception("Couldn't describe the processes of %s" % pd_name)
+                continue
+
+            now = time.time()
+            states = dict((process['upid'], process['state']) for process in processes)
+            for upid, (name, began) in self.pending.items():
+                if name != pd_name:
+                    continue
+                state = states.get(upid)
+                if state in STARTED_STATES:
+                    self.latency.record(now - began)
+                    self.counts[pd_name]['started'] += 1
+                    self._finish(upid, delay=self.lifetime)
+                elif state in FAILED_STATES:
+                    self.counts[pd_name]['failed'] += 1
+                    self._finish(upid)
+                elif now - began > self.timeout:
+                    self.counts[pd_name]['timed_out'] += 1
+                    self._finish(upid)
+
+    def _finish(self, upid, delay=0):
+        pd_name, _ = self.pending.pop(upid)
+        self._greenlets.append(gevent.spawn_later(delay, self._terminate,
+            pd_name, upid))
+
+    def _terminate(self, pd_name, upid):
+        try:
+            self.clients[pd_name].terminate_process(upid)
+        except Exception:
+            log.exception("Couldn't terminate %s on %s" % (upid, pd_name))
+        finally:
+            self._release()
+
+    def report(self):
+        """Returns the counts for each process dispatcher, the
+        schedule-to-RUNNING latency percentiles, and throughput in
+        processes started per second
+        """
+        elapsed = (getattr(self, 'finished', None) or time.time()) - self.started
+        totals = {}
+        for counts in self.counts.itervalues():
+            for key, value in counts.iteritems():
+                totals[key] = totals.get(key, 0) + value
+        return {
+            'process_dispatchers': self.counts,
+            'totals': totals,
+            'rate': self.rate,
+            'concurrency': self.concurrency,
+            'elapsed': elapsed,
+            'throughput': totals['started'] / elapsed if elapsed > 0 else None,
+            'throttled': self.throttled,
+            'latency': self.latency.summary(),
+            'schedule_latency': self.schedule_latency.summary(),
+        }
+
+
+def main(argv=None):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+    from harness import EPUHarness
+    from fixture import TestFixture
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not argv:
+        argv = list(sys.argv)
+    argv.pop(0)
+
+    parser = argparse.ArgumentParser("Generate load on the process dispatchers of a deployment")
+    parser.add_argument('deployment', help='the deployment file the harness started')
+    parser.add_argument('-x', '--exchange', default=None)
+    parser.add_argument('--rate', type=float, default=10.0,
+            help='processes to schedule each second')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+            help='the most processes alive at once')
+    parser.add_argument('-n', '--count', type=int, default=None,
+            help='processes to schedule')
+    parser.add_argument('--duration', type=float, default=None,
+            help='seconds to schedule processes for')
+    parser.add_argument('--lifetime', type=float, default=0,
+            help='seconds to leave each process running')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--engine', default=None, help='execution engine to use')
+    parser.add_argument('-o', '--output', metavar='JSON_FILE', default=None)
+    parser.add_argument('--histogram', metavar='HGRM_FILE', default=None,
+            help='write the latency distribution in HdrHistogram format')
+    args = parser.parse_args(argv)
+
+    if args.count is None and args.duration is None:
+        parser.error("give a --count or a --duration")
+
+    with open(args.deployment) as deployment_file:
+        deployment_str = deployment_file.read()
+
+    harness = EPUHarness(exchange=args.exchange)
+    clients = pd_clients(TestFixture().get_clients(deployment_str, harness.dashi))
+    generator = LoadGenerator(clients, rate=args.rate,
+            concurrency=args.concurrency, count=args.count,
+            duration=args.duration, lifetime=args.lifetime,
+            timeout=args.timeout, execution_engine_id=args.engine)
+    report = generator.run()
+
+    latency = report['latency']
+    log.info("Started %d of %d processes at %.1f/s. Latency p50 %s, p99 %s, max %s" % (
+        report['totals']['started'], report['totals']['scheduled'],
+        report['throughput'] or 0, latency['p50'], latency['p99'], latency['max']))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.histogram:
+        with open(args.histogram, "w") as output:
+            output.write(generator.latency.format_distribution() + "\n")
+
+    if report['totals']['started'] < report['totals']['scheduled']:
+        return ERROR_RETURN
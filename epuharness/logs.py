@@ -0,0 +1,297 @@
+import os
+import re
+import gzip
+import time
+import heapq
+import logging
+
+import gevent
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from exceptions import HarnessException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LOG_INTERVAL = 1.0
+READ_SIZE = 1024 * 1024
+
+COMPRESSIONS = (None, 'gzip', 'zstd')
+
+# Python logging's default asctime, eg 2012-05-01 16:20:01,123
+TIMESTAMP = re.compile(r'^(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})(?:[,.](\d{1,6}))?')
+
+
+def parse_timestamp(line):
+    """Returns the time a log line was written, as seconds since the epoch,
+    or None if the line doesn't start with a timestamp. Timestamps are
+    assumed to be in local time, as logging writes them.
+    """
+    match = TIMESTAMP.match(line)
+    if not match:
+        return None
+    try:
+        parsed = time.strptime(match.group(1).replace('T', ' '), "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    seconds = time.mktime(parsed)
+    if match.group(2):
+        seconds += float("0.%s" % match.group(2))
+    return seconds
+
+
+def log_source(path):
+    """Name a log stream after its file"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class LogTail(object):
+    """Reads whatever has been appended to a file since the last read.
+
+    If the file shrinks, it is assumed to have been truncated or replaced,
+    and is read again from the beginning.
+    """
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self._partial = ''
+
+    def read(self, size=READ_SIZE):
+        """Returns up to size new bytes, or '' if there are none
+        """
+        try:
+            current_size = os.path.getsize(self.path)
+        except OSError:
+            return ''
+        if current_size < self.offset:
+            log.debug("%s was truncated, reading it from the start" % self.path)
+            self.offset = 0
+            self._partial = ''
+        if current_size == self.offset:
+            return ''
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size)
+        self.offset += len(data)
+        return data
+
+    def iter_lines(self):
+        """Yields the new complete lines, without line endings. An
+        incomplete last line is held back until it is finished.
+        """
+        # Read a chunk at a time, so big logs aren't held in memory
+        while True:
+            data = self.read()
+            if not data:
+                break
+            lines = (self._partial + data).split('\n')
+            self._partial = lines.pop()
+            for line in lines:
+                yield line
+
+    def read_lines(self):
+        """Returns the new complete lines, as a list
+        """
+        return list(self.iter_lines())
+
+
+class LogStream(object):
+    """A merged, time-ordered stream of the lines in many logfiles.
+
+    Each file is assumed to be in time order already. Lines without a
+    timestamp, like tracebacks, keep the timestamp of the line before them.
+    """
+
+    def __init__(self, get_logfiles, from_start=True):
+        """
+        @param get_logfiles: a callable returning the paths to follow. It is
+                             called on every poll, so new logfiles are found
+        @param from_start: whether to include lines already in the files
+        """
+        self.get_logfiles = get_logfiles
+        self.from_start = from_start
+        self.tails = {}
+        self._last_timestamps = {}
+
+    def _tail(self, path):
+        tail = self.tails.get(path)
+        if tail is None:
+            offset = 0
+            if not self.from_start:
+                try:
+                    offset = os.path.getsize(path)
+                except OSError:
+                    pass
+            tail = self.tails[path] = LogTail(path, offset)
+        return tail
+
+    def _entries(self, path):
+        source = log_source(path)
+        last = self._last_timestamps.get(path, 0)
+        for i, line in enumerate(self._tail(path).iter_lines()):
+            timestamp = parse_timestamp(line)
+            if timestamp is None:
+                timestamp = last
+            last = timestamp
+            self._last_timestamps[path] = last
+            yield (timestamp, source, i, line)
+
+    def iter_poll(self):
+        """Read new lines from every logfile, a chunk of each at a time
+
+        @return: a generator of (timestamp, source, line) tuples, in time
+                 order
+        """
+        per_file = [self._entries(path) for path in self.get_logfiles()]
+        for timestamp, source, i, line in heapq.merge(*per_file):
+            yield (timestamp, source, line)
+
+    def poll(self):
+        """Read new lines from every logfile
+
+        @return: a list of (timestamp, source, line) tuples, in time order
+        """
+        return list(self.iter_poll())
+
+    def follow(self, interval=DEFAULT_LOG_INTERVAL):
+        """Yield (timestamp, source, line) tuples as they are written
+        """
+        while True:
+            for entry in self.iter_poll():
+                yield entry
+            gevent.sleep(interval)
+
+
+class LogCollector(object):
+    """Copies logfiles to a directory as they grow, rather than all at once
+    when the harness stops.
+
+    Copies can be compressed with gzip, or with zstd if the zstandard
+    package is installed, and capped at a number of bytes per logfile.
+    """
+
+    def __init__(self, get_logfiles, output_dir, compression=None,
+            max_bytes=None, interval=DEFAULT_LOG_INTERVAL):
+        """
+        @param get_logfiles: a callable returning the paths to collect
+        @param output_dir: where to write the copies
+        @param compression: None, 'gzip' or 'zstd'
+        @param max_bytes: the most uncompressed bytes to copy from each file
+        @param interval: seconds between passes over the logfiles
+        """
+        if compression not in COMPRESSIONS:
+            raise HarnessException("Unknown log compression '%s'" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise HarnessException("zstd log compression needs the zstandard package")
+
+        self.get_logfiles = get_logfiles
+        self.output_dir = output_dir
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+        self.tails = {}
+        self.destinations = {}
+        self.written = {}
+        self._outputs = {}
+        self._greenlet = None
+
+    def destination(self, path):
+        """Returns where the copy of a logfile is written
+        """
+        destination = self.destinations.get(path)
+        if destination is None:
+            basename = os.path.basename(path)
+            if self.compression == 'gzip':
+                basename += ".gz"
+            elif self.compression == 'zstd':
+                basename += ".zst"
+            destination = os.path.join(self.output_dir, basename)
+
+            # Services and supervisord may use the same log name in
+            # different directories
+            if destination in self.destinations.values():
+                parent = os.path.basename(os.path.dirname(path))
+                destination = os.path.join(self.output_dir, "%s-%s" % (parent, basename))
+            self.destinations[path] = destination
+        return destination
+
+    def _output(self, path):
+        output = self._outputs.get(path)
+        if output is None:
+            destination = self.destination(path)
+            if self.compression == 'gzip':
+                output = gzip.open(destination, 'ab')
+            elif self.compression == 'zstd':
+                raw = open(destination, 'ab')
+                output = zstandard.ZstdCompressor().stream_writer(raw)
+            else:
+                output = open(destination, 'ab')
+            self._outputs[path] = output
+        return output
+
+    def collect(self):
+        """Copy whatever has been written to the logfiles since the last pass
+
+        @return: the number of bytes copied
+        """
+        copied = 0
+        for path in self.get_logfiles():
+            tail = self.tails.get(path)
+            if tail is None:
+                tail = self.tails[path] = LogTail(path)
+                self.written[path] = 0
+
+            while True:
+                size = READ_SIZE
+                if self.max_bytes is not None:
+                    size = min(size, self.max_bytes - self.written[path])
+                    if size <= 0:
+                        break
+                data = tail.read(size)
+                if not data:
+                    break
+                output = self._output(path)
+                output.write(data)
+                self.written[path] += len(data)
+                copied += len(data)
+
+                if self.max_bytes is not None and self.written[path] >= self.max_bytes:
+                    log.warning("%s reached %d bytes, not copying any more of it" % (
+                        path, self.max_bytes))
+                    output.write("\n[epuharness: log truncated at %d bytes]\n" % self.max_bytes)
+
+            output = self._outputs.get(path)
+            if output is not None:
+                output.flush()
+        return copied
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            try:
+                self.collect()
+            except Exception:
+                log.exception("Problem collecting logs")
+            gevent.sleep(self.interval)
+
+    def stop(self):
+        """Stop collecting, after one last pass over the logfiles
+        """
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        try:
+            self.collect()
+        finally:
+            for output in self._outputs.itervalues():
+                output.close()
+            self._outputs = {}
@@ -0,0 +1,189 @@
+import os
+import re
+import sqlite3
+import logging
+
+from logs import LogTail, parse_timestamp, log_source
+
+log = logging.getLogger(__name__)
+
+LEVEL = re.compile(r'\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|FATAL)\b')
+LEVEL_ALIASES = {'WARN': 'WARNING', 'FATAL': 'CRITICAL'}
+
+# Identifiers that tie log lines from different services together
+CORRELATION_IDS = {
+    'upid': re.compile(r'''\bupid['"]?\s*[=:]\s*u?['"]?([\w.-]+)'''),
+    'node_id': re.compile(r'''\bnode_id['"]?\s*[=:]\s*u?['"]?([\w.-]+)'''),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    last_timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lines (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    source TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    level TEXT,
+    line TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ids (
+    line_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lines_by_time ON lines (timestamp);
+CREATE INDEX IF NOT EXISTS lines_by_source ON lines (source, timestamp);
+CREATE INDEX IF NOT EXISTS lines_by_level ON lines (level, timestamp);
+CREATE INDEX IF NOT EXISTS lines_by_path ON lines (path);
+CREATE INDEX IF NOT EXISTS ids_by_value ON ids (name, value);
+"""
+
+
+def parse_level(line):
+    """Returns the log level named in a line, or None"""
+    match = LEVEL.search(line)
+    if not match:
+        return None
+    level = match.group(1)
+    return LEVEL_ALIASES.get(level, level)
+
+
+def parse_ids(line):
+    """Returns a list of (name, value) correlation ids found in a line"""
+    found = []
+    for name, pattern in CORRELATION_IDS.iteritems():
+        for value in pattern.findall(line):
+            found.append((name, value))
+    return found
+
+
+class LogIndex(object):
+    """A sqlite index of log lines, for searching logs by time, service,
+    level and correlation ids without reading the logfiles again.
+
+    The index is updated incrementally: each logfile is read from where the
+    last update stopped.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: the sqlite database file, created if it doesn't exist
+        """
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, logfiles):
+        """Index whatever has been written to logfiles since the last update
+
+        @return: the number of lines added to the index
+        """
+        added = 0
+        with self.db:
+            for path in logfiles:
+                added += self._update_file(path)
+        return added
+
+    def _update_file(self, path):
+        row = self.db.execute("SELECT offset, last_timestamp FROM files WHERE path = ?",
+                (path,)).fetchone()
+        offset, last = row if row else (0, 0.0)
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        if size < offset:
+            # The file was truncated or replaced, so start it over
+            log.debug("Reindexing %s" % path)
+            self._forget(path)
+            offset, last = 0, 0.0
+
+        tail = LogTail(path, offset)
+        source = log_source(path)
+        partial = ''
+        added = 0
+        # Read a chunk at a time, so big logs aren't held in memory
+        while True:
+            data = tail.read()
+            if not data:
+                break
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                line = line.decode('utf-8', 'replace')
+                timestamp = parse_timestamp(line)
+                if timestamp is None:
+                    timestamp = last
+                last = timestamp
+                cursor = self.db.execute("INSERT INTO lines (path, source, timestamp, level, line) "
+                        "VALUES (?, ?, ?, ?, ?)", (path, source, timestamp, parse_level(line), line))
+                ids = parse_ids(line)
+                if ids:
+                    self.db.executemany("INSERT INTO ids (line_id, name, value) VALUES (?, ?, ?)",
+                            [(cursor.lastrowid, name, value) for name, value in ids])
+            added += len(lines)
+
+        # An unfinished last line is left to be indexed when it's complete
+        offset = tail.offset - len(partial)
+        self.db.execute("INSERT OR REPLACE INTO files (path, offset, last_timestamp) "
+                "VALUES (?, ?, ?)", (path, offset, last))
+        return added
+
+    def _forget(self, path):
+        self.db.execute("DELETE FROM ids WHERE line_id IN "
+                "(SELECT id FROM lines WHERE path = ?)", (path,))
+        self.db.execute("DELETE FROM lines WHERE path = ?", (path,))
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def search(self, sources=None, levels=None, start=None, end=None,
+            text=None, ids=None, limit=None):
+        """Find indexed log lines
+
+        @param sources: names of logs to search, as given by log_source
+        @param levels: log levels to match, like ['ERROR', 'CRITICAL']
+        @param start: earliest timestamp, in seconds since the epoch
+        @param end: latest timestamp, in seconds since the epoch
+        @param text: a substring lines must contain, ignoring case
+        @param ids: a dictionary of correlation ids lines must mention, like
+                    {'upid': 'abc'}
+        @param limit: the most lines to return
+        @return: a list of (timestamp, source, line) tuples, in time order
+        """
+        conditions = []
+        params = []
+        if sources is not None:
+            conditions.append("source IN (%s)" % ", ".join("?" * len(sources)))
+            params.extend(sources)
+        if levels:
+            levels = [LEVEL_ALIASES.get(level.upper(), level.upper()) for level in levels]
+            conditions.append("level IN (%s)" % ", ".join("?" * len(levels)))
+            params.extend(levels)
+        if start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("timestamp <= ?")
+            params.append(end)
+        if text:
+            conditions.append("line LIKE ? ESCAPE '\\'")
+            params.append("%%%s%%" % re.sub(r'([\\%_])', r'\\\1', text))
+        for name, value in sorted((ids or {}).iteritems()):
+            conditions.append("id IN (SELECT line_id FROM ids WHERE name = ? AND value = ?)")
+            params.extend([name, value])
+
+        query = "SELECT timestamp, source, line FROM lines"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY timestamp, id"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self.db.execute(query, params).fetchall()
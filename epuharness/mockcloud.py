@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import random
+import logging
+
+import gevent
+import dashi.bootstrap as bootstrap
+
+from libcloud.compute.base import Node, NodeDriver, NodeImage, NodeSize
+from libcloud.compute.types import NodeState
+
+from daemon import SocketServer, SocketClient
+from util import sample_latency
+
+log = logging.getLogger(__name__)
+
+DRIVER_CLASS = "epuharness.mockcloud.MockCloudNodeDriver"
+
+PENDING = 'pending'
+RUNNING = 'running'
+TERMINATING = 'terminating'
+TERMINATED = 'terminated'
+ERROR = 'error'
+
+NODE_STATES = {
+    PENDING: NodeState.PENDING,
+    RUNNING: NodeState.RUNNING,
+    TERMINATING: NodeState.PENDING,
+    TERMINATED: NodeState.TERMINATED,
+    ERROR: NodeState.UNKNOWN,
+}
+
+
+class MockCloud(object):
+    """An in-memory IaaS cloud, which makes VMs that only exist as records.
+
+    VMs boot after a delay drawn from boot_latency, and fail to boot at
+    failure_rate. States are worked out from timestamps when VMs are
+    described, so thousands of VMs cost nothing while nobody is looking.
+    The cloud can be saved to a JSON snapshot and restored from it.
+    """
+
+    def __init__(self, boot_latency=None, terminate_latency=None,
+            failure_rate=0.0, seed=None, clock=time.time):
+        """
+        @param boot_latency: how long VMs take to boot, as accepted by
+                             util.sample_latency
+        @param terminate_latency: how long VMs take to terminate
+        @param failure_rate: the chance, from 0 to 1, a VM fails to boot
+        @param seed: seeds boot latencies and failures, to repeat a run
+        @param clock: returns the current time
+        """
+        self.boot_latency = boot_latency
+        self.terminate_latency = terminate_latency
+        self.failure_rate = failure_rate or 0.0
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.nodes = {}
+        self.counts = {'created': 0, 'destroyed': 0, 'failed': 0}
+        self._addresses = 0
+        self._launches = 0
+
+    def _next_address(self):
+        self._addresses += 1
+        return "10.%d.%d.%d" % ((self._addresses >> 16) & 255,
+                (self._addresses >> 8) & 255, self._addresses & 255)
+
+    def _refresh(self, node, now):
+        if node['state'] == PENDING and now >= node['ready_at']:
+            if node['fails']:
+                node['state'] = ERROR
+                self.counts['failed'] += 1
+            else:
+                node['state'] = RUNNING
+        elif node['state'] == TERMINATING and now >= node['terminated_at']:
+            node['state'] = TERMINATED
+        return node
+
+    def create_nodes(self, name, image=None, size=None, count=1, extra=None):
+        """Start count VMs
+
+        @return: a list of the new VMs
+        """
+        now = self.clock()
+        created = []
+        for i in range(count):
+            node_id = "i-%s" % uuid.uuid4().hex[:8]
+            self._launches += 1
+            node = {
+                'id': node_id,
+                'launch_index': self._launches,
+                'name': name,
+                'image': image,
+                'size': size,
+                'state': PENDING,
+                'created_at': now,
+                'ready_at': now + sample_latency(self.boot_latency, self.rng),
+                'terminated_at': None,
+                'fails': self.rng.random() < self.failure_rate,
+                'public_ip': self._next_address(),
+                'private_ip': self._next_address(),
+                'extra': extra or {},
+            }
+            self.nodes[node_id] = node
+            created.append(self._refresh(node, now))
+        self.counts['created'] += count
+        return created
+
+    def describe_nodes(self, ids=None, states=None):
+        """Describe many VMs at once
+
+        @param ids: the ids of VMs to describe. Defaults to every VM
+        @param states: if given, only describe VMs in these states
+        @return: a list of VMs, in the order they were created
+        """
+        now = self.clock()
+        if ids is None:
+            nodes = self.nodes.values()
+        else:
+            nodes = [self.nodes[node_id] for node_id in ids if node_id in self.nodes]
+        nodes = [self._refresh(node, now) for node in nodes]
+        if states is not None:
+            nodes = [node for node in nodes if node['state'] in states]
+        return sorted(nodes, key=lambda node: node['launch_index'])
+
+    def destroy_nodes(self, ids):
+        """Terminate VMs
+
+        @return: the ids of the VMs that were terminated
+        """
+        now = self.clock()
+        destroyed = []
+        for node_id in ids:
+            node = self.nodes.get(node_id)
+            if node is None or node['state'] in (TERMINATING, TERMINATED):
+                continue
+            node['state'] = TERMINATING
+            node['terminated_at'] = now + sample_latency(self.terminate_latency, self.rng)
+            self._refresh(node, now)
+            destroyed.append(node_id)
+        self.counts['destroyed'] += len(destroyed)
+        return destroyed
+
+    def stats(self):
+        """Returns the number of VMs in each state, and how many have been
+        created, destroyed and failed
+        """
+        states = dict((state, 0) for state in NODE_STATES)
+        for node in self.describe_nodes():
+            states[node['state']] += 1
+        return dict(self.counts, states=states, nodes=len(self.nodes))
+
+    def reset(self):
+        """Forget every VM"""
+        self.nodes = {}
+        self.counts = {'created': 0, 'destroyed': 0, 'failed': 0}
+
+    def snapshot(self, path):
+        """Save every VM to a JSON file. The file is replaced atomically, so
+        a crash never leaves half a snapshot
+        """
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "w") as f:
+            json.dump({'nodes': self.nodes, 'counts': self.counts,
+                'addresses': self._addresses, 'launches': self._launches}, f)
+        os.rename(tmp_path, path)
+
+    def restore(self, path):
+        with open(path) as f:
+            snapshot = json.load(f)
+        self.nodes = dict((str(node_id), node) for node_id, node in
+                snapshot['nodes'].iteritems())
+        self.counts = snapshot['counts']
+        self._addresses = snapshot['addresses']
+        self._launches = snapshot['launches']
+
+
+class MockCloudServer(SocketServer):
+    """Serves a MockCloud over a local Unix socket, so the provisioners and
+    tests of a deployment all see the same VMs
+    """
+
+    name = "epu-harness mock cloud"
+
+    def __init__(self, cloud, socket_path, snapshot_path=None,
+            snapshot_interval=None):
+        """
+        @param cloud: the MockCloud to serve
+        @param socket_path: where to listen
+        @param snapshot_path: a file to restore the cloud from, if it
+                              exists, and to save it to when stopped
+        @param snapshot_interval: seconds between snapshots while serving
+        """
+        self.cloud = cloud
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._snapshotter = None
+        SocketServer.__init__(self, socket_path, {
+            'ping': lambda: 'pong',
+            'create_nodes': cloud.create_nodes,
+            'describe_nodes': cloud.describe_nodes,
+            'destroy_nodes': cloud.destroy_nodes,
+            'stats': cloud.stats,
+            'reset': cloud.reset,
+            'snapshot': self.snapshot,
+            'shutdown': self._shutdown,
+        })
+
+    def serve_forever(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            self.cloud.restore(self.snapshot_path)
+            log.info("Restored %d VMs from %s" % (len(self.cloud.nodes),
+                self.snapshot_path))
+        if self.snapshot_path and self.snapshot_interval:
+            self._snapshotter = gevent.spawn(self._snapshot_loop)
+        SocketServer.serve_forever(self)
+
+    def snapshot(self):
+        if self.snapshot_path:
+            self.cloud.snapshot(self.snapshot_path)
+        return self.snapshot_path
+
+    def _snapshot_loop(self):
+        while True:
+            gevent.sleep(self.snapshot_interval)
+            try:
+                self.snapshot()
+            except Exception:
+                log.exception("Problem saving mock cloud snapshot")
+
+    def _cleanup(self):
+        if self._snapshotter is not None:
+            self._snapshotter.kill()
+            self._snapshotter = None
+        try:
+            self.snapshot()
+        finally:
+            SocketServer._cleanup(self)
+
+
+class MockCloudClient(SocketClient):
+    """Talks to a MockCloudServer"""
+
+    def create_nodes(self, name, image=None, size=None, count=1, extra=None):
+        return self.call('create_nodes', name=name, image=image, size=size,
+                count=count, extra=extra)
+
+    def describe_nodes(self, ids=None, states=None):
+        return self.call('describe_nodes', ids=ids, states=states)
+
+    def destroy_nodes(self, ids):
+        return self.call('destroy_nodes', ids=ids)
+
+    def stats(self):
+        return self.call('stats')
+
+    def reset(self):
+        return self.call('reset')
+
+    def snapshot(self):
+        return self.call('snapshot')
+
+
+class MockCloudNodeDriver(NodeDriver):
+    """A libcloud driver for a mock cloud served by the harness. Give it to
+    a provisioner site as:
+
+        driver_class: epuharness.mockcloud.MockCloudNodeDriver
+        driver_kwargs:
+          socket_path: /path/to/mockcloud.sock
+    """
+
+    name = "epuharness mock cloud"
+    type = "mock-cloud"
+
+    # The fixture removes the sqlite database of EPU's mock driver
+    sqlite_db = None
+
+    def __init__(self, socket_path=None, **kwargs):
+        self.client = MockCloudClient(socket_path)
+
+    def _to_node(self, node):
+        return Node(id=node['id'], name=node['name'],
+                state=NODE_STATES[node['state']],
+                public_ips=[node['public_ip']], private_ips=[node['private_ip']],
+                driver=self, extra=node['extra'])
+
+    def create_node(self, **kwargs):
+        image = kwargs.get('image')
+        size = kwargs.get('size')
+        count = kwargs.get('ex_mincount') or 1
+        nodes = self.client.create_nodes(kwargs.get('name'),
+                image=image.id if image else None, size=size.id if size else None,
+                count=int(count))
+        nodes = [self._to_node(node) for node in nodes]
+        if len(nodes) == 1:
+            return nodes[0]
+        return nodes
+
+    def list_nodes(self, ex_node_ids=None):
+        return [self._to_node(node) for node in
+                self.client.describe_nodes(ids=ex_node_ids)]
+
+    def destroy_node(self, node):
+        return bool(self.client.destroy_nodes([node.id]))
+
+    def list_images(self, location=None):
+        return [NodeImage(id="mock-image", name="mock-image", driver=self)]
+
+    def list_sizes(self, location=None):
+        return [NodeSize(id="mock-size", name="mock-size", ram=1024, disk=10,
+            bandwidth=None, price=0, driver=self)]
+
+    def list_locations(self):
+        return []
+
+    def shutdown(self):
+        self.client.close()
+
+
+def main(argv=None):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+    if not argv:
+        argv = list(sys.argv)
+    if len(argv) != 2:
+        print >>sys.stderr, "usage: %s CONFIG_FILE" % argv[0]
+        return 1
+
+    CFG = bootstrap.configure([argv[1]])
+    config = CFG.mockcloud
+    cloud = MockCloud(boot_latency=config.get('boot_latency'),
+            terminate_latency=config.get('terminate_latency'),
+            failure_rate=config.get('failure_rate'), seed=config.get('seed'))
+    server = MockCloudServer(cloud, config.socket_path,
+            snapshot_path=config.get('snapshot'),
+            snapshot_interval=config.get('snapshot_interval'))
+    # supervisord stops programs with SIGTERM. Stopping the server lets it
+    # save a last snapshot and remove its socket
+    gevent.signal(signal.SIGTERM, server.stop)
+    server.serve_forever()
@@ -0,0 +1,159 @@
+import json
+import time
+import logging
+import collections
+
+import gevent
+
+import procstat
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5
+DEFAULT_SAMPLES = 720
+
+# Resource use of one service's process trees at one time. cpu_time is
+# cumulative, in seconds; rss is in bytes
+Sample = collections.namedtuple('Sample', ['time', 'cpu_time', 'rss', 'fds',
+    'threads', 'processes'])
+
+
+class ResourceMonitor(object):
+    """Samples CPU, memory, file descriptor and thread use of the programs
+    an EPUHarness is running, including any processes they fork.
+
+    Samples are kept per service in a ring buffer, so memory use is bounded
+    however long the monitor runs.
+    """
+
+    def __init__(self, harness, interval=None, samples=None):
+        """
+        @param harness: the EPUHarness whose programs to monitor
+        @param interval: seconds between samples
+        @param samples: how many samples to keep for each service
+        """
+        self.harness = harness
+        if interval is None:
+            interval = harness.CFG.epuharness.get('monitor_interval') or DEFAULT_INTERVAL
+        if samples is None:
+            samples = harness.CFG.epuharness.get('monitor_samples', DEFAULT_SAMPLES)
+        self.interval = interval
+        self.max_samples = samples
+        self.samples = {}
+        self._greenlet = None
+
+    @property
+    def running(self):
+        return self._greenlet is not None and not self._greenlet.ready()
+
+    def start(self):
+        if not self.running:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception:
+                log.exception("Problem sampling resource use")
+            gevent.sleep(self.interval)
+
+    def sample(self):
+        """Take one sample of every service's resource use
+
+        @return: the new samples, indexed by service
+        """
+        process_info = self.harness._process_info()
+        now = time.time()
+        processes = procstat.read_all_processes()
+
+        totals = {}
+        for name, info in process_info.iteritems():
+            service = self.harness.manifest.get(name, {}).get('service', name)
+            total = totals.setdefault(service, [0.0, 0, 0, 0, 0])
+            for pid in procstat.process_tree(info.get('pid') or 0, processes):
+                stats = processes[pid]
+                total[0] += stats['cpu_time']
+                total[1] += stats['rss']
+                total[2] += procstat.count_fds(pid) or 0
+                total[3] += stats['threads']
+                total[4] += 1
+
+        new_samples = {}
+        for service, total in totals.iteritems():
+            sample = Sample(now, *total)
+            buf = self.samples.get(service)
+            if buf is None:
+                buf = self.samples[service] = collections.deque(maxlen=self.max_samples)
+            buf.append(sample)
+            new_samples[service] = sample
+        return new_samples
+
+    def stats(self, services=None):
+        """Summarize the resource use of services
+
+        @param services: names of services to summarize. Defaults to all
+        @return: a dictionary of stats, indexed by service. cpu_percent is
+                 measured between the last two samples, so it is None until
+                 there have been two
+        """
+        if services is None:
+            services = self.samples.keys()
+
+        stats = {}
+        for service in services:
+            buf = self.samples.get(service)
+            if not buf:
+                continue
+            last = buf[-1]
+            cpu_percent = None
+            if len(buf) > 1:
+                previous = buf[-2]
+                elapsed = last.time - previous.time
+                if elapsed > 0:
+                    # cpu_time drops when a child process exits
+                    used = max(last.cpu_time - previous.cpu_time, 0)
+                    cpu_percent = round(100.0 * used / elapsed, 2)
+            stats[service] = {
+                'cpu_percent': cpu_percent,
+                'cpu_time': last.cpu_time,
+                'rss': last.rss,
+                'rss_max': max(sample.rss for sample in buf),
+                'fds': last.fds,
+                'threads': last.threads,
+                'processes': last.processes,
+                'samples': len(buf),
+            }
+        return stats
+
+    def dump(self, path):
+        """Write every sample to a JSON file
+        """
+        samples = dict((service, [sample._asdict() for sample in buf])
+                for service, buf in self.samples.iteritems())
+        with open(path, "w") as f:
+            json.dump({'interval': self.interval, 'samples': samples}, f)
+
+
+def format_stats(stats):
+    """Format resource stats as a table, busiest services first
+    """
+    lines = ["%-32s %7s %10s %10s %6s %7s %5s" % ("SERVICE", "CPU%",
+        "RSS(MB)", "MAX(MB)", "FDS", "THREADS", "PROCS")]
+    ordered = sorted(stats.iteritems(),
+            key=lambda item: (item[1]['cpu_percent'] or 0, item[1]['rss']),
+            reverse=True)
+    for service, stat in ordered:
+        if stat['cpu_percent'] is None:
+            cpu = "-"
+        else:
+            cpu = "%.1f" % stat['cpu_percent']
+        lines.append("%-32s %7s %10.1f %10.1f %6d %7d %5d" % (service, cpu,
+            stat['rss'] / (1024.0 * 1024.0), stat['rss_max'] / (1024.0 * 1024.0),
+            stat['fds'], stat['threads'], stat['processes']))
+    return "\n".join(lines)
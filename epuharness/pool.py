@@ -0,0 +1,153 @@
+import os
+import uuid
+import atexit
+import logging
+
+from deployment import compile_deployment
+from harness import EPUHarness
+from exceptions import HarnessException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_IDLE = 4
+
+
+class HarnessPool(object):
+    """Keeps started harnesses, so tests can reuse a deployment instead of
+    starting their own.
+
+    Harnesses are kept by the digest of their deployment. A test checks a
+    harness out, which resets one that is idle or starts a new one, and
+    checks it back in when it's done. Each harness has a namespace of its
+    own, so pools in parallel test workers don't get in each other's way.
+    """
+
+    def __init__(self, max_idle=None, **harness_kwargs):
+        """
+        @param max_idle: the most idle harnesses to keep. The least recently
+                         used are stopped to make room
+        @param harness_kwargs: passed to each EPUHarness
+        """
+        self.max_idle = max_idle or DEFAULT_MAX_IDLE
+        self.harness_kwargs = harness_kwargs
+        # (digest, harness) pairs, least recently used first
+        self.idle = []
+        self.checked_out = {}
+
+    def make_harness(self):
+        namespace = "pool-%s" % uuid.uuid4().hex[:8]
+        return EPUHarness(namespace=namespace, **self.harness_kwargs)
+
+    def checkout(self, deployment_str=None, deployment_file=None,
+            ready_timeout=None):
+        """Returns a running harness with a deployment, reset to a clean
+        state
+
+        @param deployment_str: the deployment, as a YAML string
+        @param deployment_file: a file to read the deployment from instead
+        @param ready_timeout: seconds to wait for services to answer
+        """
+        if deployment_str:
+            plan = compile_deployment(yaml_str=deployment_str)
+        else:
+            plan = compile_deployment(yaml_path=deployment_file)
+
+        for digest, harness in list(self.idle):
+            if digest != plan.digest:
+                continue
+            self.idle.remove((digest, harness))
+            try:
+                harness.reset()
+                harness.wait_until_ready(plan, timeout=ready_timeout)
+            except (Exception, HarnessException):
+                log.exception("Problem resetting harness %s. Stopping it." %
+                        harness.namespace)
+                self._stop(harness)
+                continue
+            log.info("Reusing harness %s" % harness.namespace)
+            self.checked_out[harness] = digest
+            return harness
+
+        harness = self.start(plan, deployment_str=deployment_str,
+                deployment_file=deployment_file, ready_timeout=ready_timeout)
+        self.checked_out[harness] = plan.digest
+        return harness
+
+    def start(self, plan, deployment_str=None, deployment_file=None,
+            ready_timeout=None):
+        harness = self.make_harness()
+        log.info("Starting harness %s for the pool" % harness.namespace)
+        try:
+            harness.start(deployment_str=deployment_str,
+                    deployment_file=deployment_file, wait=True,
+                    ready_timeout=ready_timeout)
+        except (Exception, HarnessException):
+            self._stop(harness)
+            raise
+        return harness
+
+    def prestart(self, count=1, deployment_str=None, deployment_file=None,
+            ready_timeout=None):
+        """Start harnesses ahead of the tests that will check them out
+        """
+        if deployment_str:
+            plan = compile_deployment(yaml_str=deployment_str)
+        else:
+            plan = compile_deployment(yaml_path=deployment_file)
+        for i in range(count):
+            harness = self.start(plan, deployment_str=deployment_str,
+                    deployment_file=deployment_file, ready_timeout=ready_timeout)
+            self._add_idle(plan.digest, harness)
+
+    def checkin(self, harness):
+        """Give back a checked out harness, so another test can use it
+        """
+        digest = self.checked_out.pop(harness, None)
+        if digest is None:
+            log.warning("Harness %s wasn't checked out of this pool" %
+                    getattr(harness, 'namespace', harness))
+            return
+        self._add_idle(digest, harness)
+
+    def discard(self, harness):
+        """Stop a checked out harness instead of giving it back, for example
+        when a test has left it broken
+        """
+        self.checked_out.pop(harness, None)
+        self._stop(harness)
+
+    def shutdown(self):
+        """Stop every harness in the pool, checked out or not
+        """
+        harnesses = [harness for _, harness in self.idle] + self.checked_out.keys()
+        self.idle = []
+        self.checked_out = {}
+        for harness in harnesses:
+            self._stop(harness)
+
+    def _add_idle(self, digest, harness):
+        self.idle.append((digest, harness))
+        while len(self.idle) > self.max_idle:
+            _, oldest = self.idle.pop(0)
+            self._stop(oldest)
+
+    def _stop(self, harness):
+        try:
+            harness.stop(force=True, remove_dir=True)
+        except (Exception, HarnessException):
+            log.exception("Problem stopping harness %s" % harness.namespace)
+
+
+_pool = None
+
+
+def get_pool():
+    """Returns this process's pool, which is shut down when the process
+    exits. EPUHARNESS_POOL_SIZE sets how many idle harnesses it keeps.
+    """
+    global _pool
+    if _pool is None:
+        max_idle = os.environ.get('EPUHARNESS_POOL_SIZE')
+        _pool = HarnessPool(max_idle=int(max_idle) if max_idle else None)
+        atexit.register(_pool.shutdown)
+    return _pool
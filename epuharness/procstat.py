@@ -0,0 +1,100 @@
+import os
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def system_uptime():
+    """Seconds since boot, from /proc/uptime"""
+    with open('/proc/uptime') as uptime_file:
+        return float(uptime_file.read().split()[0])
+
+
+def read_process(pid, uptime=None):
+    """Read CPU and memory use of a process from /proc
+
+    @param pid: the process id
+    @param uptime: system uptime, if already read
+    @return: a dictionary with ppid, state, threads, rss (bytes), cpu_time
+             (seconds), age (seconds) and cpu_percent (averaged over the
+             process lifetime), or None if the process is gone
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as stat_file:
+            stat = stat_file.read()
+    except (IOError, OSError):
+        return None
+
+    # The command name is in parentheses and may contain spaces, so the
+    # other fields are split from after its closing parenthesis
+    fields = stat[stat.rindex(')') + 2:].split()
+    cpu_time = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    started = int(fields[19]) / float(CLOCK_TICKS)
+
+    if uptime is None:
+        uptime = system_uptime()
+    age = max(uptime - started, 0.0)
+    if age > 0:
+        cpu_percent = 100.0 * cpu_time / age
+    else:
+        cpu_percent = 0.0
+
+    return {
+        'pid': pid,
+        'ppid': int(fields[1]),
+        'state': fields[0],
+        'threads': int(fields[17]),
+        'rss': int(fields[21]) * PAGE_SIZE,
+        'cpu_time': cpu_time,
+        'age': age,
+        'cpu_percent': cpu_percent,
+    }
+
+
+def list_pids():
+    """Returns the ids of every process on the system"""
+    return [int(name) for name in os.listdir('/proc') if name.isdigit()]
+
+
+def read_all_processes(uptime=None):
+    """Read CPU and memory use of every process on the system
+
+    @return: a dictionary of read_process results, indexed by pid
+    """
+    if uptime is None:
+        uptime = system_uptime()
+    processes = {}
+    for pid in list_pids():
+        stats = read_process(pid, uptime=uptime)
+        if stats is not None:
+            processes[pid] = stats
+    return processes
+
+
+def process_tree(pid, processes):
+    """Find a process and all of its descendants
+
+    @param pid: the root of the tree
+    @param processes: a dictionary as returned by read_all_processes
+    @return: a list of pids in the tree, including pid itself if it's alive
+    """
+    children = {}
+    for stats in processes.itervalues():
+        children.setdefault(stats['ppid'], []).append(stats['pid'])
+
+    tree = []
+    pending = [pid] if pid in processes else []
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def count_fds(pid):
+    """Count a process's open file descriptors, or None if they can't be read
+    """
+    try:
+        return len(os.listdir('/proc/%d/fd' % pid))
+    except (IOError, OSError):
+        return None
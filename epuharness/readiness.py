@@ -0,0 +1,150 @@
+import time
+import socket
+import logging
+import gevent
+
+from epu.dashiproc.processdispatcher import ProcessDispatcherClient
+from epu.dashiproc.dtrs import DTRSClient
+from epu.dashiproc.provisioner import ProvisionerClient
+from epu.dashiproc.epumanagement import EPUManagementClient
+from eeagent.client import EEAgentClient
+
+from daemon import SocketClient
+from deployment import DeploymentPlan
+
+log = logging.getLogger(__name__)
+
+DEFAULT_READY_TIMEOUT = 120
+
+# Seconds between attempts to reach a service's socket
+SOCKET_RETRY_INTERVAL = 0.1
+
+
+class ReadinessReport(dict):
+    """The result of a readiness check, indexed by service name.
+
+    Each value is a dictionary with:
+        ready: whether the service answered before the deadline
+        time_to_ready: seconds from the start of the check until the
+                       service answered, or None
+        attempts: the number of calls made to the service
+    """
+
+    @property
+    def ready(self):
+        return all(service['ready'] for service in self.itervalues())
+
+    def unready_services(self):
+        return sorted(name for name, service in self.iteritems()
+                if not service['ready'])
+
+
+def ping_socket(socket_path):
+    """Ping a service listening on a Unix socket. Raises socket.timeout
+    while nothing is listening, like a dashi call to a missing service
+    """
+    client = SocketClient(socket_path)
+    try:
+        client.ping()
+    except socket.error:
+        gevent.sleep(SOCKET_RETRY_INTERVAL)
+        raise socket.timeout("Nothing listening on %s" % socket_path)
+    finally:
+        client.close()
+
+
+def ping_port(host, port):
+    """Returns whether something accepts connections on a TCP port. Waits
+    a moment before returning False, so it can be called in a loop
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout=1)
+    except socket.error:
+        gevent.sleep(SOCKET_RETRY_INTERVAL)
+        return False
+    sock.close()
+    return True
+
+
+def get_probes(plan, dashi, sockets=None):
+    """Returns a list of (service name, function, kwargs) tuples. Each
+    function answers once the service is up
+
+    @param plan: a DeploymentPlan
+    @param sockets: the Unix sockets services without a dashi topic listen
+                    on, indexed by service name
+    """
+    probes = []
+
+    for name, socket_path in sorted((sockets or {}).iteritems()):
+        probes.append((name, ping_socket, {'socket_path': socket_path}))
+
+    for service in plan.services_of_type('provisioner'):
+        provisioner = ProvisionerClient(dashi, topic=service.name)
+        probes.append((service.name, provisioner.describe_nodes, {}))
+
+    for service in plan.services_of_type('epum'):
+        epum = EPUManagementClient(dashi, service.name)
+        probes.append((service.name, epum.list_domains, {}))
+
+    for service in plan.services_of_type('eeagent'):
+        eeagent = EEAgentClient(dashi=dashi, ee_name=service.name,
+                handle_heartbeat=False)
+        probes.append((service.name, eeagent.dump, {'rpc': True}))
+
+    for service in plan.services_of_type('process-dispatcher'):
+        pd = ProcessDispatcherClient(dashi, service.name)
+        probes.append((service.name, pd.describe_processes, {}))
+
+    for service in plan.services_of_type('dtrs'):
+        dtrs = DTRSClient(dashi, topic=service.name)
+        probes.append((service.name, dtrs.list_sites, {}))
+
+    return probes
+
+
+def check_readiness(deployment, dashi, timeout=None, sockets=None):
+    """Probes every service in a deployment in parallel until each one
+    answers or the deadline passes.
+
+    @param deployment: a DeploymentPlan, or a parsed deployment
+    @param dashi: the dashi connection to probe with
+    @param timeout: seconds to wait for all services to be ready
+    @param sockets: the Unix sockets of services like mock clouds, which
+                    don't have a dashi topic, indexed by service name
+    @return: a ReadinessReport
+    """
+    if timeout is None:
+        timeout = DEFAULT_READY_TIMEOUT
+    if not isinstance(deployment, DeploymentPlan):
+        deployment = DeploymentPlan(deployment)
+
+    report = ReadinessReport()
+    started = time.time()
+
+    def probe(name, fn, kwargs):
+        while True:
+            report[name]['attempts'] += 1
+            try:
+                fn(**kwargs)
+            except socket.timeout:
+                continue
+            report[name]['ready'] = True
+            report[name]['time_to_ready'] = time.time() - started
+            log.debug("%s is ready after %.2fs", name, report[name]['time_to_ready'])
+            return
+
+    greenlets = []
+    for name, fn, kwargs in get_probes(deployment, dashi, sockets=sockets):
+        report[name] = {'ready': False, 'time_to_ready': None, 'attempts': 0}
+        greenlets.append(gevent.spawn(probe, name, fn, kwargs))
+
+    gevent.joinall(greenlets, timeout=timeout)
+    gevent.killall(greenlets)
+
+    for greenlet in greenlets:
+        # call worked, but got some mystery error
+        if greenlet.ready() and not greenlet.successful():
+            raise greenlet.exception
+
+    return report
@@ -0,0 +1,90 @@
+import os
+import time
+import yaml
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REGISTRY_DIR = "/tmp/SupD/registry"
+
+# The registry name of a harness without a namespace
+DEFAULT_NAME = "default"
+
+
+class HarnessRegistry(object):
+    """Records the harnesses running on a host, one file per harness, so
+    concurrent harnesses can be listed and told apart.
+
+    A harness is live while its pidantic directory exists. Entries left
+    behind by harnesses that went away without stopping are pruned when
+    the registry is read.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = (directory or os.environ.get('EPUHARNESS_REGISTRY_DIR') or
+                DEFAULT_REGISTRY_DIR)
+
+    def _path(self, name):
+        return os.path.join(self.directory, "%s.yml" % name)
+
+    def register(self, name, pidantic_dir, **info):
+        """Record a running harness. The entry is replaced atomically, so
+        readers never see half of one
+
+        @param name: the harness's namespace, or DEFAULT_NAME
+        @param pidantic_dir: the harness's pidantic directory
+        @param info: anything else to record, like its exchange
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            if not os.path.isdir(self.directory):
+                raise
+        entry = dict(info, name=name, pidantic_dir=os.path.abspath(pidantic_dir),
+                pid=os.getpid(), registered=time.time())
+        path = self._path(name)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            yaml.safe_dump(entry, f, default_flow_style=False)
+        os.rename(tmp_path, path)
+        return entry
+
+    def unregister(self, name):
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            log.debug("%s wasn't registered", name)
+
+    def get(self, name):
+        """Returns the entry of a live harness, or None"""
+        try:
+            with open(self._path(name)) as f:
+                entry = yaml.safe_load(f)
+        except (IOError, yaml.YAMLError):
+            return None
+        if not entry or not os.path.exists(entry.get('pidantic_dir', '')):
+            self.unregister(name)
+            return None
+        return entry
+
+    def entries(self):
+        """Returns the entries of every live harness, sorted by name"""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(".yml"):
+                continue
+            entry = self.get(filename[:-len(".yml")])
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+
+def format_entries(entries):
+    """Describe registry entries as a table, one harness per line"""
+    lines = ["%-20s %-8s %-40s %s" % ("NAME", "PID", "PIDANTIC DIR", "EXCHANGE")]
+    for entry in entries:
+        lines.append("%-20s %-8s %-40s %s" % (entry['name'], entry.get('pid', ''),
+            entry['pidantic_dir'], entry.get('exchange', '')))
+    return "\n".join(lines)
@@ -0,0 +1,211 @@
+import json
+import time
+import socket
+import logging
+
+import gevent
+
+from histogram import Histogram
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REPORT_INTERVAL = 60
+
+
+def payload_size(payload):
+    """The size, in bytes, of a payload serialized as JSON, as dashi sends it"""
+    if payload is None:
+        return 0
+    try:
+        return len(json.dumps(payload, default=repr))
+    except (TypeError, ValueError):
+        return len(repr(payload))
+
+
+class OperationStats(object):
+    """Latency, outcomes and payload sizes of one kind of dashi operation"""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.calls = 0
+        self.fires = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.max_request_bytes = 0
+        self.max_response_bytes = 0
+
+    def record(self, kind, duration=None, request_size=0, response_size=0,
+            outcome='ok'):
+        if kind == 'fire':
+            self.fires += 1
+        else:
+            self.calls += 1
+        if outcome == 'timeout':
+            self.timeouts += 1
+        elif outcome == 'error':
+            self.errors += 1
+        elif duration is not None:
+            self.latency.record(duration)
+        self.request_bytes += request_size
+        self.response_bytes += response_size
+        self.max_request_bytes = max(self.max_request_bytes, request_size)
+        self.max_response_bytes = max(self.max_response_bytes, response_size)
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'fires': self.fires,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'latency': self.latency.summary(),
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'max_request_bytes': self.max_request_bytes,
+            'max_response_bytes': self.max_response_bytes,
+        }
+
+
+class RPCStats(object):
+    """Collects the latency, timeouts and payload sizes of dashi operations,
+    indexed by operation name, like node_state or describe_processes.
+
+    Stats are kept since the start, and for the window since the last
+    periodic summary.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.window = {}
+        self.window_started = time.time()
+        self._greenlet = None
+
+    def record(self, operation, kind, duration=None, request_size=0,
+            response_size=0, outcome='ok'):
+        """Record one dashi operation
+
+        @param operation: the dashi operation name
+        @param kind: 'call' for an RPC, or 'fire' for a one way message
+        @param duration: seconds a call took to be answered
+        @param outcome: 'ok', 'timeout' or 'error'
+        """
+        for stats in (self.operations, self.window):
+            op_stats = stats.get(operation)
+            if op_stats is None:
+                op_stats = stats[operation] = OperationStats()
+            op_stats.record(kind, duration=duration, request_size=request_size,
+                    response_size=response_size, outcome=outcome)
+
+    def summary(self, operations=None):
+        """Returns the stats of each operation since the start
+
+        @param operations: names of operations to include. Defaults to all
+        """
+        return dict((name, stats.summary()) for name, stats in self.operations.iteritems()
+                if operations is None or name in operations)
+
+    def format_window(self):
+        """Describe the operations since the last summary in one line
+        """
+        elapsed = time.time() - self.window_started
+        calls = sum(stats.calls + stats.fires for stats in self.window.itervalues())
+        parts = []
+        for name in sorted(self.window, key=lambda n: -self.window[n].calls):
+            stats = self.window[name]
+            if stats.calls:
+                part = "%s %d calls p50 %s p99 %s" % (name, stats.calls,
+                    _format_ms(stats.latency.percentile(50)),
+                    _format_ms(stats.latency.percentile(99)))
+                if stats.timeouts:
+                    part += " %d timeouts" % stats.timeouts
+                if stats.errors:
+                    part += " %d errors" % stats.errors
+            else:
+                part = "%s %d fires" % (name, stats.fires)
+            parts.append(part)
+        line = "dashi: %d operations in %.0fs (%.1f/s)" % (calls, elapsed,
+                calls / elapsed if elapsed > 0 else 0)
+        if parts:
+            line += ": " + "; ".join(parts)
+        return line
+
+    def log_window(self):
+        """Log a summary of the operations since the last one, and start a
+        new window
+        """
+        if self.window:
+            log.info(self.format_window())
+        self.window = {}
+        self.window_started = time.time()
+
+    def start_reporting(self, interval=DEFAULT_REPORT_INTERVAL):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._report_loop, interval)
+
+    def stop_reporting(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _report_loop(self, interval):
+        while True:
+            gevent.sleep(interval)
+            self.log_window()
+
+
+def _format_ms(seconds):
+    if seconds is None:
+        return "-"
+    return "%.1fms" % (seconds * 1000)
+
+
+class InstrumentedDashi(object):
+    """Wraps a dashi connection, recording the latency, outcome and payload
+    sizes of every call and fire in an RPCStats. Anything else is passed
+    through to the connection, so it can be used in its place, for
+    example by epu's service clients.
+    """
+
+    def __init__(self, dashi, stats):
+        self._dashi = dashi
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._dashi, name)
+
+    def call(self, name, operation, *args, **kwargs):
+        request_size = payload_size(kwargs)
+        began = time.time()
+        try:
+            result = self._dashi.call(name, operation, *args, **kwargs)
+        except socket.timeout:
+            self.stats.record(operation, 'call', request_size=request_size,
+                    outcome='timeout')
+            raise
+        except Exception:
+            self.stats.record(operation, 'call', request_size=request_size,
+                    outcome='error')
+            raise
+        self.stats.record(operation, 'call', duration=time.time() - began,
+                request_size=request_size, response_size=payload_size(result))
+        return result
+
+    def fire(self, name, operation, *args, **kwargs):
+        request_size = payload_size(kwargs)
+        try:
+            result = self._dashi.fire(name, operation, *args, **kwargs)
+        except Exception:
+            self.stats.record(operation, 'fire', request_size=request_size,
+                    outcome='error')
+            raise
+        self.stats.record(operation, 'fire', request_size=request_size)
+        return result
+
+
+def instrument(dashi, stats):
+    """Wrap a dashi connection in an InstrumentedDashi, unless it is already
+    """
+    if isinstance(dashi, InstrumentedDashi):
+        return dashi
+    return InstrumentedDashi(dashi, stats)
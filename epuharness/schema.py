@@ -0,0 +1,231 @@
+from exceptions import DeploymentDescriptionError
+
+string = basestring
+number = (int, long, float)
+# seconds, a [low, high] range or a distribution, as util.sample_latency takes
+latency = number + (list, dict)
+
+# The keys each kind of service may have, and the types of their values
+SERVICE = {'config': dict}
+
+SECTIONS = {
+    'mock-clouds': {'boot_latency': latency, 'terminate_latency': latency,
+        'failure_rate': number, 'seed': (int, long), 'snapshot': string,
+        'snapshot_interval': number},
+    'provisioners': SERVICE,
+    'dt_registries': SERVICE,
+    'epums': SERVICE,
+    'process-dispatchers': SERVICE,
+    'pyon-process-dispatchers': SERVICE,
+    'pyon-http-gateways': SERVICE,
+    'phantom-instances': {'config': dict, 'port': (int, long), 'users': list},
+    'nodes': {'dt': string, 'engine': string, 'process-dispatcher': string,
+        'eeagents': dict},
+    'pyon-nodes': {'dt': string, 'engine': string, 'process-dispatcher': string,
+        'eeagents': dict},
+}
+
+REQUIRED = {
+    'nodes': ('process-dispatcher',),
+    'pyon-nodes': ('process-dispatcher',),
+}
+
+EEAGENT = {'launch_type': string, 'process-dispatcher': string,
+    'pyon_directory': string, 'logfile': string, 'slots': (int, long),
+    'system_name': string, 'heartbeat': number,
+    'launch_latency': latency, 'terminate_latency': latency,
+    'failure_rate': number}
+EEAGENT_REQUIRED = ('launch_type',)
+PYON_EEAGENT = {'config': dict}
+
+LAUNCH_TYPES = ('supd', 'fork', 'pyon', 'pyon_single', 'simulated')
+
+DISTRIBUTIONS = {'normal': ('mean', 'stddev'), 'exponential': ('mean',)}
+
+# Keys only simulated eeagents understand
+SIMULATED_KEYS = ('launch_latency', 'terminate_latency', 'failure_rate')
+
+# Process dispatchers the nodes of each section may be announced to
+NODE_DISPATCHERS = {
+    'nodes': ('process-dispatchers',),
+    'pyon-nodes': ('pyon-process-dispatchers', 'process-dispatchers'),
+}
+
+
+def _type_names(types):
+    if not isinstance(types, tuple):
+        types = (types,)
+    names = []
+    for t in types:
+        name = {basestring: 'string', dict: 'mapping', list: 'list',
+            int: 'integer', long: 'integer', float: 'number'}[t]
+        if name not in names:
+            names.append(name)
+    return " or ".join(names)
+
+
+def _check_keys(errors, where, spec, schema, required=()):
+    for key in required:
+        if key not in spec:
+            errors.append("%s is missing '%s'" % (where, key))
+    for key, value in spec.iteritems():
+        if key not in schema:
+            errors.append("%s has unknown key '%s'. Expected one of: %s" % (
+                where, key, ", ".join(sorted(schema))))
+        elif value is not None and not isinstance(value, schema[key]):
+            errors.append("%s has '%s' of %r, but it should be a %s" % (
+                where, key, value, _type_names(schema[key])))
+        # bool is an int, but never a sensible count
+        elif isinstance(value, bool) and schema[key] is not dict:
+            errors.append("%s has '%s' of %r, but it should be a %s" % (
+                where, key, value, _type_names(schema[key])))
+
+
+def _check_eeagent(errors, section, node_name, name, eeagent):
+    where = "eeagent '%s' on node '%s'" % (name, node_name)
+    if not isinstance(eeagent, dict):
+        errors.append("%s should be a mapping" % where)
+        return
+    if section == 'pyon-nodes':
+        _check_keys(errors, where, eeagent, PYON_EEAGENT)
+        return
+
+    _check_keys(errors, where, eeagent, EEAGENT, EEAGENT_REQUIRED)
+    launch_type = eeagent.get('launch_type')
+    if isinstance(launch_type, basestring):
+        if launch_type not in LAUNCH_TYPES:
+            errors.append("%s has unknown launch_type '%s'. Expected one of: %s" % (
+                where, launch_type, ", ".join(LAUNCH_TYPES)))
+        elif launch_type.startswith('pyon') and not eeagent.get('pyon_directory'):
+            errors.append("%s has a pyon launch_type, but no pyon_directory" % where)
+        if launch_type != 'simulated':
+            for key in SIMULATED_KEYS:
+                if key in eeagent:
+                    errors.append("%s has '%s', but only simulated eeagents use it" % (
+                        where, key))
+
+    _check_simulation(errors, where, eeagent, ('launch_latency', 'terminate_latency'))
+    slots = eeagent.get('slots')
+    if isinstance(slots, (int, long)) and slots < 1:
+        errors.append("%s has %d slots, but needs at least one" % (where, slots))
+
+
+def _check_simulation(errors, where, spec, latency_keys):
+    """Check the latencies and failure_rate of simulated services"""
+    for key in latency_keys:
+        value = spec.get(key)
+        if isinstance(value, list) and (len(value) != 2 or
+                not all(isinstance(l, number) for l in value)):
+            errors.append("%s has '%s' of %r, but it should be seconds or a "
+                "[low, high] range" % (where, key, value))
+        elif isinstance(value, dict):
+            distribution = value.get('distribution', 'normal')
+            if distribution not in DISTRIBUTIONS:
+                errors.append("%s has '%s' with unknown distribution '%s'. Expected "
+                    "one of: %s" % (where, key, distribution, ", ".join(sorted(DISTRIBUTIONS))))
+            elif set(value) - set(DISTRIBUTIONS[distribution] + ('distribution',)) or \
+                    not isinstance(value.get('mean'), number):
+                errors.append("%s has '%s' of %r, but a %s distribution takes %s" % (
+                    where, key, value, distribution, " and ".join(DISTRIBUTIONS[distribution])))
+    failure_rate = spec.get('failure_rate')
+    if isinstance(failure_rate, number) and not 0 <= failure_rate <= 1:
+        errors.append("%s has a failure_rate of %r, but it should be between 0 and 1" % (
+            where, failure_rate))
+
+
+def _check_references(errors, deployment):
+    """Check that nodes and eeagents refer to process dispatchers and engines
+    defined in the deployment, and provisioner sites to mock clouds
+    """
+    for name, provisioner in deployment.get('provisioners', {}).iteritems():
+        sites = ((provisioner or {}).get('config') or {}).get('sites') or {}
+        for site_name, site in sites.iteritems():
+            cloud = site.get('mock_cloud') if isinstance(site, dict) else None
+            if cloud and cloud not in deployment.get('mock-clouds', {}):
+                errors.append("provisioner '%s' site '%s' refers to mock cloud '%s', "
+                    "which isn't defined in mock-clouds" % (name, site_name, cloud))
+
+    for section, pd_sections in NODE_DISPATCHERS.iteritems():
+        for node_name, node in deployment.get(section, {}).iteritems():
+            if not isinstance(node, dict):
+                continue
+            engine = node.get('engine') or 'default'
+            dispatchers = [node.get('process-dispatcher')]
+            for eeagent in (node.get('eeagents') or {}).itervalues():
+                if isinstance(eeagent, dict) and eeagent.get('process-dispatcher'):
+                    dispatchers.append(eeagent['process-dispatcher'])
+
+            for dispatcher in dispatchers:
+                if not isinstance(dispatcher, basestring):
+                    continue
+                pd = None
+                for pd_section in pd_sections:
+                    if dispatcher in deployment.get(pd_section, {}):
+                        pd = deployment[pd_section][dispatcher] or {}
+                        break
+                else:
+                    errors.append("node '%s' refers to process-dispatcher '%s', "
+                        "which isn't defined in %s" % (node_name, dispatcher,
+                            " or ".join(pd_sections)))
+                    continue
+
+                # Only check engines if the process dispatcher lists them
+                engines = ((pd.get('config') or {}).get('processdispatcher') or {}).get('engines')
+                if isinstance(engines, dict) and engine not in engines:
+                    errors.append("node '%s' uses engine '%s', which process-dispatcher "
+                        "'%s' doesn't define" % (node_name, engine, dispatcher))
+
+
+def validate_deployment(deployment):
+    """Check a parsed deployment against the schema
+
+    Every section, service and eeagent is checked for unknown keys and
+    values of the wrong type, and nodes are checked against the process
+    dispatchers they refer to, so that a bad deployment fails before
+    anything is launched.
+
+    @raise DeploymentDescriptionError: listing every problem found
+    """
+    if not isinstance(deployment, dict):
+        raise DeploymentDescriptionError("A deployment must be a mapping of sections, not %s" % (
+            type(deployment).__name__))
+
+    errors = []
+    for section, services in deployment.iteritems():
+        if section not in SECTIONS:
+            errors.append("Unknown section '%s'. Expected one of: %s" % (
+                section, ", ".join(sorted(SECTIONS))))
+            continue
+        if services is None:
+            continue
+        if not isinstance(services, dict):
+            errors.append("Section '%s' must be a mapping of service names" % section)
+            continue
+
+        for name, spec in services.iteritems():
+            if spec is None:
+                spec = {}
+            where = "%s '%s'" % (section, name)
+            if not isinstance(spec, dict):
+                errors.append("%s should be a mapping" % where)
+                continue
+            _check_keys(errors, where, spec, SECTIONS[section], REQUIRED.get(section, ()))
+
+            if section in NODE_DISPATCHERS:
+                for eeagent_name, eeagent in (spec.get('eeagents') or {}).iteritems():
+                    _check_eeagent(errors, section, name, eeagent_name, eeagent)
+
+            if section == 'mock-clouds':
+                _check_simulation(errors, where, spec, ('boot_latency', 'terminate_latency'))
+
+            if section == 'phantom-instances':
+                for user in spec.get('users') or []:
+                    if not isinstance(user, dict) or set(user) - set(['user', 'password']):
+                        errors.append("%s users should be mappings with user and password" % where)
+                        break
+
+    if not errors:
+        _check_references(errors, deployment)
+
+    if errors:
+        raise DeploymentDescriptionError("Invalid deployment:\n  " + "\n  ".join(errors))
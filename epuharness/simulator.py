@@ -0,0 +1,247 @@
+import sys
+import time
+import random
+import logging
+
+import gevent
+import dashi.bootstrap as bootstrap
+
+from epu.states import ProcessState
+
+from util import sample_latency
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SLOTS = 8
+DEFAULT_HEARTBEAT = 30
+
+# How many simulated eeagents the harness puts in each worker process
+DEFAULT_AGENTS_PER_WORKER = 250
+
+# States in which a process holds one of its eeagent's slots
+OCCUPYING_STATES = (ProcessState.PENDING, ProcessState.RUNNING,
+    ProcessState.TERMINATING)
+
+# States a process can be cleaned up from
+FINAL_STATES = (ProcessState.TERMINATED, ProcessState.EXITED,
+    ProcessState.FAILED)
+
+
+class SimulatedEEAgent(object):
+    """Stands in for an eeagent, without running any processes.
+
+    It answers the same dashi operations as a real eeagent, and heartbeats
+    to its process dispatcher, but processes only move through their states
+    after a configurable delay, and fail at a configurable rate. Many can
+    share one OS process, so process dispatchers can be tested with far
+    more nodes than a machine could run real eeagents for.
+    """
+
+    def __init__(self, dashi, name, node_id, process_dispatcher,
+            slots=DEFAULT_SLOTS, heartbeat=DEFAULT_HEARTBEAT,
+            launch_latency=None, terminate_latency=None, failure_rate=0.0,
+            rng=None):
+        """
+        @param dashi: the eeagent's own dashi connection, named after it
+        @param name: the eeagent's name
+        @param node_id: node ID to include in heartbeats
+        @param process_dispatcher: the process dispatcher to heartbeat to
+        @param slots: the number of processes it can run at once
+        @param heartbeat: seconds between heartbeats
+        @param launch_latency: seconds a process takes to start running, or
+                               a [low, high] range
+        @param terminate_latency: seconds a process takes to terminate, or
+                                  a [low, high] range
+        @param failure_rate: the chance, from 0 to 1, that a process fails
+                             instead of running
+        @param rng: a random.Random to draw latencies and failures from
+        """
+        self.dashi = dashi
+        self.name = name
+        self.node_id = node_id
+        self.process_dispatcher = process_dispatcher
+        self.slots = slots or DEFAULT_SLOTS
+        self.heartbeat = heartbeat or DEFAULT_HEARTBEAT
+        self.launch_latency = launch_latency
+        self.terminate_latency = terminate_latency
+        self.failure_rate = failure_rate or 0.0
+        self.rng = rng or random.Random()
+
+        # process state, indexed by (upid, round)
+        self.processes = {}
+        self.beats = 0
+        self._greenlets = []
+
+        self.dashi.handle(self.launch_process, "launch_process")
+        self.dashi.handle(self.terminate_process, "terminate_process")
+        self.dashi.handle(self.restart_process, "restart_process")
+        self.dashi.handle(self.cleanup, "cleanup")
+        self.dashi.handle(self.dump_state, "dump_state")
+
+    def start(self):
+        self._greenlets = [gevent.spawn(self.dashi.consume),
+                gevent.spawn(self._heartbeat_loop)]
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+        try:
+            self.dashi.cancel()
+            self.dashi.disconnect()
+        except Exception:
+            log.debug("Problem disconnecting %s" % self.name, exc_info=True)
+
+    def _heartbeat_loop(self):
+        # Agents sharing a worker start together, so spread their beats out
+        gevent.sleep(self.rng.uniform(0, self.heartbeat))
+        while True:
+            try:
+                self.beat()
+            except Exception:
+                log.exception("%s couldn't heartbeat to %s" % (self.name,
+                    self.process_dispatcher))
+            gevent.sleep(self.heartbeat)
+
+    def used_slots(self):
+        return sum(1 for process in self.processes.itervalues()
+                if process['state'] in OCCUPYING_STATES)
+
+    def make_beat(self):
+        """Returns a heartbeat message, in the same form a real eeagent sends
+        """
+        processes = [{'upid': upid, 'round': round, 'state': process['state'],
+                'msg': process['msg']}
+                for (upid, round), process in self.processes.iteritems()]
+        return {'eeagent_id': self.name, 'node_id': self.node_id,
+                'timestamp': time.time(), 'processes': processes}
+
+    def beat(self):
+        self.dashi.fire(self.process_dispatcher, "heartbeat",
+                message=self.make_beat())
+        self.beats += 1
+
+    def _set_state(self, key, state, msg=""):
+        process = self.processes.get(key)
+        if process is None:
+            return
+        process['state'] = state
+        process['msg'] = msg
+        # Process dispatchers act on state changes, so don't make them wait
+        # for the next heartbeat
+        self.beat()
+
+    def launch_process(self, u_pid, round, run_type, parameters):
+        key = (u_pid, round)
+        if key in self.processes:
+            log.warning("%s already has process %s round %s" % (self.name,
+                u_pid, round))
+            return
+
+        if self.used_slots() >= self.slots:
+            self.processes[key] = {'state': ProcessState.FAILED,
+                    'msg': "No free slots", 'run_type': run_type,
+                    'parameters': parameters}
+            self.beat()
+            return
+
+        self.processes[key] = {'state': ProcessState.PENDING, 'msg': "",
+                'run_type': run_type, 'parameters': parameters}
+        gevent.spawn(self._run_process, key)
+
+    def _run_process(self, key):
+        gevent.sleep(sample_latency(self.launch_latency, self.rng))
+        process = self.processes.get(key)
+        if process is None or process['state'] != ProcessState.PENDING:
+            return
+        if self.rng.random() < self.failure_rate:
+            self._set_state(key, ProcessState.FAILED, "Simulated failure")
+        else:
+            self._set_state(key, ProcessState.RUNNING)
+
+    def terminate_process(self, u_pid, round):
+        key = (u_pid, round)
+        process = self.processes.get(key)
+        if process is None or process['state'] in FINAL_STATES:
+            return
+        process['state'] = ProcessState.TERMINATING
+        gevent.spawn(self._terminate_process, key)
+
+    def _terminate_process(self, key):
+        gevent.sleep(sample_latency(self.terminate_latency, self.rng))
+        self._set_state(key, ProcessState.TERMINATED)
+
+    def restart_process(self, u_pid, round):
+        key = (u_pid, round)
+        process = self.processes.get(key)
+        if process is None:
+            return
+        process['state'] = ProcessState.PENDING
+        process['msg'] = ""
+        gevent.spawn(self._run_process, key)
+
+    def cleanup(self, u_pid, round):
+        key = (u_pid, round)
+        process = self.processes.get(key)
+        if process is not None and process['state'] in FINAL_STATES:
+            del self.processes[key]
+
+    def dump_state(self, rpc=False):
+        if rpc:
+            return self.make_beat()
+        self.beat()
+
+
+class SimulatorWorker(object):
+    """Hosts the simulated eeagents listed in a config, each on its own
+    dashi connection, in one process
+    """
+
+    def __init__(self, CFG, amqp_uri=None):
+        self.CFG = CFG
+        simulator = CFG.simulator
+        sysname = CFG.get('dashi', {}).get('sysname')
+        rng = random.Random(simulator.get('seed'))
+
+        self.agents = []
+        for agent in simulator.agents:
+            dashi = bootstrap.dashi_connect(agent['name'], CFG,
+                    amqp_uri=amqp_uri, sysname=sysname)
+            self.agents.append(SimulatedEEAgent(dashi, agent['name'],
+                    agent['node_id'], agent['process_dispatcher'],
+                    slots=agent.get('slots'), heartbeat=agent.get('heartbeat'),
+                    launch_latency=agent.get('launch_latency'),
+                    terminate_latency=agent.get('terminate_latency'),
+                    failure_rate=agent.get('failure_rate'),
+                    rng=random.Random(rng.random())))
+
+    def start(self):
+        for agent in self.agents:
+            agent.start()
+        log.info("Started %d simulated eeagents" % len(self.agents))
+
+    def stop(self):
+        for agent in self.agents:
+            agent.stop()
+
+    def wait(self):
+        gevent.joinall([greenlet for agent in self.agents
+                for greenlet in agent._greenlets])
+
+
+def main(argv=None):
+    import gevent.monkey
+    gevent.monkey.patch_all()
+
+    if not argv:
+        argv = list(sys.argv)
+    if len(argv) != 2:
+        print >>sys.stderr, "usage: %s CONFIG_FILE" % argv[0]
+        return 1
+
+    CFG = bootstrap.configure([argv[1]])
+    worker = SimulatorWorker(CFG)
+    worker.start()
+    try:
+        worker.wait()
+    finally:
+        worker.stop()
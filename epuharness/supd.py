@@ -0,0 +1,173 @@
+import logging
+import xmlrpclib
+import contextlib
+
+import pkg_resources
+from supervisor.xmlrpc import Faults
+
+from exceptions import HarnessException
+
+log = logging.getLogger(__name__)
+
+# pidantic releases whose SupD internals SupDAdapter is written against.
+# With any other, programs are started and stopped through pidantic's
+# public calls, one at a time
+PIDANTIC_VERSIONS = ('0.1',)
+
+# What SupDAdapter uses of pidantic's private SupD object
+SUPD_ATTRIBUTES = ('_proxy', '_supd_db', '_reread', 'transport', 'write_conf',
+        'get_all_state', 'run_program', 'terminate_program')
+
+
+def pidantic_version():
+    """Returns the installed pidantic version, or None if it is unknown
+    """
+    try:
+        return pkg_resources.get_distribution('pidantic').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def is_supported_version(version):
+    """Returns True if version is one of PIDANTIC_VERSIONS, or a
+    release of one, like 0.1.2 for 0.1
+    """
+    if not version:
+        return False
+    for supported in PIDANTIC_VERSIONS:
+        if version == supported or version.startswith(supported + "."):
+            return True
+    return False
+
+
+class SupDAdapter(object):
+    """Starts and stops the programs of a pidantic SupD factory in batches,
+    and reads supervisord's process info, neither of which pidantic has
+    public calls for. Every use of pidantic's private SupD object is here.
+
+    pidantic starts and stops one program at a time, rewriting and
+    reloading supervisord's config for each. Programs still move through
+    pidantic's states here, but the calls pidantic would make to
+    supervisord for them are collected and made together.
+
+    With a pidantic version it wasn't written against, the adapter uses
+    pidantic's public calls instead, and has no process info.
+    """
+
+    def __init__(self, factory, version=None):
+        """
+        @param factory: a SupDPidanticFactory
+        @param version: the pidantic version. Defaults to the installed one
+        """
+        self.version = version or pidantic_version()
+        supd = getattr(factory, '_supd', None)
+        if (is_supported_version(self.version) and supd is not None and
+                all(hasattr(supd, name) for name in SUPD_ATTRIBUTES)):
+            self._supd = supd
+        else:
+            log.warning("Unsupported pidantic version %s. Programs will be "
+                    "started and stopped one at a time" % self.version)
+            self._supd = None
+
+    @property
+    def batched(self):
+        return self._supd is not None
+
+    @property
+    def transport(self):
+        """pidantic's XML-RPC transport to supervisord, or None
+        """
+        if not self.batched:
+            return None
+        return self._supd.transport
+
+    @contextlib.contextmanager
+    def _deferred(self, method):
+        """Collect the arguments pidantic passes to one of its SupD methods,
+        like terminate_program, instead of letting it call supervisord
+        """
+        deferred = []
+        setattr(self._supd, method, deferred.append)
+        try:
+            yield deferred
+        finally:
+            delattr(self._supd, method)
+
+    def start(self, pids):
+        """Start programs with one supervisord config write and one
+        multicall, which reloads the config and adds every program's
+        process group. pidantic programs autostart, so supervisord starts
+        each one as it is added.
+
+        @param pids: a dictionary of pidantic objects, indexed by name
+        """
+        if not self.batched:
+            for name in sorted(pids):
+                pids[name].start()
+            return
+
+        with self._deferred('run_program') as starting:
+            for name in sorted(pids):
+                pids[name].start()
+        if not starting:
+            return
+
+        self._supd._supd_db.db_commit()
+        self._supd.write_conf()
+        names = [program_object.process_name for program_object in starting]
+        calls = [{'methodName': 'supervisor.reloadConfig', 'params': []}]
+        calls.extend({'methodName': 'supervisor.addProcessGroup', 'params': [name]}
+                for name in names)
+        results = self._supd._proxy.system.multicall(calls)
+
+        reload_result = results[0]
+        if isinstance(reload_result, dict) and 'faultCode' in reload_result:
+            raise HarnessException("Couldn't reload supervisord's config: %s" % (
+                reload_result['faultString']))
+        for name, result in zip(names, results[1:]):
+            if isinstance(result, dict) and 'faultCode' in result:
+                # ALREADY_ADDED, if supervisord already had the group
+                if result['faultCode'] != Faults.ALREADY_ADDED:
+                    raise HarnessException("Couldn't start %s: %s" % (
+                        name, result['faultString']))
+
+        # Any other change to the config is applied the way pidantic would
+        (added, changed, removed) = reload_result[0]
+        if changed or removed or set(added) - set(names):
+            self._supd._reread()
+
+    def terminate(self, instances):
+        """Stop programs without waiting for each to stop, as pidantic
+        would. The stop requests are sent back to back rather than in a
+        multicall, where supervisord answers them one poll at a time.
+
+        @param instances: a dictionary of pidantic objects, indexed by name
+        """
+        if not self.batched:
+            for name in sorted(instances):
+                try:
+                    instances[name].terminate()
+                except Exception, e:
+                    log.warning("Problem terminating %s: %s" % (name, e))
+            return
+
+        with self._deferred('terminate_program') as stopping:
+            for name in sorted(instances):
+                try:
+                    instances[name].terminate()
+                except Exception, e:
+                    log.warning("Problem terminating %s: %s" % (name, e))
+        supervisor = self._supd._proxy.supervisor
+        for name in stopping:
+            try:
+                supervisor.stopProcessGroup(name, False)
+            except xmlrpclib.Fault, e:
+                log.warning("Problem terminating %s: %s" % (name, e.faultString))
+
+    def process_info(self):
+        """Returns supervisord's process info for each program, indexed by
+        name, from one call to getAllProcessInfo. Empty if unsupported
+        """
+        if not self.batched:
+            return {}
+        return dict((info['name'], info) for info in self._supd.get_all_state())
@@ -0,0 +1,49 @@
+import xmlrpclib
+
+from epuharness.benchmark import make_deployment, run_compile_benchmark, \
+    BenchmarkHarness
+from epuharness.deployment import get_service_dependencies, get_startup_waves
+
+
+class TestBenchmark(object):
+
+    def test_make_deployment(self):
+
+        deployment = make_deployment(2, 3, 4)
+
+        assert len(deployment['process-dispatchers']) == 2
+        assert len(deployment['nodes']) == 6
+        for node in deployment['nodes'].itervalues():
+            assert len(node['eeagents']) == 4
+
+        waves = get_startup_waves(get_service_dependencies(deployment))
+        assert waves[0] == ['pd_0', 'pd_1']
+        assert len(waves[1]) == 6 + 6 * 4
+
+    def test_compile_benchmark(self):
+
+        result = run_compile_benchmark(2, 3, 4)
+        assert result['services'] == 2 + 6 + 6 * 4
+        assert 'load_python' in result['phases']
+        assert result['phases']['compile_cached'] <= result['phases']['compile']
+        assert result['template_services'] == result['services']
+        assert result['template_bytes'] < result['bytes']
+
+    def test_counts_requests(self):
+
+        sent = []
+        class Transport(object):
+            def request(self, host, handler, request_body, verbose=0):
+                sent.append(request_body)
+                return (True,)
+
+        transport = Transport()
+        harness = BenchmarkHarness(amqp_uri="memory://test-benchmark")
+        harness._count_requests(transport)
+        proxy = xmlrpclib.ServerProxy('http://127.0.0.1', transport=transport)
+        proxy.supervisor.reloadConfig()
+        proxy.supervisor.startProcessGroup("pd_0", True)
+
+        assert len(sent) == 2
+        assert harness.rpc_counts == {'supervisor.reloadConfig': 1,
+                'supervisor.startProcessGroup': 1}
@@ -0,0 +1,196 @@
+import struct
+
+import gevent
+from gevent import socket
+from nose.tools import assert_raises
+
+from epuharness.broker import (Router, BrokerServer, AMQPError, Message,
+    encode_method, decode_method, frame, PROTOCOL_HEADER, FRAME_METHOD,
+    FRAME_HEADER, FRAME_BODY, NOT_FOUND)
+
+
+class FakeChannel(object):
+
+    def __init__(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+        self.consumers = {}
+        self.delivered = []
+
+    def can_deliver(self):
+        return not self.prefetch_count or len(self.delivered) < self.prefetch_count
+
+    def deliver(self, queue, tag, message, redelivered, no_ack):
+        self.delivered.append((tag, message.body, redelivered))
+
+
+def message(body, routing_key=""):
+    return Message("", routing_key, "\x00\x00", body)
+
+
+class TestRouter(object):
+
+    def setup(self):
+        self.router = Router()
+
+    def test_default_exchange(self):
+        queue = self.router.declare_queue("pd_0")
+        assert self.router.publish("", "pd_0", message("one")) == 1
+        assert self.router.publish("", "pd_1", message("two")) == 0
+        assert [m.body for m, _ in queue.messages] == ["one"]
+
+    def test_topic(self):
+        self.router.declare_exchange("dashi", "topic")
+        for name, key in (("exact", "pd.0"), ("star", "pd.*"), ("hash", "#.0")):
+            self.router.declare_queue(name)
+            self.router.bind(name, "dashi", key)
+
+        def routed(routing_key):
+            return sorted(self.router.exchanges["dashi"].route(routing_key))
+
+        assert routed("pd.0") == ["exact", "hash", "star"]
+        assert routed("pd.1") == ["star"]
+        assert routed("eeagent.x.0") == ["hash"]
+
+        self.router.unbind("star", "dashi", "pd.*")
+        assert routed("pd.1") == []
+
+    def test_fanout(self):
+        self.router.declare_exchange("everyone", "fanout")
+        for name in ("a", "b"):
+            self.router.declare_queue(name)
+            self.router.bind(name, "everyone", "")
+        assert self.router.publish("everyone", "anything", message("hi")) == 2
+
+    def test_errors(self):
+        self.router.declare_exchange("dashi", "topic")
+        assert_raises(AMQPError, self.router.declare_exchange, "dashi", "direct")
+        assert_raises(AMQPError, self.router.publish, "missing", "pd_0", message("x"))
+        assert_raises(AMQPError, self.router.bind, "missing", "dashi", "pd_0")
+
+        owner = object()
+        self.router.declare_queue("reply", connection=owner, exclusive=True)
+        try:
+            self.router.declare_queue("reply", connection=object())
+        except AMQPError, e:
+            assert e.code == 405
+        else:
+            assert False, "exclusive queue was shared"
+
+        self.router.close_connection(owner)
+        assert "reply" not in self.router.queues
+
+    def test_consumers_take_turns(self):
+        queue = self.router.declare_queue("pd_0")
+        one, two = FakeChannel(), FakeChannel()
+        self.router.add_consumer(queue, one, "one", False)
+        self.router.add_consumer(queue, two, "two", False)
+        for i in range(4):
+            self.router.publish("", "pd_0", message(str(i)))
+        assert [body for _, body, _ in one.delivered] == ["0", "2"]
+        assert [body for _, body, _ in two.delivered] == ["1", "3"]
+
+    def test_prefetch(self):
+        queue = self.router.declare_queue("pd_0")
+        channel = FakeChannel(prefetch_count=1)
+        self.router.add_consumer(queue, channel, "tag", False)
+        self.router.publish("", "pd_0", message("first"))
+        self.router.publish("", "pd_0", message("second"))
+        assert len(channel.delivered) == 1
+        assert len(queue.messages) == 1
+
+        channel.prefetch_count = 0
+        self.router.requeue(queue, [message("again")])
+        assert [(body, redelivered) for _, body, redelivered in channel.delivered] == [
+            ("first", False), ("again", True), ("second", False)]
+
+    def test_auto_delete(self):
+        queue = self.router.declare_queue("temp", auto_delete=True)
+        channel = FakeChannel()
+        self.router.add_consumer(queue, channel, "tag", False)
+        self.router.remove_consumer(queue, "tag")
+        assert "temp" not in self.router.queues
+
+
+def test_codec():
+    payload = encode_method(50, 10, 0, "pd_0", False, False, True, True, False, {})
+    method, args = decode_method(payload)
+    assert method == (50, 10)
+    assert args[:7] == [0, "pd_0", False, False, True, True, False]
+
+
+class Client(object):
+    """Just enough of an AMQP client to talk to the broker"""
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.buffer = ""
+        self.sock.sendall(PROTOCOL_HEADER)
+        assert self.expect() == (10, 10)
+        self.send(0, 10, 11, {}, "PLAIN", "\x00guest\x00guest", "en_US")
+        assert self.expect() == (10, 30)
+        self.send(0, 10, 31, 0, 131072, 0)
+        self.send(0, 10, 40, "/", "", False)
+        assert self.expect() == (10, 41)
+        self.send(1, 20, 10, "")
+        assert self.expect() == (20, 11)
+
+    def send(self, channel, class_id, method_id, *args):
+        self.sock.sendall(frame(FRAME_METHOD, channel,
+            encode_method(class_id, method_id, *args)))
+
+    def publish(self, routing_key, body):
+        self.sock.sendall(frame(FRAME_METHOD, 1, encode_method(60, 40, 0, "",
+            routing_key, False, False)) +
+            frame(FRAME_HEADER, 1, struct.pack('>HHQH', 60, 0, len(body), 0)) +
+            frame(FRAME_BODY, 1, body))
+
+    def read_frame(self):
+        while True:
+            if len(self.buffer) >= 7:
+                frame_type, channel, size = struct.unpack_from('>BHI', self.buffer)
+                if len(self.buffer) >= 8 + size:
+                    payload = self.buffer[7:7 + size]
+                    self.buffer = self.buffer[8 + size:]
+                    return frame_type, channel, payload
+            self.buffer += self.sock.recv(65536)
+
+    def expect(self):
+        frame_type, channel, payload = self.read_frame()
+        assert frame_type == FRAME_METHOD
+        method, self.last_args = decode_method(payload)
+        return method
+
+
+def test_server():
+    server = BrokerServer(port=0)
+    server.start()
+    try:
+        client = Client(server.address)
+        client.send(1, 50, 10, 0, "pd_0", False, False, False, True, False, {})
+        assert client.expect() == (50, 11)
+
+        client.send(1, 60, 20, 0, "pd_0", "tag", False, False, False, False, {})
+        assert client.expect() == (60, 21)
+
+        client.publish("pd_0", "hello")
+        assert client.expect() == (60, 60)
+        assert client.last_args[0] == "tag"
+        assert client.read_frame()[0] == FRAME_HEADER
+        assert client.read_frame() == (FRAME_BODY, 1, "hello")
+
+        # publishing to a missing exchange closes the channel
+        client.sock.sendall(frame(FRAME_METHOD, 1, encode_method(60, 40, 0,
+            "missing", "pd_0", False, False)) +
+            frame(FRAME_HEADER, 1, struct.pack('>HHQH', 60, 0, 0, 0)))
+        assert client.expect() == (20, 40)
+        assert client.last_args[0] == NOT_FOUND
+        client.send(1, 20, 41)
+
+        client.send(0, 10, 50, 200, "bye", 0, 0)
+        assert client.expect() == (10, 51)
+        gevent.sleep(0.1)
+        assert server.connections == set()
+        # the auto-delete queue goes with its consumer
+        assert "pd_0" not in server.router.queues
+    finally:
+        server.stop()
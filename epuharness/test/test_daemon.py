@@ -0,0 +1,41 @@
+import json
+
+from epuharness.daemon import HarnessDaemon
+from epuharness.exceptions import HarnessException
+
+
+class FakeHarness(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def start(self, **kwargs):
+        self.calls.append(('start', kwargs))
+        raise HarnessException("pd_0-0 is running")
+
+    def stop(self, **kwargs):
+        self.calls.append(('stop', kwargs))
+
+
+class TestHarnessDaemon(object):
+
+    def setup(self):
+        self.harness = FakeHarness()
+        self.daemon = HarnessDaemon(self.harness, socket_path="/tmp/unused.sock")
+
+    def request(self, action, **kwargs):
+        return self.daemon._dispatch(json.dumps({'action': action, 'kwargs': kwargs}))
+
+    def test_dispatch(self):
+
+        assert self.request('ping') == {'result': 'pong'}
+
+        assert self.request('stop', services=['pd_0']) == {'result': None}
+        # the daemon keeps its dashi connection open between requests
+        assert self.harness.calls[-1] == ('stop', {'services': ['pd_0'], 'disconnect': False})
+
+    def test_errors(self):
+
+        assert self.request('start') == {'error': "pd_0-0 is running"}
+        assert 'error' in self.request('explode')
+        assert 'error' in self.daemon._dispatch("not json")
@@ -0,0 +1,177 @@
+import os
+import glob
+import tempfile
+
+from nose.tools import assert_raises
+from nose.plugins.skip import SkipTest
+
+from epuharness.deployment import parse_deployment, get_service_dependencies, \
+    get_startup_waves, compile_deployment, expand_templates, DeploymentPlan, \
+    DEFAULT_DEPLOYMENT
+from epuharness.exceptions import DeploymentDescriptionError, ProgrammingError
+
+
+class TestStartupOrder(object):
+
+    def test_default_deployment(self):
+
+        deployment = parse_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+        dependencies = get_service_dependencies(deployment)
+
+        assert dependencies['epum_0'] == set(['provisioner_0'])
+        assert dependencies['eeagent_nodeone'] == set(['pd_0'])
+        assert dependencies['nodeone'] == set(['pd_0'])
+        assert not dependencies['pd_0']
+
+        waves = get_startup_waves(dependencies)
+        assert waves == [
+            ['dtrs', 'pd_0', 'provisioner_0'],
+            ['eeagent_nodeone', 'epum_0', 'nodeone'],
+        ]
+
+    def test_unknown_dependencies_ignored(self):
+
+        deployment = {'epums': {'epum_0': {'config': {
+            'epumanagement': {'provisioner_topic': 'elsewhere'}}}}}
+        dependencies = get_service_dependencies(deployment)
+        assert get_startup_waves(dependencies) == [['epum_0']]
+
+    def test_duplicate_names(self):
+
+        deployment = {
+            'epums': {'service': {}},
+            'dt_registries': {'service': {}},
+        }
+        assert_raises(DeploymentDescriptionError, get_service_dependencies, deployment)
+
+    def test_cycle(self):
+
+        dependencies = {'a': set(['b']), 'b': set(['a']), 'c': set()}
+        assert_raises(DeploymentDescriptionError, get_startup_waves, dependencies)
+
+
+class TestDeploymentPlan(object):
+
+    def test_compile(self):
+
+        plan = compile_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+        assert plan.waves == [
+            ['dtrs', 'pd_0', 'provisioner_0'],
+            ['eeagent_nodeone', 'epum_0', 'nodeone'],
+        ]
+        eeagent = plan.services['eeagent_nodeone']
+        assert eeagent.type == 'eeagent'
+        assert eeagent.node == 'nodeone'
+        assert eeagent.spec['launch_type'] == 'supd'
+        assert [s.name for s in plan.services_of_type('process-dispatcher')] == ['pd_0']
+
+        # every section is present, even if the document leaves it out
+        assert plan['pyon-nodes'] == {}
+        assert plan.get('phantom-instances') == {}
+
+    def test_memoized(self):
+
+        plan = compile_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+        assert compile_deployment(yaml_str=DEFAULT_DEPLOYMENT) is plan
+
+        other = compile_deployment(yaml_str="process-dispatchers: {pd_0: }")
+        assert other is not plan
+        assert other != plan
+        assert len(set([plan, other, compile_deployment(yaml_str=DEFAULT_DEPLOYMENT)])) == 2
+        assert other.services['pd_0'].spec == {}
+
+    def test_compile_file(self):
+
+        fd, path = tempfile.mkstemp(suffix=".yml")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(DEFAULT_DEPLOYMENT)
+            assert compile_deployment(yaml_path=path) is \
+                compile_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+        finally:
+            os.remove(path)
+
+    def test_errors_are_raised(self):
+
+        assert_raises(ProgrammingError, compile_deployment)
+        assert_raises(ProgrammingError, parse_deployment, yaml_path="a.yml",
+                yaml_str="a: b")
+        assert_raises(DeploymentDescriptionError, compile_deployment,
+                yaml_str="nodes: {nodeone: {eeagents: {}}}")
+        assert_raises(DeploymentDescriptionError, compile_deployment,
+                yaml_str="epums: [epum_0]")
+        assert_raises(DeploymentDescriptionError, DeploymentPlan, ['epum_0'])
+
+
+class TestTemplates(object):
+
+    def test_expand(self):
+
+        deployment = {
+            'process-dispatchers': [
+                {'template': 'pd_{i}', 'count': 2},
+                {'pd_extra': {}},
+            ],
+            'nodes': {
+                'template': 'node_{i}',
+                'count': 3,
+                'process-dispatcher': {'cycle': ['pd_0', 'pd_1']},
+                'eeagents_per_node': 2,
+                'eeagent': {'launch_type': 'fork', 'logfile': '/tmp/{node}_{j}.log'},
+            },
+        }
+        expanded = expand_templates(deployment)
+
+        assert sorted(expanded['process-dispatchers']) == ['pd_0', 'pd_1', 'pd_extra']
+        assert sorted(expanded['nodes']) == ['node_0', 'node_1', 'node_2']
+        assert expanded['nodes']['node_2']['process-dispatcher'] == 'pd_0'
+        eeagents = expanded['nodes']['node_1']['eeagents']
+        assert sorted(eeagents) == ['eeagent_node_1_0', 'eeagent_node_1_1']
+        assert eeagents['eeagent_node_1_1'] == {'launch_type': 'fork',
+                'logfile': '/tmp/node_1_1.log'}
+
+        plan = DeploymentPlan(deployment)
+        assert len(plan.services_of_type('eeagent')) == 6
+        assert plan.services['eeagent_node_2_0'].node == 'node_2'
+
+    def test_specs_are_shared(self):
+
+        expanded = expand_templates({'epums': {'template': 'epum_{i}',
+            'count': 3, 'config': {'epumanagement': {}}}})
+        epums = expanded['epums']
+        assert epums['epum_0']['config'] is epums['epum_2']['config']
+
+    def test_start(self):
+
+        expanded = expand_templates({'epums': {'template': 'epum_{i}',
+            'start': 5, 'count': 2}})
+        assert sorted(expanded['epums']) == ['epum_5', 'epum_6']
+
+    def test_no_templates(self):
+
+        deployment = parse_deployment(yaml_str=DEFAULT_DEPLOYMENT)
+        assert expand_templates(deployment) is deployment
+
+    def test_bad_templates(self):
+
+        assert_raises(DeploymentDescriptionError, expand_templates,
+                {'epums': {'template': 'epum', 'count': 2}})
+        assert_raises(DeploymentDescriptionError, expand_templates,
+                {'epums': {'template': 'epum_{i}', 'count': -1}})
+        assert_raises(DeploymentDescriptionError, expand_templates,
+                {'epums': {'template': 'epum_{x}', 'count': 1}})
+        assert_raises(DeploymentDescriptionError, expand_templates,
+                {'epums': [{'template': 'epum_{i}', 'count': 1}, {'epum_0': {}}]})
+
+
+def test_example_deployments():
+    deployments_dir = os.path.join(os.path.dirname(__file__), "..", "..",
+            "deployments")
+    paths = glob.glob(os.path.join(deployments_dir, "*.yml"))
+    if not paths:
+        raise SkipTest("The example deployments aren't installed")
+    for path in paths:
+        try:
+            compile_deployment(yaml_path=path)
+        except DeploymentDescriptionError, e:
+            assert False, "%s: %s" % (os.path.basename(path), e)
@@ -1,7 +1,14 @@
+import os
+import yaml
 import shutil
 import tempfile
+from socket import timeout
+from mock import patch, Mock
 from nose.plugins.skip import SkipTest
-from epuharness.harness import EPUHarness
+from pidantic.state_machine import PIDanticState, PIDanticStatesList
+from epu.states import ProcessState
+from epuharness.harness import EPUHarness, remove_directories, LIVE_STATES
+from epuharness.registry import HarnessRegistry
 
 class TestEPUHarness(object):
 
@@ -22,6 +29,129 @@ class TestEPUHarness(object):
         self.epuharness._start_process_dispatcher(pd_name, engines, exe_name="echo")
         assert len(self.epuharness.factory.reload_instances()) == 1
 
+        manifest = self.epuharness._load_manifest()
+        config_file, = manifest["testpd-0"]['files']
+        assert os.path.dirname(config_file) == self.epuharness.config_dir
+        assert os.path.exists(config_file)
+
+    def test_manifest_is_plain_yaml(self):
+
+        os.makedirs(self.epuharness.config_dir)
+        self.epuharness.manifest = {u'pd_0-0': {'service': u'pd_0',
+            'files': [], 'directories': [], 'restarts': 1}}
+        self.epuharness._save_manifest()
+
+        with open(self.epuharness.manifest_path) as manifest_f:
+            assert "!!python" not in manifest_f.read()
+        manifest = self.epuharness._load_manifest()
+        assert manifest['pd_0-0']['service'] == "pd_0"
+        assert manifest['pd_0-0']['restarts'] == 1
+
+    def test_launch(self):
+
+        assert not self.epuharness.factory.reload_instances()
+
+        pds = self.epuharness._plan_process_dispatcher("testpd",
+                {'replica_count': 2}, exe_name="echo")
+        eeagents = self.epuharness._plan_eeagent("testeeagent", "testpd",
+                "somenode", "fork", exe_name="echo")
+        pids = self.epuharness.launch([pds, eeagents])
+
+        assert sorted(pids) == ["testeeagent", "testpd-0", "testpd-1"]
+        assert len(self.epuharness.factory.reload_instances()) == 3
+        assert self.epuharness.launch_timings['programs'] == 3
+
+    def test_restart(self):
+
+        pds = self.epuharness._plan_process_dispatcher("testpd",
+                {'replica_count': 1}, exe_name="echo")
+        self.epuharness.launch([pds])
+
+        restarted = self.epuharness.restart(["testpd-0"], timeout=5)
+        assert restarted == ["testpd-0"]
+
+        instance = self.epuharness.factory.reload_instances()["testpd-0"]
+        assert instance.get_state() != PIDanticState.STATE_TERMINATED
+        entry = self.epuharness._load_manifest()["testpd-0"]
+        assert entry['restarts'] == 1
+        # programs are registered again from the manifest
+        assert entry['command'].startswith("echo ")
+        assert entry['directory'] == self.pidantic_dir
+        assert 'autorestart' in entry
+
+    def test_reset(self):
+
+        pds = self.epuharness._plan_process_dispatcher("testpd",
+                {'replica_count': 1}, exe_name="echo")
+        self.epuharness._plan_node("nodeone", "default", "testpd")
+        self.epuharness.launch([pds])
+
+        processes = [[{'upid': 'proc1', 'state': ProcessState.RUNNING}], []]
+        def describe_processes():
+            return processes.pop(0) if processes else []
+
+        with patch('epuharness.harness.ProcessDispatcherClient') as client:
+            client.return_value.describe_processes.side_effect = describe_processes
+            restarted = self.epuharness.reset(timeout=5)
+            client.return_value.terminate_process.assert_called_once_with('proc1')
+            assert client.return_value.node_state.call_args[0][0] == "nodeone"
+
+        assert restarted == ["testpd-0"]
+        instance = self.epuharness.factory.reload_instances()["testpd-0"]
+        assert instance.get_state() != PIDanticState.STATE_TERMINATED
+
+    def test_plan_simulators(self):
+
+        self.epuharness.CFG.epuharness['simulator_agents_per_worker'] = 5
+        def assignments(count):
+            agents = [{'name': "sim_%d" % i, 'node_id': "node_%d" % i}
+                    for i in range(count)]
+            programs = self.epuharness._plan_simulators(agents)
+            return dict((program.name,
+                self.epuharness.manifest[program.name]['agents'])
+                for program in programs)
+
+        before = assignments(18)
+        assert sorted(name for agents in before.values() for name in agents) == \
+            sorted("sim_%d" % i for i in range(18))
+        assert len(before) <= 4
+
+        # one more eeagent only changes the worker it goes to
+        after = assignments(19)
+        changed = [name for name in after if after[name] != before.get(name)]
+        assert len(changed) == 1
+        assert "sim_18" in after[changed[0]]
+
+    def test_apply(self):
+
+        deployment = {'process-dispatchers': {'pd_0': {}, 'pd_1': {}, 'pd_2': {}}}
+
+        launched = []
+        def launch(waves):
+            launched.append(sorted(p.name for wave in waves for p in wave))
+
+        with patch.object(self.epuharness, 'launch', side_effect=launch):
+            changes = self.epuharness.apply(deployment_str=yaml.dump(deployment))
+            assert changes['started'] == ['pd_0-0', 'pd_1-0', 'pd_2-0']
+            assert launched[-1] == ['pd_0-0', 'pd_1-0', 'pd_2-0']
+
+            deployment['process-dispatchers']['pd_1']['config'] = {
+                'processdispatcher': {'static_resources': False}}
+            del deployment['process-dispatchers']['pd_2']
+            deployment['process-dispatchers']['pd_3'] = {}
+
+            instances = dict((name, Mock()) for name in launched[-1])
+            with patch.object(self.epuharness.factory, 'reload_instances',
+                    return_value=instances):
+                changes = self.epuharness.apply(deployment_str=yaml.dump(deployment))
+
+        assert changes == {'started': ['pd_3-0'], 'restarted': ['pd_1-0'],
+                'stopped': ['pd_2-0'], 'announced': [], 'removed_nodes': []}
+        assert launched[-1] == ['pd_1-0', 'pd_3-0']
+        assert instances['pd_2-0'].cleanup.called
+        assert instances['pd_1-0'].cleanup.called
+        assert not instances['pd_0-0'].cleanup.called
+
     def test_start_eeagent(self):
 
         ee_name = "testeeagent"
@@ -35,6 +165,34 @@ class TestEPUHarness(object):
                 launch_type, exe_name="echo")
         assert len(self.epuharness.factory.reload_instances()) == 1
 
+    def test_register_harness(self):
+
+        registry_dir = tempfile.mkdtemp()
+        try:
+            self.epuharness.registry = HarnessRegistry(registry_dir)
+            self.epuharness._register_harness()
+            entry = self.epuharness.registry.get(self.epuharness.registry_name)
+            assert entry['pidantic_dir'] == self.pidantic_dir
+        finally:
+            shutil.rmtree(registry_dir)
+
+    def test_get_logfiles(self):
+
+        log_dir = os.path.join(self.pidantic_dir, "epu-harness")
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        for name in ("eeagent_1", "eeagent_10"):
+            for channel in ("stdout", "stderr"):
+                logfile = "%s-%s---supervisor-abc123.log" % (name, channel)
+                open(os.path.join(log_dir, logfile), "w").close()
+            self.epuharness.manifest[name] = {'service': name, 'type': 'eeagent'}
+        self.epuharness._save_manifest()
+
+        logfiles = self.epuharness.get_logfiles(services=["eeagent_1"])
+        assert sorted(os.path.basename(f) for f in logfiles) == [
+            "eeagent_1-stderr---supervisor-abc123.log",
+            "eeagent_1-stdout---supervisor-abc123.log"]
+
     def test_announce_node(self):
 
         raise SkipTest("TODO")
@@ -45,9 +203,62 @@ class TestEPUHarness(object):
         dashi = self.epuharness.dashi
         raise Exception("TODO")
 
+    def test_announce_nodes(self):
+
+        calls = []
+        def node_state(node_name, domain_id, state):
+            calls.append(node_name)
+            # the pd isn't up for the first announcement
+            if len(calls) == 1:
+                raise timeout()
+
+        with patch('epuharness.harness.ProcessDispatcherClient') as client:
+            client.return_value.node_state.side_effect = node_state
+            unannounced = self.epuharness.announce_nodes([
+                ("nodeone", "default", "pd_0"),
+                ("nodetwo", "default", "pd_0")])
+
+        assert unannounced == []
+        assert sorted(set(calls)) == ["nodeone", "nodetwo"]
+        assert len(calls) == 3
+
+    def test_announce_backs_off_once_pd_is_ready(self):
+
+        pd_ready = Mock()
+        pd_ready.is_set.return_value = True
+        with patch('epuharness.harness.ProcessDispatcherClient') as client:
+            client.return_value.node_state.side_effect = [timeout(), None]
+            with patch('epuharness.harness.gevent.sleep') as sleep:
+                assert self.epuharness.announce_node("nodeone", "default",
+                        "pd_0", pd_ready=pd_ready)
+
+        assert sleep.call_count == 1
+        assert not pd_ready.wait.called
+
     def teardown(self):
-        instances = self.epuharness.factory.reload_instances()
-        for instance in instances.values():
-            instance.cleanup()
+        # Polling autorestarted echo programs can trip pidantic's state
+        # machine, so shut supervisord down, which stops them all, without
+        # reloading the instances first
         self.epuharness.factory.terminate()
         shutil.rmtree(self.pidantic_dir)
+
+
+def test_live_states():
+    for state in LIVE_STATES:
+        assert state in PIDanticStatesList, state
+
+
+def test_remove_directories():
+
+    parent = tempfile.mkdtemp()
+    try:
+        directories = [os.path.join(parent, name) for name in ("a", "a/b", "c")]
+        for directory in directories:
+            os.makedirs(directory)
+        missing = os.path.join(parent, "missing")
+
+        remove_directories(directories + [missing])
+
+        assert os.listdir(parent) == []
+    finally:
+        shutil.rmtree(parent)
@@ -0,0 +1,53 @@
+import random
+
+from epuharness.histogram import Histogram
+
+
+class TestHistogram(object):
+
+    def setup(self):
+        self.histogram = Histogram(significant_figures=2)
+
+    def test_empty(self):
+        assert self.histogram.percentile(50) is None
+        assert self.histogram.mean is None
+        assert "Total count    =            0" in self.histogram.format_distribution()
+
+    def test_percentiles(self):
+        values = [i / 1000.0 for i in range(1, 1001)]
+        random.Random(0).shuffle(values)
+        for value in values:
+            self.histogram.record(value)
+
+        assert self.histogram.count == 1000
+        assert self.histogram.min == 0.001
+        assert self.histogram.max == 1.0
+        for percentile, expected in ((50, 0.5), (90, 0.9), (99, 0.99)):
+            value = self.histogram.percentile(percentile)
+            # two significant figures
+            assert abs(value - expected) / expected < 0.01, (percentile, value)
+        assert self.histogram.percentile(100) == 1.0
+
+    def test_merge(self):
+        other = Histogram(significant_figures=2)
+        self.histogram.record(0.1, count=3)
+        other.record(2.0)
+        self.histogram.merge(other)
+        assert self.histogram.count == 4
+        assert self.histogram.max == 2.0
+        assert self.histogram.percentile(75) < 0.11
+
+    def test_round_trip(self):
+        self.histogram.record(0.25)
+        self.histogram.record(0.5)
+        copy = Histogram.from_dict(self.histogram.to_dict())
+        assert copy.summary() == self.histogram.summary()
+
+    def test_format_distribution(self):
+        for i in range(100):
+            self.histogram.record(i / 100.0)
+        lines = self.histogram.format_distribution().splitlines()
+        assert lines[0].split() == ["Value", "Percentile", "TotalCount", "1/(1-Percentile)"]
+        counts = [int(line.split()[2]) for line in lines[2:-2]]
+        assert counts == sorted(counts)
+        assert counts[-1] == 100
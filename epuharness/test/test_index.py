@@ -0,0 +1,37 @@
+from nose.tools import assert_raises
+
+from epuharness.index import InstanceIndex
+from epuharness.exceptions import HarnessException
+
+
+class TestInstanceIndex(object):
+
+    def setup(self):
+        manifest = {
+            'pd_0-0': {'service': 'pd_0', 'type': 'process-dispatcher', 'replica': 0},
+            'pd_0-1': {'service': 'pd_0', 'type': 'process-dispatcher', 'replica': 1},
+            'pd_0x-0': {'service': 'pd_0x', 'type': 'process-dispatcher', 'replica': 0},
+            'eeagent_one': {'service': 'eeagent_one', 'type': 'eeagent', 'node': 'nodeone'},
+            'eeagent_two': {'service': 'eeagent_two', 'type': 'eeagent', 'node': 'nodetwo'},
+            'nodeone': {'service': 'nodeone', 'type': 'node'},
+        }
+        self.index = InstanceIndex.from_manifest(manifest)
+
+    def test_lookup(self):
+
+        # selecting a service doesn't match services that share its prefix
+        assert self.index.lookup('pd_0') == set(['pd_0-0', 'pd_0-1'])
+        assert self.index.lookup('pd_0-1') == set(['pd_0-1'])
+        assert self.index.lookup('type=eeagent') == set(['eeagent_one', 'eeagent_two'])
+        assert self.index.lookup('node=nodeone') == set(['eeagent_one'])
+        assert self.index.lookup('service=pd_0,replica=1') == set(['pd_0-1'])
+        assert self.index.lookup('nodeone') == set()
+
+        assert self.index.select(['pd_0x', 'node=nodetwo']) == set(['pd_0x-0', 'eeagent_two'])
+        assert_raises(HarnessException, self.index.lookup, 'colour=blue')
+
+    def test_remove(self):
+
+        self.index.remove('pd_0-0')
+        assert self.index.lookup('pd_0') == set(['pd_0-1'])
+        assert self.index.lookup('replica=0') == set(['pd_0x-0'])
@@ -0,0 +1,76 @@
+from nose.tools import assert_raises
+
+from epu.states import ProcessState
+
+from epuharness.loadgen import LoadGenerator, DEFINITION_ID
+
+
+class FakeProcessDispatcher(object):
+
+    def __init__(self, state=ProcessState.RUNNING):
+        self.state = state
+        self.definitions = []
+        self.processes = {}
+        self.terminated = []
+
+    def create_definition(self, definition_id, definition_type, executable, **kwargs):
+        self.definitions.append(definition_id)
+
+    def schedule_process(self, upid, definition_id, **kwargs):
+        self.processes[upid] = {'upid': upid, 'state': ProcessState.PENDING}
+
+    def describe_processes(self):
+        for process in self.processes.itervalues():
+            if process['state'] == ProcessState.PENDING:
+                process['state'] = self.state
+        return self.processes.values()
+
+    def terminate_process(self, upid):
+        self.terminated.append(upid)
+        self.processes[upid]['state'] = ProcessState.TERMINATED
+
+
+def test_needs_limit():
+    assert_raises(ValueError, LoadGenerator, {'pd_0': FakeProcessDispatcher()})
+    assert_raises(ValueError, LoadGenerator, {}, count=1)
+
+
+def test_load():
+    pds = {'pd_0': FakeProcessDispatcher(), 'pd_1': FakeProcessDispatcher()}
+    generator = LoadGenerator(pds, rate=1000, concurrency=5, count=20,
+            poll_interval=0.001)
+    report = generator.run()
+
+    assert pds['pd_0'].definitions == [DEFINITION_ID]
+    assert report['totals']['scheduled'] == 20
+    assert report['totals']['started'] == 20
+    # processes are spread evenly, and all terminated
+    assert report['process_dispatchers']['pd_0']['started'] == 10
+    assert len(pds['pd_1'].terminated) == 10
+    assert report['latency']['count'] == 20
+    assert report['throughput'] > 0
+    assert generator.alive == 0
+
+
+def test_failures():
+    pds = {'pd_0': FakeProcessDispatcher(state=ProcessState.REJECTED)}
+    report = LoadGenerator(pds, rate=1000, count=3, poll_interval=0.001).run()
+    assert report['totals']['failed'] == 3
+    assert report['totals']['started'] == 0
+    assert report['latency']['count'] == 0
+
+
+def test_describe_errors():
+    pd = FakeProcessDispatcher()
+    describe_processes = pd.describe_processes
+    errors = [Exception("pd_0 fell over")]
+    def flaky_describe():
+        if errors:
+            raise errors.pop()
+        return describe_processes()
+    pd.describe_processes = flaky_describe
+
+    report = LoadGenerator({'pd_0': pd}, rate=1000, count=3,
+            poll_interval=0.001).run()
+    assert not errors
+    assert report['totals']['started'] == 3
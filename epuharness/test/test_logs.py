@@ -0,0 +1,121 @@
+import os
+import gzip
+import time
+import shutil
+import tempfile
+
+from nose.tools import assert_raises
+
+from epuharness.logs import parse_timestamp, LogTail, LogStream, LogCollector
+from epuharness.exceptions import HarnessException
+
+
+def test_parse_timestamp():
+    expected = time.mktime((2012, 5, 1, 16, 20, 1, 0, 0, -1))
+    assert parse_timestamp("2012-05-01 16:20:01,250 INFO hello") == expected + 0.25
+    assert parse_timestamp("2012-05-01T16:20:01 hello") == expected
+    assert parse_timestamp("Traceback (most recent call last):") is None
+
+
+class TestLogs(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.tmpdir, "saved")
+        os.mkdir(self.output_dir)
+        self.pd_log = os.path.join(self.tmpdir, "pd_0.log")
+        self.eeagent_log = os.path.join(self.tmpdir, "eeagent_one.log")
+        self.logfiles = [self.pd_log, self.eeagent_log]
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, text):
+        with open(path, "a") as f:
+            f.write(text)
+
+    def test_tail(self):
+        tail = LogTail(self.pd_log)
+        assert tail.read_lines() == []
+
+        self.write(self.pd_log, "one\ntw")
+        assert tail.read_lines() == ["one"]
+        self.write(self.pd_log, "o\n")
+        assert tail.read_lines() == ["two"]
+
+        # truncated files are read again from the start
+        with open(self.pd_log, "w") as f:
+            f.write("new\n")
+        assert tail.read_lines() == ["new"]
+
+    def test_tail_reads_a_chunk_at_a_time(self):
+        self.write(self.pd_log, "one\ntwo\nthree\n")
+        tail = LogTail(self.pd_log)
+        tail.read = lambda size=4: LogTail.read(tail, size)
+
+        lines = tail.iter_lines()
+        assert lines.next() == "one"
+        assert tail.offset == 4
+        assert list(lines) == ["two", "three"]
+
+    def test_stream_is_time_ordered(self):
+        self.write(self.pd_log, "2012-05-01 16:20:01,000 pd first\n"
+                "2012-05-01 16:20:03,000 pd third\n"
+                "Traceback, still third\n")
+        self.write(self.eeagent_log, "2012-05-01 16:20:02,000 eeagent second\n")
+
+        stream = LogStream(lambda: self.logfiles)
+        lines = [(source, line) for timestamp, source, line in stream.poll()]
+        assert lines == [
+            ('pd_0', "2012-05-01 16:20:01,000 pd first"),
+            ('eeagent_one', "2012-05-01 16:20:02,000 eeagent second"),
+            ('pd_0', "2012-05-01 16:20:03,000 pd third"),
+            ('pd_0', "Traceback, still third"),
+        ]
+
+        assert stream.poll() == []
+        self.write(self.eeagent_log, "2012-05-01 16:20:04,000 eeagent fourth\n")
+        assert [line for timestamp, source, line in stream.poll()] == \
+            ["2012-05-01 16:20:04,000 eeagent fourth"]
+
+    def test_stream_from_end(self):
+        self.write(self.pd_log, "old\n")
+        stream = LogStream(lambda: [self.pd_log], from_start=False)
+        assert stream.poll() == []
+        self.write(self.pd_log, "new\n")
+        assert [line for timestamp, source, line in stream.poll()] == ["new"]
+
+    def test_collector(self):
+        collector = LogCollector(lambda: self.logfiles, self.output_dir)
+        self.write(self.pd_log, "one\n")
+        assert collector.collect() == 4
+        self.write(self.pd_log, "two\n")
+        self.write(self.eeagent_log, "eeagent\n")
+        collector.stop()
+
+        with open(os.path.join(self.output_dir, "pd_0.log")) as f:
+            assert f.read() == "one\ntwo\n"
+        with open(os.path.join(self.output_dir, "eeagent_one.log")) as f:
+            assert f.read() == "eeagent\n"
+
+    def test_collector_gzip_and_cap(self):
+        collector = LogCollector(lambda: [self.pd_log], self.output_dir,
+                compression='gzip', max_bytes=6)
+        self.write(self.pd_log, "one\n")
+        collector.collect()
+        self.write(self.pd_log, "two\nthree\n")
+        collector.stop()
+
+        destination = collector.destination(self.pd_log)
+        assert destination == os.path.join(self.output_dir, "pd_0.log.gz")
+        f = gzip.open(destination)
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        assert contents.startswith("one\ntw\n")
+        assert "truncated at 6 bytes" in contents
+
+    def test_unknown_compression(self):
+        assert_raises(HarnessException, LogCollector, lambda: [],
+                self.output_dir, compression='lzma')
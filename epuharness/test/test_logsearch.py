@@ -0,0 +1,82 @@
+import os
+import time
+import shutil
+import tempfile
+
+from epuharness.logsearch import LogIndex, parse_level, parse_ids
+
+
+def test_parse_level():
+    assert parse_level("2012-05-01 16:20:01,000 ERROR something broke") == 'ERROR'
+    assert parse_level("2012-05-01 16:20:01,000 WARN careful") == 'WARNING'
+    assert parse_level("no level here") is None
+
+
+def test_parse_ids():
+    ids = parse_ids("dispatching upid=proc-1 to node_id: 'node-2'")
+    assert sorted(ids) == [('node_id', 'node-2'), ('upid', 'proc-1')]
+    assert parse_ids("{'upid': u'proc-3'}") == [('upid', 'proc-3')]
+
+
+class TestLogIndex(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pd_log = os.path.join(self.tmpdir, "pd_0.log")
+        self.eeagent_log = os.path.join(self.tmpdir, "eeagent_one.log")
+        self.logfiles = [self.pd_log, self.eeagent_log]
+        self.index = LogIndex(os.path.join(self.tmpdir, "logs.db"))
+
+        self.write(self.pd_log, "2012-05-01 16:20:01,000 INFO dispatching upid=p1\n"
+                "2012-05-01 16:20:03,000 ERROR upid=p1 failed\n"
+                "Traceback (most recent call last):\n")
+        self.write(self.eeagent_log, "2012-05-01 16:20:02,000 ERROR node_id=n1 is sad\n"
+                "2012-05-01 16:20:04,000 INFO upid=p1 running\n")
+        assert self.index.update(self.logfiles) == 5
+
+    def teardown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, text):
+        with open(path, "a") as f:
+            f.write(text)
+
+    def lines(self, **query):
+        return [line for timestamp, source, line in self.index.search(**query)]
+
+    def test_search(self):
+        assert len(self.lines()) == 5
+        assert self.lines(levels=['error']) == [
+            "2012-05-01 16:20:02,000 ERROR node_id=n1 is sad",
+            "2012-05-01 16:20:03,000 ERROR upid=p1 failed"]
+        assert self.lines(sources=['pd_0'], levels=['ERROR']) == [
+            "2012-05-01 16:20:03,000 ERROR upid=p1 failed"]
+        assert self.lines(ids={'node_id': 'n1'}) == [
+            "2012-05-01 16:20:02,000 ERROR node_id=n1 is sad"]
+        assert len(self.lines(ids={'upid': 'p1'})) == 3
+        assert self.lines(text="traceback") == ["Traceback (most recent call last):"]
+        assert self.lines(text="100%") == []
+
+    def test_search_by_time(self):
+        start = time.mktime((2012, 5, 1, 16, 20, 2, 0, 0, -1))
+        end = time.mktime((2012, 5, 1, 16, 20, 3, 0, 0, -1))
+        # the traceback takes the time of the line before it
+        assert len(self.lines(start=start, end=end)) == 3
+        assert len(self.lines(start=start, limit=2)) == 2
+
+    def test_incremental_update(self):
+        assert self.index.update(self.logfiles) == 0
+
+        # unfinished lines wait until they're complete
+        self.write(self.pd_log, "2012-05-01 16:20:05,000 INFO more")
+        assert self.index.update(self.logfiles) == 0
+        self.write(self.pd_log, " to come\n")
+        assert self.index.update(self.logfiles) == 1
+        assert self.lines(text="more")[0].endswith("more to come")
+
+    def test_truncated_file(self):
+        with open(self.pd_log, "w") as f:
+            f.write("2012-05-01 16:20:06,000 INFO fresh start\n")
+        self.index.update(self.logfiles)
+        assert self.lines(sources=['pd_0']) == ["2012-05-01 16:20:06,000 INFO fresh start"]
@@ -0,0 +1,88 @@
+import os
+import json
+import shutil
+import tempfile
+
+from epuharness.mockcloud import MockCloud, MockCloudServer
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMockCloud(object):
+
+    def setup(self):
+        self.clock = Clock()
+        self.cloud = MockCloud(boot_latency=[10, 20], terminate_latency=5,
+                seed=0, clock=self.clock)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def states(self, **kwargs):
+        return [node['state'] for node in self.cloud.describe_nodes(**kwargs)]
+
+    def test_boot(self):
+        nodes = self.cloud.create_nodes("vm", image="ami-1", count=3)
+        assert len(nodes) == 3
+        assert len(set(node['id'] for node in nodes)) == 3
+        assert self.states() == ['pending'] * 3
+
+        self.clock.now += 20
+        assert self.states() == ['running'] * 3
+
+    def test_terminate(self):
+        ids = [node['id'] for node in self.cloud.create_nodes("vm", count=2)]
+        self.clock.now += 20
+        assert self.cloud.destroy_nodes(ids[:1] + ['i-missing']) == ids[:1]
+        assert self.states(ids=ids[:1]) == ['terminating']
+        # terminating twice does nothing
+        assert self.cloud.destroy_nodes(ids[:1]) == []
+
+        self.clock.now += 5
+        assert self.states(ids=ids) == ['terminated', 'running']
+        assert self.states(states=['running']) == ['running']
+
+    def test_failures(self):
+        self.cloud.failure_rate = 1.0
+        self.cloud.create_nodes("vm", count=2)
+        self.clock.now += 20
+        assert self.states() == ['error'] * 2
+        stats = self.cloud.stats()
+        assert stats['failed'] == 2
+        assert stats['states']['error'] == 2
+
+    def test_snapshot(self):
+        self.cloud.create_nodes("vm", count=2)
+        path = os.path.join(self.tmpdir, "cloud.json")
+        self.cloud.snapshot(path)
+
+        restored = MockCloud(clock=self.clock)
+        restored.restore(path)
+        assert restored.describe_nodes() == self.cloud.describe_nodes()
+        assert restored.stats() == self.cloud.stats()
+
+    def test_server(self):
+        path = os.path.join(self.tmpdir, "cloud.json")
+        server = MockCloudServer(self.cloud, os.path.join(self.tmpdir, "cloud.sock"),
+                snapshot_path=path)
+
+        def call(action, **kwargs):
+            return server._dispatch(json.dumps({'action': action, 'kwargs': kwargs}))
+
+        created = call('create_nodes', name="vm", count=2)['result']
+        ids = [node['id'] for node in created]
+        described = call('describe_nodes', ids=ids)['result']
+        assert [node['id'] for node in described] == ids
+
+        assert call('snapshot')['result'] == path
+        assert os.path.exists(path)
+        call('reset')
+        assert call('stats')['result']['nodes'] == 0
@@ -0,0 +1,76 @@
+import os
+import json
+import shutil
+import tempfile
+
+from epuharness.monitor import ResourceMonitor, format_stats, DEFAULT_INTERVAL
+
+
+class FakeHarness(object):
+
+    def __init__(self):
+        self.manifest = {
+            'pd_0-0': {'service': 'pd_0'},
+            'pd_0-1': {'service': 'pd_0'},
+        }
+
+    def _process_info(self):
+        # both replicas report the test process, so their use is summed
+        return {
+            'pd_0-0': {'name': 'pd_0-0', 'pid': os.getpid()},
+            'pd_0-1': {'name': 'pd_0-1', 'pid': os.getpid()},
+            'gone': {'name': 'gone', 'pid': 0},
+        }
+
+
+def test_default_interval():
+    class Config(dict):
+        __getattr__ = dict.__getitem__
+
+    harness = FakeHarness()
+    harness.CFG = Config(epuharness=Config(monitor_interval=None))
+    assert ResourceMonitor(harness, samples=3).interval == DEFAULT_INTERVAL
+
+
+class TestResourceMonitor(object):
+
+    def setup(self):
+        self.monitor = ResourceMonitor(FakeHarness(), interval=0.01, samples=3)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.monitor.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sample(self):
+        samples = self.monitor.sample()
+        assert sorted(samples) == ['gone', 'pd_0']
+        assert samples['pd_0'].processes >= 2
+        assert samples['pd_0'].rss > 0
+        assert samples['pd_0'].threads >= 2
+        assert samples['gone'].processes == 0
+
+    def test_ring_buffer(self):
+        for i in range(5):
+            self.monitor.sample()
+        assert len(self.monitor.samples['pd_0']) == 3
+
+        stats = self.monitor.stats(['pd_0'])
+        assert stats.keys() == ['pd_0']
+        assert stats['pd_0']['samples'] == 3
+        assert stats['pd_0']['cpu_percent'] >= 0
+        assert stats['pd_0']['rss_max'] >= stats['pd_0']['rss']
+        assert 'pd_0' in format_stats(stats)
+
+    def test_cpu_needs_two_samples(self):
+        self.monitor.sample()
+        assert self.monitor.stats()['pd_0']['cpu_percent'] is None
+
+    def test_dump(self):
+        self.monitor.sample()
+        path = os.path.join(self.tmpdir, "resources.json")
+        self.monitor.dump(path)
+        with open(path) as f:
+            dumped = json.load(f)
+        assert len(dumped['samples']['pd_0']) == 1
+        assert dumped['samples']['pd_0'][0]['rss'] > 0
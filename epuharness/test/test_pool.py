@@ -0,0 +1,110 @@
+from nose.tools import assert_raises
+
+from epuharness.pool import HarnessPool
+from epuharness.exceptions import HarnessException
+
+ONE_NODE = """
+process-dispatchers:
+  pd_0:
+    config: {}
+nodes:
+  nodeone:
+    process-dispatcher: pd_0
+    eeagents:
+      eeagent_nodeone:
+        launch_type: supd
+"""
+
+TWO_NODES = ONE_NODE + """
+  nodetwo:
+    process-dispatcher: pd_0
+    eeagents:
+      eeagent_nodetwo:
+        launch_type: supd
+"""
+
+
+class FakeHarness(object):
+
+    def __init__(self, namespace, fail_reset=False):
+        self.namespace = namespace
+        self.fail_reset = fail_reset
+        self.calls = []
+
+    def start(self, **kwargs):
+        self.calls.append('start')
+        if 'broken' in kwargs['deployment_str']:
+            raise HarnessException("broken")
+
+    def reset(self):
+        self.calls.append('reset')
+        if self.fail_reset:
+            raise HarnessException("pd_0 didn't come back")
+
+    def wait_until_ready(self, plan, timeout=None):
+        self.calls.append('ready')
+
+    def stop(self, **kwargs):
+        self.calls.append('stop')
+
+
+class FakeHarnessPool(HarnessPool):
+
+    def __init__(self, **kwargs):
+        HarnessPool.__init__(self, **kwargs)
+        self.harnesses = []
+
+    def make_harness(self):
+        harness = FakeHarness("pool-%d" % len(self.harnesses))
+        self.harnesses.append(harness)
+        return harness
+
+
+class TestHarnessPool(object):
+
+    def setup(self):
+        self.pool = FakeHarnessPool(max_idle=2)
+
+    def test_reuse(self):
+        harness = self.pool.checkout(ONE_NODE)
+        assert harness.calls == ['start']
+        self.pool.checkin(harness)
+
+        assert self.pool.checkout(ONE_NODE) is harness
+        assert harness.calls == ['start', 'reset', 'ready']
+
+        # a different deployment gets a harness of its own
+        other = self.pool.checkout(TWO_NODES)
+        assert other is not harness
+        self.pool.checkin(other)
+        self.pool.checkin(harness)
+        # checking in twice is harmless
+        self.pool.checkin(harness)
+        assert len(self.pool.idle) == 2
+
+        self.pool.shutdown()
+        assert harness.calls[-1] == 'stop'
+        assert other.calls[-1] == 'stop'
+        assert self.pool.idle == []
+
+    def test_max_idle(self):
+        self.pool.prestart(count=3, deployment_str=ONE_NODE)
+        assert len(self.pool.idle) == 2
+        assert self.pool.harnesses[0].calls == ['start', 'stop']
+
+        # the least recently used harness is checked out first
+        assert self.pool.checkout(ONE_NODE) is self.pool.harnesses[1]
+
+    def test_failed_reset(self):
+        harness = self.pool.checkout(ONE_NODE)
+        harness.fail_reset = True
+        self.pool.checkin(harness)
+
+        replacement = self.pool.checkout(ONE_NODE)
+        assert replacement is not harness
+        assert harness.calls[-1] == 'stop'
+
+    def test_failed_start(self):
+        assert_raises(HarnessException, self.pool.checkout, ONE_NODE + "# broken\n")
+        assert self.pool.harnesses[0].calls == ['start', 'stop']
+        assert self.pool.checked_out == {}
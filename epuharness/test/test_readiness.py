@@ -0,0 +1,28 @@
+import gevent
+from socket import timeout
+from mock import patch
+
+from epuharness.readiness import check_readiness
+
+
+class TestReadiness(object):
+
+    def test_report(self):
+
+        def ready():
+            pass
+
+        def never_ready():
+            gevent.sleep(0.01)
+            raise timeout()
+
+        probes = [("pd_0", ready, {}), ("eeagent_nodeone", never_ready, {})]
+        with patch('epuharness.readiness.get_probes', return_value=probes):
+            report = check_readiness({}, None, timeout=0.1)
+
+        assert not report.ready
+        assert report.unready_services() == ["eeagent_nodeone"]
+        assert report["pd_0"]["ready"]
+        assert report["pd_0"]["time_to_ready"] < 0.1
+        assert report["eeagent_nodeone"]["time_to_ready"] is None
+        assert report["eeagent_nodeone"]["attempts"] > 1
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+
+from epuharness.registry import HarnessRegistry, format_entries
+
+
+class TestHarnessRegistry(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.registry = HarnessRegistry(os.path.join(self.dir, "registry"))
+        self.pidantic_dir = os.path.join(self.dir, "epuharness-alice")
+        os.mkdir(self.pidantic_dir)
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_register(self):
+        assert self.registry.entries() == []
+        self.registry.register("alice", self.pidantic_dir, exchange="epuharness.alice")
+
+        entry = self.registry.get("alice")
+        assert entry['pidantic_dir'] == self.pidantic_dir
+        assert entry['exchange'] == "epuharness.alice"
+        assert entry['pid'] == os.getpid()
+        assert [e['name'] for e in self.registry.entries()] == ["alice"]
+        assert "epuharness.alice" in format_entries(self.registry.entries())
+
+        self.registry.unregister("alice")
+        assert self.registry.get("alice") is None
+        # unregistering twice is harmless
+        self.registry.unregister("alice")
+
+    def test_prunes_dead_harnesses(self):
+        self.registry.register("alice", self.pidantic_dir)
+        self.registry.register("bob", os.path.join(self.dir, "epuharness-bob"))
+
+        assert [e['name'] for e in self.registry.entries()] == ["alice"]
+        assert os.listdir(self.registry.directory) == ["alice.yml"]
@@ -0,0 +1,90 @@
+import socket
+
+from nose.tools import assert_raises
+
+from epuharness.rpcstats import RPCStats, InstrumentedDashi, instrument, payload_size
+
+
+class FakeDashi(object):
+
+    def __init__(self):
+        self.fired = []
+        self.consumed = False
+
+    def call(self, name, operation, **kwargs):
+        if operation == "slow_op":
+            raise socket.timeout()
+        if operation == "bad_op":
+            raise ValueError("bad")
+        return {'name': name, 'args': kwargs}
+
+    def fire(self, name, operation, **kwargs):
+        self.fired.append((name, operation, kwargs))
+
+    def consume(self):
+        self.consumed = True
+
+
+def test_call_and_fire():
+    stats = RPCStats()
+    dashi = instrument(FakeDashi(), stats)
+
+    result = dashi.call("pd_0", "describe_processes", upid="one")
+    assert result == {'name': "pd_0", 'args': {'upid': "one"}}
+    dashi.call("pd_0", "describe_processes")
+    dashi.fire("pd_0", "heartbeat", message={'processes': []})
+
+    summary = stats.summary()
+    describe = summary['describe_processes']
+    assert describe['calls'] == 2
+    assert describe['latency']['count'] == 2
+    assert describe['request_bytes'] == payload_size({'upid': "one"}) + payload_size({})
+    assert describe['max_response_bytes'] == payload_size(result)
+
+    heartbeat = summary['heartbeat']
+    assert heartbeat['fires'] == 1
+    assert heartbeat['calls'] == 0
+    assert heartbeat['latency']['count'] == 0
+
+    assert stats.summary(["heartbeat"]).keys() == ["heartbeat"]
+
+
+def test_timeouts_and_errors():
+    stats = RPCStats()
+    dashi = instrument(FakeDashi(), stats)
+
+    assert_raises(socket.timeout, dashi.call, "pd_0", "slow_op")
+    assert_raises(ValueError, dashi.call, "pd_0", "bad_op")
+
+    summary = stats.summary()
+    assert summary['slow_op']['timeouts'] == 1
+    assert summary['slow_op']['errors'] == 0
+    assert summary['slow_op']['latency']['count'] == 0
+    assert summary['bad_op']['errors'] == 1
+
+
+def test_passes_through():
+    fake = FakeDashi()
+    stats = RPCStats()
+    dashi = instrument(fake, stats)
+    assert isinstance(dashi, InstrumentedDashi)
+    assert instrument(dashi, RPCStats()) is dashi
+
+    dashi.consume()
+    assert fake.consumed
+
+
+def test_window():
+    stats = RPCStats()
+    dashi = instrument(FakeDashi(), stats)
+    dashi.call("pd_0", "describe_processes")
+    dashi.fire("pd_0", "heartbeat")
+
+    line = stats.format_window()
+    assert line.startswith("dashi: 2 operations")
+    assert "describe_processes 1 calls" in line
+    assert "heartbeat 1 fires" in line
+
+    stats.log_window()
+    assert stats.window == {}
+    assert stats.summary()['describe_processes']['calls'] == 1
@@ -0,0 +1,109 @@
+from nose.tools import assert_raises
+
+from epuharness.schema import validate_deployment
+from epuharness.exceptions import DeploymentDescriptionError
+
+
+def error_for(deployment):
+    try:
+        validate_deployment(deployment)
+    except DeploymentDescriptionError, e:
+        return str(e)
+    assert False, "%s should be invalid" % deployment
+
+
+class TestSchema(object):
+
+    def setup(self):
+        self.deployment = {
+            'process-dispatchers': {
+                'pd_0': {'config': {'processdispatcher': {'engines': {
+                    'default': {'slots': 4}, 'big': {'slots': 16}}}}},
+            },
+            'nodes': {
+                'nodeone': {
+                    'engine': 'big',
+                    'process-dispatcher': 'pd_0',
+                    'eeagents': {
+                        'eeagent_nodeone': {'launch_type': 'supd', 'slots': 4},
+                    },
+                },
+            },
+            'epums': {'epum_0': None},
+            'phantom-instances': {'phantom': {'port': 8080,
+                'users': [{'user': 'alice', 'password': 'secret'}]}},
+        }
+
+    def test_valid(self):
+        validate_deployment(self.deployment)
+        validate_deployment({})
+
+    def test_not_a_mapping(self):
+        assert_raises(DeploymentDescriptionError, validate_deployment, ['pd_0'])
+
+    def test_unknown_section(self):
+        self.deployment['process_dispatchers'] = {}
+        assert "Unknown section 'process_dispatchers'" in error_for(self.deployment)
+
+    def test_unknown_key(self):
+        self.deployment['epums']['epum_0'] = {'confg': {}}
+        assert "epums 'epum_0' has unknown key 'confg'" in error_for(self.deployment)
+
+    def test_wrong_type(self):
+        self.deployment['nodes']['nodeone']['eeagents']['eeagent_nodeone']['slots'] = "four"
+        assert "'slots' of 'four'" in error_for(self.deployment)
+
+    def test_missing_launch_type(self):
+        del self.deployment['nodes']['nodeone']['eeagents']['eeagent_nodeone']['launch_type']
+        assert "is missing 'launch_type'" in error_for(self.deployment)
+
+    def test_pyon_needs_directory(self):
+        eeagent = self.deployment['nodes']['nodeone']['eeagents']['eeagent_nodeone']
+        eeagent['launch_type'] = 'pyon_single'
+        assert "no pyon_directory" in error_for(self.deployment)
+        eeagent['pyon_directory'] = '/opt/coi-services'
+        validate_deployment(self.deployment)
+
+    def test_simulated(self):
+        eeagent = self.deployment['nodes']['nodeone']['eeagents']['eeagent_nodeone']
+        eeagent['launch_latency'] = [0.1, 0.5]
+        assert "only simulated eeagents" in error_for(self.deployment)
+
+        eeagent['launch_type'] = 'simulated'
+        eeagent['failure_rate'] = 0.1
+        validate_deployment(self.deployment)
+
+        eeagent['launch_latency'] = [0.1]
+        eeagent['failure_rate'] = 2
+        error = error_for(self.deployment)
+        assert "[low, high] range" in error
+        assert "between 0 and 1" in error
+
+    def test_mock_cloud(self):
+        self.deployment['provisioners'] = {'prov_0': {'config': {'sites': {
+            'site1': {'mock_cloud': 'mockcloud'}}}}}
+        assert "mock cloud 'mockcloud'" in error_for(self.deployment)
+
+        self.deployment['mock-clouds'] = {'mockcloud': {
+            'boot_latency': {'distribution': 'exponential', 'mean': 30},
+            'failure_rate': 0.05}}
+        validate_deployment(self.deployment)
+
+        self.deployment['mock-clouds']['mockcloud']['boot_latency'] = {
+            'distribution': 'weibull'}
+        assert "unknown distribution 'weibull'" in error_for(self.deployment)
+
+    def test_undefined_process_dispatcher(self):
+        self.deployment['nodes']['nodeone']['process-dispatcher'] = 'pd_1'
+        assert "refers to process-dispatcher 'pd_1'" in error_for(self.deployment)
+
+    def test_undefined_engine(self):
+        self.deployment['nodes']['nodeone']['engine'] = 'huge'
+        assert "uses engine 'huge'" in error_for(self.deployment)
+
+    def test_every_error_is_reported(self):
+        self.deployment['epums']['epum_0'] = {'confg': {}}
+        self.deployment['nodes']['nodeone']['eeagents']['eeagent_nodeone']['launch_type'] = 'magic'
+        error = error_for(self.deployment)
+        assert "'confg'" in error
+        assert "'magic'" in error
@@ -0,0 +1,96 @@
+import random
+
+import gevent
+
+from epu.states import ProcessState
+
+from epuharness.simulator import SimulatedEEAgent
+from epuharness.util import sample_latency
+
+
+class FakeDashi(object):
+
+    def __init__(self):
+        self.handlers = {}
+        self.fired = []
+
+    def handle(self, handler, name):
+        self.handlers[name] = handler
+
+    def fire(self, name, operation, **kwargs):
+        self.fired.append((name, operation, kwargs))
+
+
+def test_sample_latency():
+    assert sample_latency(None) == 0
+    assert sample_latency(0.5) == 0.5
+    rng = random.Random(1)
+    for _ in range(10):
+        assert 1 <= sample_latency([1, 2], rng) <= 2
+        assert sample_latency({'distribution': 'normal', 'mean': 1, 'stddev': 5}, rng) >= 0
+        assert sample_latency({'distribution': 'exponential', 'mean': 1}, rng) >= 0
+
+
+class TestSimulatedEEAgent(object):
+
+    def setup(self):
+        self.dashi = FakeDashi()
+        self.agent = SimulatedEEAgent(self.dashi, 'eeagent_0', 'node_0', 'pd_0',
+                slots=2, rng=random.Random(0))
+
+    def states(self):
+        beat = self.agent.make_beat()
+        return dict((process['upid'], process['state']) for process in beat['processes'])
+
+    def test_handlers(self):
+        assert sorted(self.dashi.handlers) == ['cleanup', 'dump_state',
+                'launch_process', 'restart_process', 'terminate_process']
+
+    def test_lifecycle(self):
+        self.agent.launch_process('p1', 0, 'supd', {})
+        assert self.states() == {'p1': ProcessState.PENDING}
+        gevent.sleep(0.01)
+        assert self.states() == {'p1': ProcessState.RUNNING}
+
+        # state changes are sent to the process dispatcher straight away
+        name, operation, kwargs = self.dashi.fired[-1]
+        assert (name, operation) == ('pd_0', 'heartbeat')
+        assert kwargs['message']['node_id'] == 'node_0'
+        assert kwargs['message']['processes'][0]['state'] == ProcessState.RUNNING
+
+        self.agent.terminate_process('p1', 0)
+        assert self.states() == {'p1': ProcessState.TERMINATING}
+        gevent.sleep(0.01)
+        assert self.states() == {'p1': ProcessState.TERMINATED}
+
+        self.agent.cleanup('p1', 0)
+        assert self.states() == {}
+
+    def test_slots(self):
+        for upid in ('p1', 'p2', 'p3'):
+            self.agent.launch_process(upid, 0, 'supd', {})
+        gevent.sleep(0.01)
+        assert self.states() == {'p1': ProcessState.RUNNING,
+                'p2': ProcessState.RUNNING, 'p3': ProcessState.FAILED}
+        assert self.agent.used_slots() == 2
+
+    def test_failures(self):
+        self.agent.failure_rate = 1.0
+        self.agent.launch_process('p1', 0, 'supd', {})
+        gevent.sleep(0.01)
+        assert self.states() == {'p1': ProcessState.FAILED}
+
+        self.agent.failure_rate = 0.0
+        self.agent.restart_process('p1', 0)
+        gevent.sleep(0.01)
+        assert self.states() == {'p1': ProcessState.RUNNING}
+
+    def test_dump_state(self):
+        self.agent.launch_process('p1', 0, 'supd', {})
+        beat = self.agent.dump_state(rpc=True)
+        assert beat['eeagent_id'] == 'eeagent_0'
+        assert len(beat['processes']) == 1
+
+        fired = len(self.dashi.fired)
+        self.agent.dump_state()
+        assert len(self.dashi.fired) == fired + 1
@@ -0,0 +1,49 @@
+import os
+
+from epuharness import procstat
+from epuharness.harness import format_status, status_changes
+
+
+def test_read_process():
+    stats = procstat.read_process(os.getpid())
+    assert stats['pid'] == os.getpid()
+    assert stats['ppid'] == os.getppid()
+    assert stats['rss'] > 0
+    assert stats['threads'] >= 1
+    assert stats['cpu_percent'] >= 0
+
+
+def test_read_missing_process():
+    # pids are capped well below this by the kernel
+    assert procstat.read_process(2 ** 30) is None
+
+
+def test_format_status():
+    row = {'name': 'pd_0-0', 'state': 'RUNNING', 'pid': 42, 'uptime': 12,
+            'restarts': 1, 'rss': 3 * 1024 * 1024, 'cpu_percent': 1.5}
+    assert format_status(row) == \
+        "pd_0-0 is RUNNING (pid 42, up 12s, 1 restarts, rss 3.0MB, cpu 1.5%)"
+
+    row = {'name': 'pd_0-0', 'state': 'EXITED', 'pid': None}
+    assert format_status(row) == "pd_0-0 is EXITED"
+
+
+def test_status_changes():
+    first = [{'name': 'pd', 'state': 'RUNNING', 'pid': 1},
+             {'name': 'eeagent', 'state': 'RUNNING', 'pid': 2}]
+    changes = status_changes({}, first)
+    assert [change['name'] for change in changes] == ['pd', 'eeagent']
+    assert all(change['previous_state'] is None for change in changes)
+
+    previous = dict((row['name'], row) for row in first)
+    assert status_changes(previous, first) == []
+
+    # a new pid means the program restarted, even if it's still running
+    second = [{'name': 'pd', 'state': 'RUNNING', 'pid': 3}]
+    changes = status_changes(previous, second)
+    assert len(changes) == 2
+    assert changes[0]['name'] == 'pd'
+    assert changes[0]['pid'] == 3
+    assert changes[1]['name'] == 'eeagent'
+    assert changes[1]['state'] is None
+    assert changes[1]['previous_state'] == 'RUNNING'
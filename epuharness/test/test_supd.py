@@ -0,0 +1,129 @@
+from nose.tools import assert_raises
+from supervisor.xmlrpc import Faults
+
+from epuharness.supd import SupDAdapter, is_supported_version
+from epuharness.exceptions import HarnessException
+
+
+class FakeSupD(object):
+    """Stands in for pidantic's SupD object, recording the calls made to it
+    """
+
+    def __init__(self, faults=None):
+        self.calls = []
+        self.faults = faults or {}
+        self.transport = object()
+        self._supd_db = self
+        self._proxy = self
+        self.system = self
+        self.supervisor = self
+
+    def db_commit(self):
+        self.calls.append('db_commit')
+
+    def write_conf(self):
+        self.calls.append('write_conf')
+
+    def _reread(self):
+        self.calls.append('_reread')
+
+    def run_program(self, program_object):
+        self.calls.append(('run_program', program_object.process_name))
+
+    def terminate_program(self, name):
+        self.calls.append(('terminate_program', name))
+
+    def get_all_state(self):
+        return [{'name': 'one', 'pid': 1}]
+
+    def stopProcessGroup(self, name, wait=True):
+        self.calls.append(('stopProcessGroup', name, wait))
+
+    def multicall(self, calls):
+        self.calls.append(('multicall', [(c['methodName'], c['params']) for c in calls]))
+        names = [c['params'][0] for c in calls[1:]]
+        results = [[[names, [], []]]]
+        for name in names:
+            if name in self.faults:
+                results.append({'faultCode': self.faults[name], 'faultString': name})
+            else:
+                results.append(True)
+        return results
+
+
+class FakeProgram(object):
+    def __init__(self, process_name):
+        self.process_name = process_name
+
+
+class FakePid(object):
+    """Stands in for a pidantic object, calling its SupD object as pidantic
+    would
+    """
+
+    def __init__(self, supd, name):
+        self.supd = supd
+        self.name = name
+
+    def start(self):
+        self.supd.run_program(FakeProgram(self.name))
+
+    def terminate(self):
+        self.supd.terminate_program(self.name)
+
+
+class FakeFactory(object):
+    def __init__(self, supd):
+        self._supd = supd
+
+
+class TestSupDAdapter(object):
+
+    def setup(self):
+        self.supd = FakeSupD()
+        self.adapter = SupDAdapter(FakeFactory(self.supd), version="0.1.2")
+        self.pids = dict((name, FakePid(self.supd, name)) for name in ('two', 'one'))
+
+    def test_versions(self):
+        assert is_supported_version("0.1")
+        assert is_supported_version("0.1.2")
+        assert not is_supported_version("0.10")
+        assert not is_supported_version("0.2")
+        assert not is_supported_version(None)
+
+    def test_start_in_one_multicall(self):
+        self.adapter.start(self.pids)
+
+        assert self.supd.calls == ['db_commit', 'write_conf', ('multicall', [
+            ('supervisor.reloadConfig', []),
+            ('supervisor.addProcessGroup', ['one']),
+            ('supervisor.addProcessGroup', ['two'])])]
+        # pidantic's own run_program is back in place
+        assert 'run_program' not in self.supd.__dict__
+
+    def test_start_faults(self):
+        self.supd.faults['one'] = Faults.ALREADY_ADDED
+        self.adapter.start(self.pids)
+
+        self.supd.faults['two'] = Faults.BAD_NAME
+        assert_raises(HarnessException, self.adapter.start, self.pids)
+
+    def test_terminate(self):
+        self.adapter.terminate(self.pids)
+
+        assert self.supd.calls == [('stopProcessGroup', 'one', False),
+                ('stopProcessGroup', 'two', False)]
+        assert self.adapter.process_info() == {'one': {'name': 'one', 'pid': 1}}
+        assert self.adapter.transport is self.supd.transport
+
+    def test_unsupported_version(self):
+        adapter = SupDAdapter(FakeFactory(self.supd), version="0.2")
+        assert not adapter.batched
+
+        # programs are started and stopped through pidantic, one at a time
+        adapter.start(self.pids)
+        adapter.terminate(self.pids)
+        assert self.supd.calls == [('run_program', 'one'), ('run_program', 'two'),
+                ('terminate_program', 'one'), ('terminate_program', 'two')]
+        assert adapter.process_info() == {}
+        assert adapter.transport is None
@@ -0,0 +1,42 @@
+from epuharness.timing import Timings, timed
+
+
+class Timed(object):
+
+    def __init__(self):
+        self.timings = Timings()
+
+    @timed("build_config")
+    def build(self, name, proc_name=None):
+        return name
+
+
+class TestTimings(object):
+
+    def test_phases(self):
+
+        timings = Timings()
+        with timings.phase("parse_deployment"):
+            pass
+        timings.record("pid.start", 10.0, 0.5, service="pd_0-0")
+        timings.record("pid.start", 10.0, 1.5, service="pd_0-1")
+
+        summary = timings.summary()
+        assert summary["parse_deployment"]["count"] == 1
+        assert summary["pid.start"] == {'count': 2, 'total': 2.0, 'max': 1.5}
+        assert len(timings.for_service("pd_0-1")) == 1
+
+        trace = timings.to_chrome_trace()['traceEvents']
+        assert len(trace) == 3
+        assert trace[2]['ts'] == 10000000
+        assert trace[2]['dur'] == 1500000
+        assert trace[2]['args'] == {'service': 'pd_0-1'}
+
+    def test_timed(self):
+
+        obj = Timed()
+        assert obj.build("pd_0", proc_name="pd_0-0") == "pd_0"
+        assert obj.build("eeagent") == "eeagent"
+
+        services = [event['service'] for event in obj.timings.events]
+        assert services == ["pd_0-0", "eeagent"]
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import gevent
+import inspect
+import functools
+
+from contextlib import contextmanager
+
+
+class Timings(object):
+    """Records how long each phase of a harness operation took, overall and
+    for each service.
+
+    Each event is a dictionary with the phase name, the service it applies
+    to (or None), its start time and duration in seconds, and any extra
+    arguments it was recorded with.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    @contextmanager
+    def phase(self, name, service=None, **args):
+        """Time the body of a with block as one event"""
+        began = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, began, time.time() - began, service=service, **args)
+
+    def record(self, name, start, duration, service=None, **args):
+        self.events.append({
+            'name': name,
+            'service': service,
+            'start': start,
+            'duration': duration,
+            'args': args,
+            'greenlet': id(gevent.getcurrent()),
+        })
+
+    def clear(self):
+        self.events = []
+
+    def summary(self):
+        """Returns a dictionary with the count, total and maximum duration of
+        each phase
+        """
+        summary = {}
+        for event in self.events:
+            phase = summary.setdefault(event['name'],
+                    {'count': 0, 'total': 0.0, 'max': 0.0})
+            phase['count'] += 1
+            phase['total'] += event['duration']
+            phase['max'] = max(phase['max'], event['duration'])
+        return summary
+
+    def for_service(self, service):
+        """Returns the events recorded for one service"""
+        return [event for event in self.events if event['service'] == service]
+
+    def format_summary(self):
+        lines = ["%-20s %6s %10s %10s" % ("phase", "count", "total(s)", "max(s)")]
+        summary = self.summary()
+        for name in sorted(summary, key=lambda n: -summary[n]['total']):
+            phase = summary[name]
+            lines.append("%-20s %6d %10.3f %10.3f" % (name, phase['count'],
+                phase['total'], phase['max']))
+        return "\n".join(lines)
+
+    def to_chrome_trace(self):
+        """Returns the events in the Chrome trace event format, which can be
+        loaded in chrome://tracing. Each greenlet is shown as a thread.
+        """
+        pid = os.getpid()
+        threads = {}
+        trace_events = []
+        for event in self.events:
+            tid = threads.setdefault(event['greenlet'], len(threads))
+            args = dict(event['args'])
+            if event['service']:
+                args['service'] = event['service']
+            trace_events.append({
+                'name': event['name'],
+                'cat': event['service'] or 'harness',
+                'ph': 'X',
+                'ts': int(event['start'] * 1000000),
+                'dur': int(event['duration'] * 1000000),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            })
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        """Write the events to path as a Chrome trace"""
+        with open(path, "w") as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
+
+
+def timed(phase):
+    """Decorator for harness methods that records each call in self.timings.
+
+    The event's service is taken from the method's proc_name or name
+    argument, when it has one.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            callargs = inspect.getcallargs(fn, self, *args, **kwargs)
+            service = callargs.get('proc_name') or callargs.get('name')
+            with self.timings.phase(phase, service=service):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,4 +1,6 @@
 import os
+import random
+import socket
 
 def determine_path():                                                           
     """find path of current file,                                               
@@ -39,3 +41,38 @@ def get_config_paths(configs):
         paths.append(path)                                                      
                                                                                 
     return paths                                                                
+
+
+def sample_latency(latency, rng=random):
+    """Pick a delay, in seconds, from a latency setting. A latency is one of:
+
+        a number of seconds
+        a [low, high] list, to pick uniformly between
+        {distribution: normal, mean: 30, stddev: 5}
+        {distribution: exponential, mean: 30}
+
+    Delays are never negative.
+    """
+    if not latency:
+        return 0
+    if isinstance(latency, (list, tuple)):
+        low, high = latency
+        return rng.uniform(low, high)
+    if isinstance(latency, dict):
+        distribution = latency.get('distribution', 'normal')
+        if distribution == 'normal':
+            return max(0, rng.gauss(latency['mean'], latency.get('stddev', 0)))
+        elif distribution == 'exponential':
+            return rng.expovariate(1.0 / latency['mean']) if latency['mean'] else 0
+        raise ValueError("Unknown latency distribution '%s'" % distribution)
+    return latency
+
+
+def free_port(host="127.0.0.1"):
+    """Returns a TCP port nothing is listening on, as picked by the OS"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
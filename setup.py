@@ -63,12 +63,17 @@ setupdict['install_requires'] += ['pyyaml',
                                   'eeagent',
                                   'ceiclient',
                                  ]
-setupdict['tests_require'] = ['nose']
+setupdict['tests_require'] = ['nose', 'mock']
 setupdict['test_suite'] = 'nose.collector'
 
 setupdict['entry_points'] = {
         'console_scripts': [
             'epu-harness=epuharness.cli:main',
+            'epu-harness-benchmark=epuharness.benchmark:main',
+            'epu-harness-simulator=epuharness.simulator:main',
+            'epu-harness-mockcloud=epuharness.mockcloud:main',
+            'epu-harness-loadgen=epuharness.loadgen:main',
+            'epu-harness-broker=epuharness.broker:main',
             ]
         }
 